@@ -0,0 +1,101 @@
+"""Deterministic generator of realistic todo.txt files for the benchmarks.
+
+    python benchmarks/generate.py 100000 -o todo.txt --seed 1
+
+The same count and seed always give the same file. Lines mix priorities,
+created and done dates, +projects and @contexts (a few popular ones and a
+long tail), labels such as jira:TODO-123, due: and est:, and a small share
+of malformed lines that the parser warns about.
+"""
+import argparse
+import random
+import sys
+from datetime import date, timedelta
+
+WORDS = ('review', 'update', 'fix', 'write', 'call', 'plan', 'prepare',
+         'check', 'send', 'merge', 'release', 'notes', 'budget', 'report',
+         'meeting', 'design', 'tests', 'docs', 'invoice', 'backup', 'server',
+         'client', 'roadmap', 'slides', 'feedback', 'draft', 'the', 'for',
+         'with', 'about', 'new', 'old', 'weekly', 'quarterly', 'team')
+PROJECTS = ['proj{}'.format(i) for i in range(60)]
+CONTEXTS = ['ctx{}'.format(i) for i in range(25)]
+START = date(2020, 1, 1)
+DAYS = 1500
+
+
+def pick(rng, values):
+    # Skewed towards the first values, like real projects and contexts
+    return values[min(int(rng.paretovariate(1.2)) - 1, len(values) - 1)]
+
+
+def day(rng):
+    return START + timedelta(days=rng.randrange(DAYS))
+
+
+def line(rng, no):
+    """One todo.txt line (without the newline) for line number no."""
+    roll = rng.random()
+    if roll < 0.003:
+        # Done with a single date
+        return 'x {} {}'.format(day(rng), 'malformed done todo')
+    if roll < 0.006:
+        # Two dates but not done
+        return '{} {} {}'.format(day(rng), day(rng), 'malformed open todo')
+
+    parts = []
+    done = rng.random() < 0.25
+    if done:
+        parts.append('x')
+    if rng.random() < 0.6:
+        parts.append('({})'.format(rng.choice('AAABBBBCCCDE')))
+    if done and rng.random() < 0.8:
+        created = day(rng)
+        parts.append(str(created + timedelta(days=rng.randrange(60))))
+        parts.append(str(created))
+    elif not done and rng.random() < 0.7:
+        parts.append(str(day(rng)))
+
+    parts.extend(rng.choice(WORDS) for _ in range(rng.randint(2, 7)))
+    for _ in range(rng.choice((0, 1, 1, 1, 2))):
+        parts.append('+' + pick(rng, PROJECTS))
+    for _ in range(rng.choice((0, 1, 1, 2))):
+        parts.append('@' + pick(rng, CONTEXTS))
+    if rng.random() < 0.5:
+        parts.append('jira:TODO-{}'.format(no))
+    if rng.random() < 0.3:
+        parts.append('due:{}'.format(day(rng)))
+    if rng.random() < 0.1:
+        parts.append('est:{}'.format(rng.randint(1, 13)))
+    return ' '.join(parts)
+
+
+def generate(count, seed=0):
+    """Return count todo.txt lines, each ending with a newline."""
+    rng = random.Random(seed)
+    return [line(rng, no) + '\n' for no in range(count)]
+
+
+def write(path, count, seed=0):
+    with open(path, 'w') as todo_file:
+        todo_file.writelines(generate(count, seed))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic todo.txt file')
+    parser.add_argument('count', type=int, help='Number of lines')
+    parser.add_argument('-o',
+                        metavar='file',
+                        dest='output',
+                        help='Write to file instead of stdout')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    args = parser.parse_args()
+
+    if args.output:
+        write(args.output, args.count, args.seed)
+    else:
+        sys.stdout.writelines(generate(args.count, args.seed))
+
+
+if __name__ == '__main__':
+    main()
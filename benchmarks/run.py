@@ -0,0 +1,693 @@
+"""Benchmark suite for todo.py.
+
+    python benchmarks/run.py -o before.json
+    python benchmarks/run.py -o after.json --compare before.json
+
+Every benchmark runs against generated todo.txt files (see generate.py) of
+each size in a throwaway todo-dir, and is measured --repeat times: most are
+timed in seconds, the memory_* ones measure the peak memory in KiB and the
+footprint_* ones the memory held per line of todo.txt in bytes. Results
+are written as JSON (best and median per benchmark and size, with their
+unit) together with the commit, Python version and CPU count they were
+taken with, so two runs can be compared with --compare. Benchmarks with a
+budget (import_time) are flagged when their best run exceeds it, and make
+run.py exit with status 1.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'todo.py')
+sys.path.insert(0, ROOT)
+
+import todo  # noqa: E402
+import generate  # noqa: E402
+
+
+class Workspace:
+    """A todo-dir with a generated todo.txt and a dotfile pointing at it,
+    used as HOME by the commands run in a subprocess."""
+    def __init__(self, size, seed):
+        self.size = size
+        self.dir = tempfile.mkdtemp(prefix='todo-bench-')
+        self.todo_path = os.path.join(self.dir, 'todo.txt')
+        self.original = os.path.join(self.dir, 'original.txt')
+        self.dotfile = os.path.join(self.dir, '.todo-cli')
+        generate.write(self.original, size, seed)
+        with open(self.dotfile, 'w') as dotfile:
+            dotfile.write('todo-dir={}'.format(self.dir))
+        # Like todo.txt, old enough for its parsed cache to be trusted, the
+        # way it is once set up
+        past = time.time() - 10
+        os.utime(self.dotfile, (past, past))
+        self.reset()
+
+    def reset(self, cached=True):
+        """Restore the generated todo.txt, with a fresh cache or none."""
+        for name in os.listdir(self.dir):
+            if name.startswith('.todo.txt') or name == 'done.txt':
+                os.remove(os.path.join(self.dir, name))
+        shutil.copyfile(self.original, self.todo_path)
+        # Old enough for the cache to be trusted on its mtime
+        past = time.time() - 10
+        os.utime(self.todo_path, (past, past))
+        self.config = todo.Dotfile(self.dotfile)
+        if cached:
+            with quiet():
+                todo.load_cache_entry(self.config)
+
+    def run(self, *argv, stdin=None):
+        return subprocess.run([sys.executable, SCRIPT] + list(argv),
+                              env=dict(os.environ, HOME=self.dir),
+                              input=stdin,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.PIPE,
+                              text=True,
+                              check=True)
+
+    def close(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(
+            devnull), contextlib.redirect_stderr(devnull):
+        yield
+
+
+def traced(fn, repeat, setup=None):
+    """Run setup and fn repeat times, return the peak memory fn allocated
+    in KiB, as seen by tracemalloc."""
+    import tracemalloc
+    peaks = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        tracemalloc.start()
+        try:
+            with quiet():
+                fn()
+            peaks.append(tracemalloc.get_traced_memory()[1] / 1024)
+        finally:
+            tracemalloc.stop()
+    return peaks
+
+
+def kib(bench):
+    """Mark bench as measuring KiB instead of seconds."""
+    bench.unit = 'KiB'
+    return bench
+
+
+def per_line(bench):
+    """Mark bench as measuring bytes per line of todo.txt."""
+    bench.unit = 'B/line'
+    return bench
+
+
+def budget(seconds):
+    """Mark a benchmark as failing when its best run takes longer."""
+    def mark(bench):
+        bench.budget = seconds
+        return bench
+
+    return mark
+
+
+def timed(fn, repeat, setup=None):
+    """Run setup (untimed) and fn repeat times, return the durations."""
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        with quiet():
+            fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+# Each benchmark takes a Workspace and the repeat count and returns the
+# durations of its runs (or peak memory for those marked with kib), or None
+# when it does not apply to the workspace.
+
+
+def bench_parse(ws, repeat):
+    with open(ws.original) as todo_file:
+        lines = todo_file.readlines()
+    parser = todo.TodoParser()
+
+    def parse():
+        for idx, line in enumerate(lines):
+            todo.TodoCache.parse_record(parser, idx, line)
+
+    return timed(parse, repeat)
+
+
+def bench_load_cold(ws, repeat):
+    return timed(lambda: todo.load_todos(ws.config), repeat,
+                 lambda: ws.reset(cached=False))
+
+
+def bench_load_warm(ws, repeat):
+    return timed(lambda: todo.load_todos(ws.config), repeat, ws.reset)
+
+
+def bench_load_appended(ws, repeat):
+    # 1% more lines than the cache knows about, only those are parsed
+    extra = generate.generate(max(1, ws.size // 100), seed=ws.size)
+
+    def append():
+        ws.reset()
+        with open(ws.todo_path, 'a') as todo_file:
+            todo_file.writelines(extra)
+
+    return timed(lambda: todo.load_todos(ws.config), repeat, append)
+
+
+def bench_load_workers(ws, repeat, workers):
+    if ws.size * 80 < 2 * todo.TodoCache.parallel_size:
+        return None
+
+    def setup():
+        ws.reset(cached=False)
+        ws.config.workers = workers
+
+    return timed(lambda: todo.load_todos(ws.config), repeat, setup)
+
+
+def ls(**kwargs):
+    def bench(ws, repeat):
+        args = dict(category=None, project=None, due=None, finished=False)
+        args.update(kwargs)
+        return timed(lambda: todo.ls_todo(ws.config, **args), repeat,
+                     ws.reset)
+
+    return bench
+
+
+def view(catch_up):
+    """`todo ls --view` of a view materialized by an earlier run, after a
+    todo was added when catch_up is set."""
+    def bench(ws, repeat):
+        def ls_view():
+            todo.ls_todo(ws.config, None, None, None, False, view='bench')
+
+        def setup():
+            ws.reset()
+            ws.config.views['bench'] = ['-@ ctx2 -s due,prio', None]
+            with quiet():
+                ls_view()
+                if catch_up:
+                    todo.add_todo(ws.config, None, None, 'Benchmark @ctx2',
+                                  [], [], None)
+
+        return timed(ls_view, repeat, setup)
+
+    return bench
+
+
+def bench_sort_double(ws, repeat):
+    """The sort ls_todo started out with: two stable sorts of the Todo
+    objects with lambdas, by due and then by priority."""
+    ws.reset()
+    with quiet():
+        todos = list(todo.load_todos(ws.config))
+    maximum = datetime.max
+
+    def sort():
+        ordered = list(todos)
+        ordered.sort(key=lambda t: t.due if t.due else maximum)
+        ordered.sort(key=lambda t: t.prio if t.prio else 'Z')
+
+    return timed(sort, repeat)
+
+
+def bench_sort_composite(ws, repeat):
+    """The same order (prio,due) in a single sort on the composite key of
+    the cached records, with NumPy when it is installed."""
+    ws.reset()
+    with quiet():
+        items = list(enumerate(todo.load_cache_entry(ws.config).iter_records()))
+    sorter = todo.TodoSorter()
+    return timed(lambda: sorter.select(items), repeat)
+
+
+@kib
+def bench_memory_load_cold(ws, repeat):
+    return traced(lambda: list(todo.load_todos(ws.config)), repeat,
+                  lambda: ws.reset(cached=False))
+
+
+@kib
+def bench_memory_load_warm(ws, repeat):
+    return traced(lambda: list(todo.load_todos(ws.config)), repeat, ws.reset)
+
+
+@kib
+def bench_memory_ls(ws, repeat):
+    return traced(
+        lambda: todo.ls_todo(ws.config, None, None, None, False, limit=20),
+        repeat, ws.reset)
+
+
+@kib
+def bench_memory_cli_ls(ws, repeat):
+    """Peak resident size (ru_maxrss) of a whole `todo ls -n 20` process."""
+    if not hasattr(os, 'wait4'):
+        return None
+    ws.reset()
+    peaks = []
+    for _ in range(repeat):
+        process = subprocess.Popen([sys.executable, SCRIPT, 'ls', '-n', '20'],
+                                   env=dict(os.environ, HOME=ws.dir),
+                                   stdout=subprocess.DEVNULL)
+        (_, status, usage) = os.wait4(process.pid, 0)
+        # Reaped here, so the Popen must not wait for it again
+        process.returncode = status
+        if status:
+            raise subprocess.CalledProcessError(status, process.args)
+        # Bytes on macOS, KiB elsewhere
+        peaks.append(usage.ru_maxrss /
+                     (1024 if sys.platform == 'darwin' else 1))
+    return peaks
+
+
+def footprint(build, lines, repeat, setup=None):
+    """Run setup and build repeat times, return the memory still allocated
+    while what build returned is alive in bytes per line, as seen by
+    tracemalloc."""
+    import tracemalloc
+    sizes = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        tracemalloc.start()
+        try:
+            with quiet():
+                kept = build()
+            sizes.append(tracemalloc.get_traced_memory()[0] / lines)
+        finally:
+            tracemalloc.stop()
+        del kept
+    return sizes
+
+
+class DictTodo:
+    """A Todo the way it was before it had __slots__: its attributes in an
+    instance __dict__, with nothing interned or shared between todos."""
+    def __init__(self, item):
+        for name in todo.Todo.__slots__:
+            setattr(self, name, unshared(getattr(item, name)))
+
+
+def unshared(value):
+    """A copy of value sharing no strings or dates with it."""
+    if isinstance(value, str):
+        return (value + ' ')[:-1]
+    if isinstance(value, datetime):
+        return value.replace()
+    if isinstance(value, list):
+        return [unshared(item) for item in value]
+    if isinstance(value, dict):
+        return {unshared(k): unshared(v) for k, v in value.items()}
+    return value
+
+
+@per_line
+def bench_footprint_records(ws, repeat):
+    """The (idx, record) tuples ls, search and the exports work on."""
+    def records():
+        return list(todo.load_cache_entry(ws.config).iter_records())
+
+    return footprint(records, ws.size, repeat, ws.reset)
+
+
+@per_line
+def bench_footprint_todos(ws, repeat):
+    return footprint(lambda: list(todo.load_todos(ws.config)), ws.size,
+                     repeat, ws.reset)
+
+
+@per_line
+def bench_footprint_dict_todos(ws, repeat):
+    """The todos of footprint_todos as DictTodo, the baseline."""
+    todos = []
+
+    def setup():
+        ws.reset()
+        with quiet():
+            todos[:] = todo.load_todos(ws.config)
+
+    return footprint(lambda: [DictTodo(item) for item in todos], ws.size,
+                     repeat, setup)
+
+
+def first_row(*argv):
+    """Wall time from starting a `todo ls` process to reading the first row
+    of its table."""
+    def bench(ws, repeat):
+        def run():
+            process = subprocess.Popen([sys.executable, SCRIPT, 'ls'] +
+                                       list(argv),
+                                       env=dict(os.environ, HOME=ws.dir),
+                                       stdout=subprocess.PIPE)
+            # The rule and the header come first
+            rows = 0
+            for line in process.stdout:
+                if line.startswith(b'|'):
+                    rows += 1
+                    if rows == 2:
+                        break
+            process.stdout.close()
+            process.wait()
+
+        return timed(run, repeat, ws.reset)
+
+    return bench
+
+
+def bench_print_todos(ws, repeat):
+    ws.reset()
+    with quiet():
+        todos = todo.load_todos(ws.config)
+    printer = todo.TodoPrinter(todo.TodoPrinter.Properties.get_default())
+    return timed(lambda: printer.print_todos(todos), repeat)
+
+
+def bench_write_todo_file(ws, repeat):
+    ws.reset()
+    with quiet():
+        todos = todo.load_todos(ws.config)
+    return timed(lambda: todo.write_todo_file(ws.config, todos), repeat)
+
+
+def bench_set(ws, repeat):
+    line = str(ws.size // 2)
+    return timed(lambda: todo.toggle_todo(ws.config, line, 'toggle'), repeat,
+                 ws.reset)
+
+
+def bench_batch(ws, repeat):
+    ops = []
+    for no in range(0, ws.size, max(1, ws.size // 100)):
+        ops.append('set {} toggle'.format(no))
+        ops.append('add "Benchmark todo {}" -+ bench'.format(no))
+    path = os.path.join(ws.dir, 'batch.txt')
+    with open(path, 'w') as batch_file:
+        batch_file.write('\n'.join(ops))
+    return timed(lambda: todo.batch_todo(ws.config, path), repeat, ws.reset)
+
+
+def bench_archive(ws, repeat):
+    return timed(lambda: todo.archive_todo(ws.config), repeat, ws.reset)
+
+
+def bench_cli_startup(ws, repeat):
+    """Wall time of a whole `todo ls -n 1` process, minus a bare
+    interpreter start."""
+    bare = min(
+        timed(
+            lambda: subprocess.run([sys.executable, '-c', 'pass'], check=True),
+            repeat))
+    ws.reset()
+    return [t - bare for t in timed(lambda: ws.run('ls', '-n', '1'), repeat)]
+
+
+def import_times(argv, ws=None):
+    """The cumulative import time in seconds of every module imported at
+    the top level by a python -X importtime run of argv."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + argv,
+        env=dict(os.environ, HOME=ws.dir) if ws else None,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True)
+    modules = {}
+    # import time: self [us] | cumulative | imported package
+    for line in result.stderr.splitlines():
+        fields = line.split('|')
+        if not line.startswith('import time:') or len(fields) != 3:
+            continue
+        name = fields[2][1:]
+        if fields[1].strip().isdigit() and not name.startswith(' '):
+            modules[name] = int(fields[1]) / 1e6
+    return modules
+
+
+@budget(0.015)
+def bench_import_time(ws, repeat):
+    """Time `todo ls -n 1` spends importing modules a bare interpreter
+    does not, as reported by python -X importtime."""
+    ws.reset()
+    bare = set(import_times(['-c', 'pass']))
+    times = []
+    for _ in range(repeat):
+        modules = import_times([SCRIPT, 'ls', '-n', '1'], ws)
+        times.append(
+            sum(value for name, value in modules.items() if name not in bare))
+    return times
+
+
+def bench_serve(ws, repeat):
+    """`todo ls -+ proj1` forwarded to a running `todo serve`."""
+    if not hasattr(__import__('socket'), 'AF_UNIX'):
+        return None
+    ws.reset()
+    server = subprocess.Popen([sys.executable, SCRIPT, 'serve'],
+                              env=dict(os.environ, HOME=ws.dir),
+                              stdout=subprocess.DEVNULL)
+    try:
+        while not os.path.exists(ws.dotfile + '.sock'):
+            if server.poll() is not None:
+                return None
+            time.sleep(0.05)
+        return timed(lambda: ws.run('ls', '-+', 'proj1'), repeat)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def bench_concurrent_writes(ws, repeat):
+    """Concurrent add and set processes, checking that no write is lost."""
+    if ws.size > 1000:
+        return None
+    from concurrent.futures import ThreadPoolExecutor
+    jobs = [('add', 'Concurrent {}'.format(no)) for no in range(40)]
+    jobs += [('set', str(no), 'done') for no in range(0, 40, 2)]
+
+    def run():
+        with ThreadPoolExecutor(8) as executor:
+            list(executor.map(lambda argv: ws.run(*argv), jobs))
+        with open(ws.todo_path) as todo_file:
+            lines = todo_file.readlines()
+        lost = 40 - sum(1 for line in lines if line.startswith('Concurrent'))
+        if lost:
+            raise AssertionError('{} concurrent adds were lost'.format(lost))
+
+    return timed(run, repeat, lambda: ws.reset(cached=False))
+
+
+BENCHMARKS = {
+    'parse': bench_parse,
+    'load_cold': bench_load_cold,
+    'load_warm': bench_load_warm,
+    'load_appended': bench_load_appended,
+    'ls': ls(),
+    'ls_project': ls(project='proj3'),
+    'ls_category': ls(category='ctx2'),
+    'ls_due': ls(due=datetime(2020, 6, 1)),
+    'ls_finished': ls(finished=True),
+    'ls_sort_limit': ls(sort_keys=todo.TodoSorter.parse('due,-prio'),
+                        limit=20),
+    'sort_double': bench_sort_double,
+    'sort_composite': bench_sort_composite,
+    'export_jsonl': ls(finished=True, sort=False, fmt='jsonl'),
+    'export_csv': ls(finished=True, sort=False, fmt='csv'),
+    'view': view(False),
+    'view_catch_up': view(True),
+    'print_todos': bench_print_todos,
+    'write_todo_file': bench_write_todo_file,
+    'set': bench_set,
+    'batch': bench_batch,
+    'archive': bench_archive,
+    'cli_startup': bench_cli_startup,
+    'import_time': bench_import_time,
+    'first_row': first_row('-n', '20'),
+    'first_row_no_sort': first_row('-n', '20', '--no-sort'),
+    'serve': bench_serve,
+    'concurrent_writes': bench_concurrent_writes,
+    'memory_load_cold': bench_memory_load_cold,
+    'memory_load_warm': bench_memory_load_warm,
+    'memory_ls': bench_memory_ls,
+    'memory_cli_ls': bench_memory_cli_ls,
+    'footprint_records': bench_footprint_records,
+    'footprint_todos': bench_footprint_todos,
+    'footprint_dict_todos': bench_footprint_dict_todos,
+}
+
+
+def available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def benchmarks(max_workers):
+    """All benchmarks by name, with the parallel loader at 1..max_workers
+    workers."""
+    result = dict(BENCHMARKS)
+    for workers in range(1, max_workers + 1):
+        result['load_workers_{}'.format(workers)] = (
+            lambda ws, repeat, workers=workers: bench_load_workers(
+                ws, repeat, workers))
+    return result
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=ROOT,
+                              capture_output=True,
+                              text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, base):
+    """Print the best results next to those of base."""
+    before = {(r['name'], r['size']): r['best'] for r in base['results']}
+    print('{:<20} {:>9} {:>12} {:>12} {:>7}'.format('benchmark', 'size',
+                                                    'before', 'after',
+                                                    'ratio'))
+    for result in results:
+        old = before.get((result['name'], result['size']))
+        unit = result.get('unit', 's')
+        print('{:<20} {:>9} {:>12} {:>12} {:>7}'.format(
+            result['name'], result['size'],
+            '-' if old is None else format_value(old, unit),
+            format_value(result['best'], unit),
+            '-' if not old else '{:.2f}x'.format(result['best'] / old)))
+
+
+def format_value(value, unit):
+    if unit == 's':
+        return '{:.4f}'.format(value)
+    return '{:.0f} {}'.format(value, unit)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark todo.py')
+    parser.add_argument('-o',
+                        metavar='file',
+                        dest='output',
+                        help='Write the JSON results to file (default: '
+                        'stdout)')
+    parser.add_argument('--sizes',
+                        default='1000,10000,100000',
+                        type=lambda s: [int(size) for size in s.split(',')],
+                        help='Comma-separated todo.txt line counts '
+                        '(default: %(default)s)')
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=3,
+                        help='Runs per benchmark (default: %(default)s)')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='Seed of the generated files')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=available_cpus(),
+                        help='Scale the parallel loader from 1 to this many '
+                        'workers (default: available CPUs)')
+    parser.add_argument('--only',
+                        type=lambda s: s.split(','),
+                        help='Comma-separated benchmarks to run')
+    parser.add_argument('--compare',
+                        metavar='file',
+                        help='Print a comparison with the results in file')
+    args = parser.parse_args()
+
+    suite = benchmarks(args.workers)
+    names = args.only or list(suite)
+    unknown = [name for name in names if name not in suite]
+    if unknown:
+        parser.error('unknown benchmarks: {} (known: {})'.format(
+            ', '.join(unknown), ', '.join(suite)))
+
+    results = []
+    over = []
+    for size in args.sizes:
+        ws = Workspace(size, args.seed)
+        try:
+            for name in names:
+                times = suite[name](ws, args.repeat)
+                if times is None:
+                    continue
+                unit = getattr(suite[name], 'unit', 's')
+                results.append({
+                    'name': name,
+                    'size': size,
+                    'unit': unit,
+                    'best': min(times),
+                    'median': statistics.median(times),
+                    'runs': times,
+                })
+                print('{:<20} {:>9} {:>12}'.format(
+                    name, size, format_value(min(times), unit)),
+                      file=sys.stderr)
+                limit = getattr(suite[name], 'budget', None)
+                if limit is not None:
+                    results[-1]['budget'] = limit
+                    if min(times) > limit:
+                        over.append(results[-1])
+        finally:
+            ws.close()
+
+    report = {
+        'commit': commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': available_cpus(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'repeat': args.repeat,
+        'seed': args.seed,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as base:
+            compare(results, json.load(base))
+
+    for result in over:
+        print('{} at {} todos: {} over its budget of {}'.format(
+            result['name'], result['size'],
+            format_value(result['best'], result['unit']),
+            format_value(result['budget'], result['unit'])),
+              file=sys.stderr)
+    if over:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
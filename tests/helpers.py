@@ -0,0 +1,50 @@
+"""Helpers shared by the tests that run todo's commands in this process
+against a todo.txt of their own: a throwaway todo-dir with its dotfile,
+todo.txt written from a function of the line number, and rm and add the
+way the commands run them."""
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import todo  # noqa: E402
+
+
+class WorkspaceTest(unittest.TestCase):
+    """A test case with a todo-dir of its own, removed after the test, and
+    self.config pointing at its todo.txt."""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.config = todo.Dotfile(os.path.join(self.dir, '.todo-cli'))
+        self.config.todo_path = os.path.join(self.dir, 'todo.txt')
+
+    def write_todos(self, line, count):
+        """Write todo.txt with the todos line(0) .. line(count - 1)."""
+        # Lines as todo writes them, so that an edit can keep the length
+        parser = todo.TodoParser()
+        with open(self.config.todo_path, 'w') as todo_file:
+            todo_file.write(''.join(
+                str(parser.parse_line(no, line(no))) for no in range(count)))
+
+    def quiet(self):
+        """Drop what the commands print for the rest of the test."""
+        quiet = contextlib.redirect_stdout(io.StringIO())
+        quiet.__enter__()
+        self.addCleanup(quiet.__exit__, None, None, None)
+
+    def rm(self, line):
+        # remove_todo asks for confirmation, this is what it does after yes
+        with todo.TodoLock(self.config.todo_path):
+            item = todo.load_todo(self.config, line)
+            todo.update_todo(self.config, item.idx, None)
+
+    def add(self, description, projects=(), categories=()):
+        todo.add_todo(self.config, None, None, description, list(projects),
+                      list(categories), None)
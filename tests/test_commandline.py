@@ -0,0 +1,98 @@
+"""Tests of read_args, which reads the command lines of the read-only
+commands without argparse, from the same read_options as their argparse
+parsers: whatever it reads has to come out as argparse reads it, and
+anything it does not read (-h, errors, forms it does not know) has to be
+left to argparse."""
+import contextlib
+import io
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import todo  # noqa: E402
+
+READ = [
+    ['ls'],
+    ['ls', '-n', '1'],
+    ['ls', '-n5', '-f'],
+    ['--timings', 'ls', 'prio<=B and +p1', '-s', '~due,prio'],
+    ['--profile', 'ls', '--sort=-due', '--no-sort', '-a', '--format', 'csv'],
+    ['ls', '-+', 'p1', '-@c1', '-d', '2024-01-31', '--view', 'v'],
+    ['ls', '--limit=3', '--finished', '--archive', '--format=jsonl'],
+    ['ls', '--view', '-'],
+    ['search', 'foo', 'bar*', '-i'],
+    ['search', '-f', '-n', '2', 'foo'],
+    ['search', '--ignore-case', '--format', 'tsv', 'foo'],
+    ['show', '3'],
+    ['show', 'abcdefghijkl', '--format=raw'],
+    ['ids'],
+    ['ids', '--assign'],
+    ['completions'],
+    ['completions', 'fish'],
+    ['completions', '--query', 'word', '+p'],
+    ['completions', '--query', 'id', ''],
+]
+
+LEFT = [
+    [],
+    ['ls', '-h'],
+    ['search', '--help'],
+    ['--timings'],
+    ['add', 'foo'],
+    ['set', '1', 'done'],
+    ['ls', '-n=5'],
+    ['ls', '-fa'],
+    ['ls', '--lim', '3'],
+    ['ls', '-n', '-5'],
+    ['ls', '-n', 'x'],
+    ['ls', '-s', 'bogus'],
+    ['ls', '-d', 'tomorrow'],
+    ['ls', '--format', 'xml'],
+    ['ls', '-f=1'],
+    ['ls', 'a', 'b'],
+    ['ls', '--', '-x'],
+    ['ls', '--timings'],
+    ['search'],
+    ['search', 'foo', '-i', 'bar'],
+    ['show'],
+    ['show', '1', '2'],
+    ['ids', 'x'],
+    ['completions', 'tcsh'],
+    ['completions', '--query', 'word'],
+    ['completions', '--query=word', '+p'],
+]
+
+
+class ReadArgsTest(unittest.TestCase):
+    def parse(self, argv):
+        """What argparse reads, None when it exits."""
+        try:
+            with contextlib.redirect_stdout(
+                    io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                return vars(todo.create_parser().parse_args(argv))
+        except SystemExit:
+            return None
+
+    def test_read(self):
+        for argv in READ:
+            with self.subTest(argv=argv):
+                args = todo.read_args(argv)
+                self.assertIsNotNone(args)
+                self.assertEqual(vars(args), self.parse(argv))
+
+    def test_today(self):
+        args = todo.read_args(['ls', '-d', 'today'])
+        self.assertEqual(args.due.date(), self.parse(['ls', '-d',
+                                                      'today'])['due'].date())
+
+    def test_left_to_argparse(self):
+        for argv in LEFT:
+            with self.subTest(argv=argv):
+                self.assertIsNone(todo.read_args(argv))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,393 @@
+"""Stress test of concurrent writers: several processes running todo add, set,
+edit and rm against the same todo.txt at once, while another one keeps
+listing it. Every change has to land, and todo.txt, its cache and the id
+index in it have to end up exactly as if the commands had run one after the
+other. A reader rebuilding the cache while a line is edited in place is
+also run step by step, as random timing hardly ever hits it, and so is an
+rm left waiting for its confirmation while others write. A cache written
+by a command has to pass for todo.txt, but not once another tool changed
+todo.txt without moving its mtime."""
+import contextlib
+import errno
+import io
+import marshal
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'todo.py')
+sys.path.insert(0, ROOT)
+
+import todo  # noqa: E402
+
+WORKERS = 4
+TODOS = 60
+ADDS = 5
+
+
+class ConcurrencyTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.todo_path = os.path.join(self.dir, 'todo.txt')
+        with open(os.path.join(self.dir, '.todo-cli'), 'w') as dotfile:
+            dotfile.write('todo-dir={}'.format(self.dir))
+        self.lines = [
+            'task {:03d} +p{} id:tk{:03d}\n'.format(no, no % 3, no)
+            for no in range(TODOS)
+        ]
+        with open(self.todo_path, 'w') as todo_file:
+            todo_file.write(''.join(self.lines))
+        self.config = todo.Dotfile(os.path.join(self.dir, '.todo-cli'))
+        self.errors = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_todo(self, argv, stdin=None):
+        result = subprocess.run([sys.executable, SCRIPT] + argv,
+                                env=dict(os.environ, HOME=self.dir),
+                                input=stdin,
+                                capture_output=True,
+                                text=True)
+        if (result.returncode or result.stderr
+                or 'No match' in result.stdout):
+            self.errors.append((argv, result.stdout, result.stderr))
+
+    def plan(self, worker):
+        """The commands of worker, and what they do to the todos it owns:
+        a third is set done, a third edited (some to a description of the
+        same length, patched in place) and a third removed."""
+        commands = []
+        changes = {}
+        owned = list(range(worker, TODOS, WORKERS))
+        for pos, no in enumerate(owned):
+            ref = 'id:tk{:03d}'.format(no)
+            kind = pos % 3
+            if kind == 0:
+                commands.append((['set', ref, 'done'], None))
+                changes[no] = ('done', None)
+            elif kind == 1:
+                description = ('edit {:03d}'.format(no) if pos % 2 else
+                               'edited by worker {}'.format(worker))
+                commands.append((['edit', ref, description], None))
+                changes[no] = ('edit', description)
+            else:
+                commands.append((['rm', ref], 'y\n'))
+                changes[no] = ('rm', None)
+        for no in range(ADDS):
+            commands.append(
+                (['add', 'added {} {}'.format(worker, no), '-+',
+                  'w{}'.format(worker)], None))
+        random.Random(worker).shuffle(commands)
+        return (commands, changes)
+
+    def expected_lines(self, changes):
+        """todo.txt after changes, without the added todos."""
+        parser = todo.TodoParser()
+        lines = []
+        for no, line in enumerate(self.lines):
+            action, description = changes[no]
+            if action == 'rm':
+                continue
+            item = parser.parse_line(no, line)
+            if action == 'done':
+                todo.set_status(item, 'done')
+            else:
+                item.set_description(description)
+            lines.append(str(item))
+        return lines
+
+    def parse(self):
+        """The records of todo.txt, parsed without the cache."""
+        parser = todo.TodoParser()
+        with open(self.todo_path, 'rb') as todo_file:
+            return [
+                todo.TodoCache.parse_record(parser, idx, line)[1]
+                for idx, (offset, line) in enumerate(
+                    todo.TodoCache.read_lines(todo_file))
+            ]
+
+    def test_concurrent_writers(self):
+        plans = [self.plan(worker) for worker in range(WORKERS)]
+        changes = {}
+        for commands, worker_changes in plans:
+            changes.update(worker_changes)
+
+        start = threading.Barrier(WORKERS + 1)
+        done = threading.Event()
+
+        def work(commands):
+            start.wait()
+            for argv, stdin in commands:
+                self.run_todo(argv, stdin)
+
+        def read():
+            # Reads the cache while the writers replace it
+            start.wait()
+            while not done.is_set():
+                self.run_todo(['ls', '-f', '-n', '5', '+p1'])
+
+        threads = [
+            threading.Thread(target=work, args=(commands, ))
+            for commands, _ in plans
+        ]
+        reader = threading.Thread(target=read)
+        for thread in threads + [reader]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        done.set()
+        reader.join()
+        self.assertEqual(self.errors, [])
+
+        with open(self.todo_path) as todo_file:
+            lines = todo_file.readlines()
+        kept = [line for line in lines if not line.startswith('added ')]
+        self.assertEqual(kept, self.expected_lines(changes))
+        added = sorted(
+            line.split(' id:')[0] for line in lines
+            if line.startswith('added '))
+        self.assertEqual(
+            added,
+            sorted('added {} {} +w{}'.format(worker, no, worker)
+                   for worker in range(WORKERS) for no in range(ADDS)))
+
+        records = self.parse()
+        # A cache left behind that still passes for todo.txt has to be right
+        entry = todo.TodoCache(self.todo_path).load_valid(self.todo_path)
+        if entry is not None:
+            self.assertEqual(list(entry.iter_records()), records)
+        with contextlib.redirect_stdout(io.StringIO()):
+            entry = todo.load_cache_entry(self.config)
+        self.assertEqual(list(entry.iter_records()), records)
+        self.assertEqual(entry.count, len(records))
+        offsets = entry.load_offsets()
+        with open(self.todo_path, 'rb') as todo_file:
+            self.assertEqual(list(offsets), [
+                offset
+                for offset, line in todo.TodoCache.read_lines(todo_file)
+            ])
+
+        ids = [dict(record[8]).get('id') for record in records]
+        self.assertEqual(len(set(ids)), len(ids))
+        for idx, value in enumerate(ids):
+            self.assertEqual(entry.find_id(value), [idx])
+        for no, (action, description) in changes.items():
+            if action == 'rm':
+                self.assertEqual(entry.find_id('tk{:03d}'.format(no)), [])
+
+        # Nothing half written is left behind
+        self.assertEqual(
+            sorted(name for name in os.listdir(self.dir)
+                   if '~' in name or name.endswith('.journal')), [])
+
+    def test_edit_while_reading(self):
+        # Lines as todo writes them, so that an edit can keep the length
+        parser = todo.TodoParser()
+        self.lines = [
+            str(parser.parse_line(no, line))
+            for no, line in enumerate(self.lines)
+        ]
+        with open(self.todo_path, 'w') as todo_file:
+            todo_file.write(''.join(self.lines))
+        self.config.workers = 1
+
+        # No cache yet: the reader parses todo.txt and writes one
+        reader = todo.iter_records(self.config)
+        with contextlib.redirect_stdout(io.StringIO()):
+            next(reader)
+            # Patched in place while the reader is half way
+            size = os.path.getsize(self.todo_path)
+            self.run_todo(['edit', 'id:tk001', 'TASK 001'])
+            self.assertEqual(os.path.getsize(self.todo_path), size)
+            for _ in reader:
+                pass
+        self.assertEqual(self.errors, [])
+
+        entry = todo.TodoCache(self.todo_path).load_valid(self.todo_path)
+        if entry is not None:
+            self.assertEqual(list(entry.iter_records()), self.parse())
+        self.run_todo(['set', 'id:tk001', 'done'])
+        self.assertEqual(self.errors, [])
+        with open(self.todo_path) as todo_file:
+            self.assertEqual(todo_file.readlines()[1],
+                             'x TASK 001 +p1 id:tk001 \n')
+
+    def test_cache_after_write(self):
+        # The cache written by each command has to pass for todo.txt
+        for argv, stdin in ((['set', 'id:tk001', 'done'], None),
+                            (['edit', 'id:tk002', 'TASK 002'], None),
+                            (['edit', 'id:tk003', 'a longer task 003'], None),
+                            (['rm', 'id:tk004'], 'y\n'),
+                            (['batch'], 'set 5 done\nrm 7\n'
+                             'edit 8 "batch 008"\nrm 9\nrm 10\n'
+                             'add "batch added"\n'),
+                            (['archive'], None),
+                            (['add', 'added'], None)):
+            if argv[0] == 'add':
+                # add only catches up a cache that is fresh
+                past = os.stat(self.todo_path).st_mtime - 10
+                os.utime(self.todo_path, (past, past))
+                os.remove(todo.TodoCache(self.todo_path).path)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    todo.load_cache_entry(self.config)
+            self.run_todo(argv, stdin)
+            self.assertEqual(self.errors, [])
+            entry = todo.TodoCache(self.todo_path).load_valid(self.todo_path)
+            with self.subTest(argv=argv):
+                self.assertIsNotNone(entry)
+                self.assertEqual(list(entry.iter_records()), self.parse())
+                with open(self.todo_path, 'rb') as todo_file:
+                    self.assertEqual(list(entry.load_offsets()), [
+                        offset for offset, line in todo.TodoCache.read_lines(
+                            todo_file)
+                    ])
+
+    def test_splice_across_chunks(self):
+        # Lines changed, removed and added in several chunks at once, the
+        # cache patched has to be the cache parsed from scratch
+        chunk_size = todo.TodoCache.chunk_size
+        todo.TodoCache.chunk_size = 7
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                entry = todo.load_cache_entry(self.config)
+                changed = {}
+                for idx, record in entry.iter_records_at(range(0, TODOS, 3)):
+                    changed[idx] = todo.TodoCache.from_record(idx, record)
+                    changed[idx].set_description('changed {}'.format(idx) *
+                                                 (idx % 4))
+                for idx in range(1, TODOS, 5):
+                    changed[idx] = None
+                added = [todo.Todo('added {}'.format(no)) for no in range(9)]
+                with todo.TodoLock(self.todo_path):
+                    todo.splice_todo_file(self.config, entry, changed, added)
+                    todo.archive_todo(self.config)
+                patched = todo.TodoCache(self.todo_path).load_valid(
+                    self.todo_path)
+                self.assertIsNotNone(patched)
+                os.remove(patched.path)
+                fresh = todo.load_cache_entry(self.config)
+        finally:
+            todo.TodoCache.chunk_size = chunk_size
+        self.assertEqual(list(patched.iter_records()), self.parse())
+        self.assertEqual(list(patched.load_offsets()),
+                         list(fresh.load_offsets()))
+        (index, expected) = (patched.load_index(), fresh.load_index())
+        for name in todo.TodoIndex.sections:
+            self.assertEqual(marshal.loads(index.dump_section(name)),
+                             marshal.loads(expected.dump_section(name)), name)
+        index.sort_due()
+        expected.sort_due()
+        for name in ('due_dates', 'due_idxs', 'done', 'warnings', 'count'):
+            self.assertEqual(getattr(index, name), getattr(expected, name),
+                             name)
+
+    def test_splice_copy(self):
+        # The lines kept are copied in the kernel, or read and written when
+        # it cannot, and a line break goes before lines added after a last
+        # line without one
+        for (fails, ending) in ((False, '\n'), (True, '\n'), (False, ''),
+                                (True, '')):
+            with self.subTest(fails=fails, ending=ending):
+                with open(self.todo_path, 'w') as todo_file:
+                    todo_file.write(''.join(self.lines).rstrip('\n') +
+                                    ending)
+                failure = OSError(errno.EXDEV, 'cross-device link')
+                copy = mock.patch.object(
+                    os, 'copy_file_range', side_effect=failure,
+                    create=True) if fails else contextlib.nullcontext()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    entry = todo.load_cache_entry(self.config)
+                    with todo.TodoLock(self.todo_path), copy:
+                        todo.splice_todo_file(self.config, entry, {
+                            3: todo.Todo('changed 003'),
+                            7: None
+                        }, [todo.Todo('added')])
+                expected = (self.lines[:3] + [str(todo.Todo('changed 003'))] +
+                            self.lines[4:7] + self.lines[8:] +
+                            [str(todo.Todo('added'))])
+                with open(self.todo_path) as todo_file:
+                    self.assertEqual(todo_file.read(), ''.join(expected))
+                with contextlib.redirect_stdout(io.StringIO()):
+                    entry = todo.load_cache_entry(self.config)
+                self.assertEqual(list(entry.iter_records()), self.parse())
+
+    def test_edit_behind_back_after_write(self):
+        # Another tool changes a line right after todo did, without moving
+        # the mtime or the size: the cache must not pass for todo.txt
+        self.run_todo(['set', '0', 'toggle'])
+        stat = os.stat(self.todo_path)
+        with open(self.todo_path, 'r+b') as todo_file:
+            todo_file.readline()
+            todo_file.write(b'TASK')
+        os.utime(self.todo_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        with contextlib.redirect_stdout(io.StringIO()):
+            entry = todo.load_cache_entry(self.config)
+        self.assertEqual(list(entry.iter_records()), self.parse())
+        self.run_todo(['set', '0', 'toggle'])
+        with open(self.todo_path) as todo_file:
+            self.assertEqual(todo_file.readlines()[1],
+                             'TASK 001 +p1 id:tk001\n')
+
+    def ask_rm(self, ref):
+        """Start `todo rm ref` and wait for it to ask for confirmation."""
+        proc = subprocess.Popen([sys.executable, SCRIPT, 'rm', ref],
+                                env=dict(os.environ, HOME=self.dir),
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                text=True)
+        out = ''
+        while not out.endswith('(y/n): '):
+            char = proc.stdout.read(1)
+            self.assertTrue(char, out)
+            out += char
+        return proc
+
+    def test_rm_while_asking(self):
+        # Without an id the todo is found again on its line no
+        with open(self.todo_path, 'a') as todo_file:
+            todo_file.write('no id\n')
+        asking = [self.ask_rm('id:tk005'), self.ask_rm(str(TODOS))]
+        # Other writers are not held up by the prompts
+        for argv, stdin in ((['rm', 'id:tk001'], 'y\n'),
+                            (['add', 'added'], None)):
+            subprocess.run([sys.executable, SCRIPT] + argv,
+                           env=dict(os.environ, HOME=self.dir),
+                           input=stdin,
+                           capture_output=True,
+                           text=True,
+                           timeout=30,
+                           check=True)
+        outs = [proc.communicate('y\n', timeout=30)[0] for proc in asking]
+        # tk005 moved up a line and is removed all the same, the line
+        # without an id moved and is left alone
+        self.assertEqual(asking[0].returncode, 0)
+        self.assertEqual(asking[1].returncode, 1)
+        self.assertIn('changed meanwhile', outs[1])
+        with open(self.todo_path) as todo_file:
+            lines = todo_file.readlines()
+        self.assertEqual(lines[:TODOS - 2],
+                         [line for no, line in enumerate(self.lines)
+                          if no not in (1, 5)])
+        self.assertEqual(lines[TODOS - 2], 'no id\n')
+        self.assertTrue(lines[TODOS - 1].startswith('added '))
+
+        proc = self.ask_rm('id:tk007')
+        self.run_todo(['edit', 'id:tk007', 'edited'])
+        self.assertEqual(self.errors, [])
+        out = proc.communicate('y\n', timeout=30)[0]
+        self.assertEqual(proc.returncode, 1)
+        self.assertIn('changed meanwhile', out)
+        with open(self.todo_path) as todo_file:
+            self.assertIn('edited +p1 id:tk007 \n', todo_file.readlines())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+"""Golden-file test of the todo.txt parser.
+
+data/todo.expected.json holds what the parser todo.py started out with (the
+regex cascade in load_todos) made of data/todo.txt: the fields and str() of
+every todo and the warnings printed for malformed lines. Parsing the file,
+reading it back from the cache and parsing it in worker processes all have
+to give exactly that."""
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA = os.path.join(ROOT, 'tests', 'data')
+sys.path.insert(0, ROOT)
+
+import todo  # noqa: E402
+
+
+def fields(item):
+    def date(value):
+        return value.date().isoformat() if value else None
+
+    return {
+        'idx': item.idx,
+        'done': item.done,
+        'prio': item.prio,
+        'done_date': date(item.done_date),
+        'created_date': date(item.created_date),
+        'due': date(item.due),
+        'description': item.description,
+        'categories': list(item.categories),
+        'projects': list(item.projects),
+        'labels': [list(label) for label in item.labels.items()],
+        'matched': item.matched,
+        'line': item.line,
+        'str': str(item),
+    }
+
+
+class ParserTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        shutil.copy(os.path.join(DATA, 'todo.txt'), self.dir)
+        self.config = todo.Dotfile(os.path.join(self.dir, '.todo-cli'))
+        self.config.todo_path = os.path.join(self.dir, 'todo.txt')
+        with open(os.path.join(DATA, 'todo.expected.json'),
+                  encoding='utf-8') as expected_file:
+            self.expected = json.load(expected_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def load(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            todos = todo.load_todos(self.config)
+        return ([fields(item) for item in todos], out.getvalue().splitlines())
+
+    def check(self, todos, output):
+        self.assertEqual(len(todos), len(self.expected['todos']))
+        for got, expected in zip(todos, self.expected['todos']):
+            self.assertEqual(got, expected)
+        self.assertEqual(output, self.expected['output'])
+
+    def test_parse(self):
+        self.check(*self.load())
+
+    def test_cached(self):
+        self.load()
+        self.assertIsNotNone(
+            todo.TodoCache(self.config.todo_path).load_valid(
+                self.config.todo_path))
+        self.check(*self.load())
+
+    def test_workers(self):
+        # Every range of a few bytes gets a process of its own
+        size = os.path.getsize(self.config.todo_path)
+        parallel_size = todo.TodoCache.parallel_size
+        todo.TodoCache.parallel_size = size // 4
+        try:
+            self.config.workers = 4
+            self.check(*self.load())
+        finally:
+            todo.TodoCache.parallel_size = parallel_size
+
+    def test_parse_line(self):
+        parser = todo.TodoParser()
+        with open(self.config.todo_path, encoding='utf-8') as todo_file:
+            lines = todo_file.readlines()
+        for idx, (line, expected) in enumerate(
+                zip(lines, self.expected['todos'])):
+            if not expected['matched']:
+                with self.assertRaises(todo.TodoParseError):
+                    parser.parse_line(idx, line)
+                continue
+            self.assertEqual(fields(parser.parse_line(idx, line)), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
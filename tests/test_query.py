@@ -0,0 +1,266 @@
+"""Tests of the ls query language (TodoQuery) on data/todo.txt plus a few
+todos with more labels and dates: every operator, globs, not and nested
+parentheses, typed custom labels, fields a todo does not have and malformed
+queries. Each query is checked against a plain Python test of the records,
+and the lines picked through the cache index by the query's lookup plan
+against a full scan. Typed labels are also checked in the JSON export."""
+import contextlib
+import io
+import os
+import shutil
+import sys
+import unittest
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA = os.path.join(ROOT, 'tests', 'data')
+sys.path.insert(0, ROOT)
+
+import todo  # noqa: E402
+from helpers import WorkspaceTest  # noqa: E402
+
+EXTRA = [
+    '(C) 2022-02-01 Pay rent +home @bank due:2022-02-01 rt:10 '
+    'jira:TODO-7\n',
+    'x 2022-01-05 2022-01-01 Fix bike +home @garage rt:x jira:OPS-1\n',
+    '(B) Book flights +travel @laptop due:2021-03-01 rt:3 owner:kim\n',
+    'Water plants +home @garden rt:2.5\n',
+]
+
+
+def label(record, key):
+    return dict(record[8]).get(key)
+
+
+def date(text):
+    return datetime.strptime(text, '%Y-%m-%d').toordinal()
+
+
+class QueryTest(WorkspaceTest):
+    def setUp(self):
+        super().setUp()
+        self.config.custom_labels['rt'] = todo.TodoPrinter.Property(
+            False, 3, 'Rt', 'int')
+        shutil.copy(os.path.join(DATA, 'todo.txt'), self.config.todo_path)
+        with open(self.config.todo_path, 'a') as todo_file:
+            todo_file.write('\n' + ''.join(EXTRA))
+        parser = todo.TodoParser()
+        with open(self.config.todo_path, 'rb') as todo_file:
+            self.records = [
+                (idx, todo.TodoCache.parse_record(parser, idx, line)[1])
+                for idx, (offset, line) in enumerate(
+                    todo.TodoCache.read_lines(todo_file))
+            ]
+
+    def query(self, text, finished=True, **spec):
+        spec.update(query=text, finished=finished)
+        with contextlib.redirect_stdout(io.StringIO()):
+            return [
+                idx for idx, record in todo.query_records(self.config, spec)
+            ]
+
+    def scan(self, test, finished=True):
+        """Line nos of the todos ls would list (matched, not done unless
+        finished) passing test."""
+        return [
+            idx for idx, record in self.records
+            if record[9] and (finished or not record[0]) and test(record)
+        ]
+
+    def check(self, text, test, finished=True):
+        expected = self.scan(test, finished)
+        self.assertTrue(expected, text)
+        self.assertEqual(self.query(text, finished), expected, text)
+
+    def test_terms(self):
+        self.check('+home', lambda r: 'home' in r[7])
+        self.check('@phone', lambda r: 'phone' in r[6])
+        self.check('done', lambda r: r[0])
+        self.check('mom', lambda r: 'mom' in r[5].lower())
+        self.check('"call mom"', lambda r: 'call mom' in r[5].lower())
+        self.check("'pull request'", lambda r: 'pull request' in r[5].lower())
+
+    def test_operators(self):
+        self.check('prio=A', lambda r: r[1] == 'A')
+        self.check('prio=a', lambda r: r[1] == 'A')
+        self.check('prio!=A', lambda r: r[1] and r[1] != 'A')
+        self.check('prio<B', lambda r: r[1] and r[1] < 'B')
+        self.check('prio<=B', lambda r: r[1] and r[1] <= 'B')
+        self.check('prio>B', lambda r: r[1] and r[1] > 'B')
+        self.check('prio>=C', lambda r: r[1] and r[1] >= 'C')
+        self.check('due<2022-01-01', lambda r: r[4] and r[4] < date(
+            '2022-01-01'))
+        self.check('due<=2022-01-31', lambda r: r[4] and r[4] <= date(
+            '2022-01-31'))
+        self.check('due>2022-01-31', lambda r: r[4] and r[4] > date(
+            '2022-01-31'))
+        self.check('due>=2022-01-31', lambda r: r[4] and r[4] >= date(
+            '2022-01-31'))
+        self.check('due=2021-03-07', lambda r: r[4] == date('2021-03-07'))
+        self.check('due!=2021-03-07', lambda r: r[4] and r[4] != date(
+            '2021-03-07'))
+        self.check('created>=2021-03-04', lambda r: r[3] and r[3] >= date(
+            '2021-03-04'))
+        self.check('completed<2022-01-01', lambda r: r[2] and r[2] < date(
+            '2022-01-01'))
+        self.check('idx<3', lambda r: r in [rec for idx, rec in
+                                            self.records[:3]])
+        self.check('owner=sam', lambda r: label(r, 'owner') == 'sam')
+        self.check('owner!=sam', lambda r: label(r, 'owner') not in (None,
+                                                                     'sam'))
+        self.check('description="Call mom"', lambda r: r[5] == 'Call mom')
+        today = datetime.today().toordinal()
+        self.check('due>today-100000', lambda r: r[4] and r[4] > today -
+                   100000)
+
+    def test_globs(self):
+        self.check('jira~TODO-*', lambda r: (label(r, 'jira') or '')
+                   .startswith('TODO-'))
+        self.check('jira~*-1', lambda r: (label(r, 'jira') or '')
+                   .endswith('-1'))
+        self.check('jira~TODO-?', lambda r: (label(r, 'jira') or '')
+                   .startswith('TODO-') and len(label(r, 'jira')) == 6)
+        self.check('prio~[AB]', lambda r: r[1] in ('A', 'B'))
+        self.check('description~Call*', lambda r: r[5].startswith('Call'))
+        self.check('+tr*', lambda r: any(p.startswith('tr') for p in r[7]))
+        self.check('@*o*', lambda r: any('o' in c for c in r[6]))
+
+    def test_boolean(self):
+        self.check('not done', lambda r: not r[0])
+        self.check('not not done', lambda r: r[0])
+        self.check('+home and @bank', lambda r: 'home' in r[7] and 'bank' in
+                   r[6])
+        self.check('+home @bank', lambda r: 'home' in r[7] and 'bank' in r[6])
+        self.check('+travel or @phone', lambda r: 'travel' in r[7] or 'phone'
+                   in r[6])
+        self.check('+home and not (@bank or @garage)',
+                   lambda r: 'home' in r[7] and not ({'bank', 'garage'} &
+                                                      set(r[6])))
+        self.check(
+            '((prio<=B and (+travel or (@phone))) or (done and not +home))',
+            lambda r: (r[1] and r[1] <= 'B' and
+                       ('travel' in r[7] or 'phone' in r[6])) or
+            (r[0] and 'home' not in r[7]))
+        self.check('NOT done AND +home OR prio=A',
+                   lambda r: (not r[0] and 'home' in r[7]) or r[1] == 'A')
+
+    def test_typed_labels(self):
+        # rt is declared int: 10 > 3 as numbers, rt:x and rt:2.5 never match
+        self.check('rt>3', lambda r: label(r, 'rt') == '10')
+        self.check('rt<10', lambda r: label(r, 'rt') in ('2', '3'))
+        self.check('rt=2', lambda r: label(r, 'rt') == '2')
+        self.check('rt!=2', lambda r: label(r, 'rt') in ('3', '10'))
+        # Undeclared labels compare as text
+        self.check('owner<sam', lambda r: label(r, 'owner') == 'kim')
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            with self.assertRaises(SystemExit):
+                todo.compile_query(self.config, 'rt>three')
+        self.assertIn('not a valid int', out.getvalue())
+
+    def test_missing_fields(self):
+        # Todos without the field never match, whatever the operator
+        for text in ('due!=2000-01-01', 'due>2000-01-01', 'prio!=Z',
+                     'created<2100-01-01', 'completed>2000-01-01',
+                     'owner!=nobody', 'jira~*', 'rt>=0'):
+            expected = self.query(text)
+            field = text.split('~')[0].split('!')[0].split('<')[0].split(
+                '>')[0].split('=')[0]
+            for idx in expected:
+                record = self.records[idx][1]
+                if field in todo.TodoQuery.fields:
+                    self.assertTrue(record[todo.TodoQuery.fields[field]],
+                                    (text, idx))
+                else:
+                    self.assertIsNotNone(label(record, field), (text, idx))
+        self.assertEqual(self.query('nosuchlabel=x'), [])
+        self.assertEqual(self.query('not nosuchlabel=x'),
+                         self.scan(lambda r: True))
+
+    def test_invalid(self):
+        for text in ('(+home', '+home)', 'prio<', 'due~2021*', 'due<soon',
+                     'idx<one', 'not', '+home or'):
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                with self.assertRaises(SystemExit):
+                    todo.compile_query(self.config, text)
+            self.assertIn('Invalid query', out.getvalue(), text)
+
+    def test_invalid_keywords_and_today(self):
+        # and/or need a term on both sides and today an explicit sign, none
+        # of them is read as a word of the description or a date
+        for text in ('and +home', '+home and', '+home and or @bank', 'or',
+                     '(+home or)', 'due<today7', 'due<today+', 'due>TODAY1'):
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                with self.assertRaises(SystemExit):
+                    todo.compile_query(self.config, text)
+            self.assertIn('Invalid query', out.getvalue(), text)
+        self.assertEqual(self.query('"and" or "or"'),
+                         self.scan(lambda r: 'and' in r[5].lower() or 'or' in
+                                   r[5].lower()))
+
+    def test_export_non_finite(self):
+        # Typed labels that are not finite numbers are exported as text,
+        # JSON has no NaN or Infinity
+        import json
+        self.config.custom_labels['est'] = todo.TodoPrinter.Property(
+            False, 3, 'Est', 'float')
+        parser = todo.TodoParser()
+        records = [
+            (idx, todo.TodoCache.parse_record(parser, idx, line)[1])
+            for idx, line in enumerate(('a est:15\n', 'b est:nan\n',
+                                        'c est:-inf\n', 'd est:Infinity\n'))
+        ]
+        out = io.StringIO()
+        todo.TodoExport('jsonl', self.config.custom_labels, out).write(records)
+
+        def constant(name):
+            raise ValueError(name)
+
+        rows = [
+            json.loads(line, parse_constant=constant)
+            for line in out.getvalue().splitlines()
+        ]
+        self.assertEqual([row['labels']['est'] for row in rows],
+                         [15.0, 'nan', '-inf', 'Infinity'])
+
+    def test_index_plan(self):
+        # With a fresh cache, planned queries only read the lines the index
+        # picks, and have to find what a scan of every line finds
+        with contextlib.redirect_stdout(io.StringIO()):
+            entry = todo.load_cache_entry(self.config)
+        index = entry.load_index()
+        for text in ('+home', '@bank', '+home @bank', 'jira=TODO-123',
+                     'owner=sam and prio<=D', 'due<2022-01-01',
+                     'due<=2022-02-01 and +home', 'id=abcdefghijkl',
+                     '+home and (done or rt>3)', '+nosuchproject'):
+            for finished in (True, False):
+                spec = {'query': text, 'finished': finished}
+                (lookup, filters) = todo.spec_filters(self.config, spec)
+                self.assertIsNotNone(lookup(index), text)
+                scan = self.records
+                for include in filters:
+                    scan = filter(include, scan)
+                self.assertEqual(self.query(text, finished),
+                                 [idx for idx, record in scan],
+                                 (text, finished))
+
+    def test_same_as_options(self):
+        # Queries equivalent to -+, -@ and -d list the same table
+        def ls(*args, **kwargs):
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                todo.ls_todo(self.config, *args, **kwargs)
+            return out.getvalue()
+
+        due = datetime(2022, 1, 31)
+        self.assertEqual(ls(None, 'home', None, False),
+                         ls(None, None, None, False, query='+home'))
+        self.assertEqual(ls('bank', None, None, True),
+                         ls(None, None, None, True, query='@bank'))
+        self.assertEqual(ls(None, None, due, False),
+                         ls(None, None, None, False, query='due<=2022-01-31'))
+        self.assertEqual(ls('garage', 'home', None, True),
+                         ls(None, None, None, True, query='@garage +home'))
+
+
+if __name__ == '__main__':
+    unittest.main()
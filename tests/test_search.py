@@ -0,0 +1,177 @@
+"""Tests of todo search and the word index of the cache (TodoIndex.search):
+exact words, prefixes ending with *, -i case folding and several words at
+once have to find the line numbers a plain scan of the descriptions finds,
+also after rm, add and edit renumbered or changed lines and the index was
+patched rather than rebuilt."""
+import contextlib
+import io
+import json
+import os
+import re
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import todo  # noqa: E402
+from helpers import WorkspaceTest  # noqa: E402
+
+TODOS = 200
+WORDS = ('Plan', 'plan', 'planning', 'PLANET', 'budget', 'Budget-review',
+         'report_2024', 'reports', 'Straße', 'STRASSE', 'été', 'Été', 'call',
+         'mom', 'x1', 'review')
+SEARCHES = (
+    (['plan'], False),
+    (['Plan'], False),
+    (['plan'], True),
+    (['plan*'], False),
+    (['PLAN*'], True),
+    (['pla*'], False),
+    (['report*'], False),
+    (['report_2024'], False),
+    (['strasse'], True),
+    (['Straße'], False),
+    (['ÉTÉ'], True),
+    (['été'], False),
+    (['budget', 'review'], False),
+    (['budget-review'], False),
+    (['budget', 'rev*'], True),
+    (['plan', 'call', 'mom'], False),
+    (['call', 'mom*', 'Plan'], True),
+    (['x1', 'report*', 'budget'], True),
+    (['nosuchword'], False),
+    (['nosuch*'], True),
+)
+
+
+def line(no):
+    """A todo whose description has three to five of WORDS."""
+    words = [WORDS[(no * step + step) % len(WORDS)] for step in (1, 3, 7)]
+    words += [WORDS[(no // 2 + step) % len(WORDS)]
+              for step in range(no % 3)]
+    done = 'x ' if no % 6 == 0 else ''
+    return '{}{} {:03d} +p{} @c{}\n'.format(done, ' '.join(words), no,
+                                            no % 4, no % 3)
+
+
+def scan(descriptions, args, fold):
+    """Line nos of the descriptions having every word of args as a whole
+    word, or the start of one when the argument ends with *."""
+    patterns = []
+    for arg in args:
+        words = re.findall(r'\w+', arg.casefold() if fold else arg)
+        for pos, word in enumerate(words):
+            prefix = pos == len(words) - 1 and arg.endswith('*')
+            patterns.append(
+                re.compile(r'(?<!\w)' + re.escape(word) +
+                           ('' if prefix else r'(?!\w)')))
+    return [
+        idx for idx, description in enumerate(descriptions)
+        if description is not None and all(
+            pattern.search(description.casefold() if fold else description)
+            for pattern in patterns)
+    ]
+
+
+class SearchTest(WorkspaceTest):
+    def setUp(self):
+        super().setUp()
+        self.write_todos(line, TODOS)
+        self.quiet()
+        self.lineage = todo.load_cache_entry(self.config).lineage
+
+    def descriptions(self, finished):
+        """The description of every line of todo.txt, parsed without the
+        cache, None for the lines search skips."""
+        parser = todo.TodoParser()
+        with open(self.config.todo_path, 'rb') as todo_file:
+            records = [
+                todo.TodoCache.parse_record(parser, idx, line)[1]
+                for idx, (offset, line) in enumerate(
+                    todo.TodoCache.read_lines(todo_file))
+            ]
+        return [
+            record[5] if record[9] and (finished or not record[0]) else None
+            for record in records
+        ]
+
+    def search(self, args, fold, finished):
+        """Line nos todo search prints, as JSON lines."""
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            todo.search_todo(self.config, args, fold, finished, fmt='jsonl')
+        return sorted(
+            json.loads(row)['idx'] for row in out.getvalue().splitlines())
+
+    def check(self):
+        """Check every search against a scan of todo.txt."""
+        entry = todo.load_cache_entry(self.config)
+        # Patched, not rebuilt from scratch
+        self.assertEqual(entry.lineage, self.lineage)
+        index = entry.load_index()
+        found = 0
+        for finished in (False, True):
+            descriptions = self.descriptions(finished)
+            for args, fold in SEARCHES:
+                expected = scan(descriptions, args, fold)
+                found += len(expected)
+                spec = {
+                    'finished': finished,
+                    'words': todo.search_terms(args, fold),
+                    'fold': fold
+                }
+                # Looked up in the index, not filtered from every line
+                (lookup, filters) = todo.spec_filters(self.config, spec)
+                self.assertIsNotNone(lookup(index), args)
+                self.assertEqual([
+                    idx for idx, record in todo.query_records(
+                        self.config, spec)
+                ], expected, (args, fold, finished))
+                self.assertEqual(self.search(args, fold, finished), expected,
+                                 (args, fold, finished))
+        self.assertGreater(found, 0)
+
+    def test_search(self):
+        self.check()
+        # Multi-word searches narrow down, ORed ones would not
+        descriptions = self.descriptions(True)
+        self.assertLess(len(scan(descriptions, ['plan', 'call'], False)),
+                        len(scan(descriptions, ['plan'], False)))
+        self.assertLess(len(scan(descriptions, ['plan'], False)),
+                        len(scan(descriptions, ['plan*'], True)))
+
+    def test_rm(self):
+        self.rm('0')
+        self.rm('77')
+        self.rm(str(TODOS - 3))
+        self.check()
+
+    def test_edit(self):
+        size = os.path.getsize(self.config.todo_path)
+        # Same length, edited in place: words leave and join the index
+        todo.edit_todo(self.config, '10', 'xxxxxx xxxx call mom Straße 010')
+        todo.edit_todo(self.config, '11',
+                       'Plan PLANET planning été reports x1 strass 011')
+        self.assertEqual(os.path.getsize(self.config.todo_path), size)
+        # Longer, spliced in
+        todo.edit_todo(self.config, '12', 'plan the planet budget-review '
+                       'with mom and report_2024')
+        self.check()
+
+    def test_mixed(self):
+        self.rm('3')
+        todo.add_todo(self.config, None, None, 'call mom about the Plan',
+                      ['p1'], [], None)
+        todo.edit_todo(self.config, '40', 'ÉTÉ reports')
+        self.rm('5')
+        todo.toggle_todo(self.config, '7', 'toggle')
+        todo.toggle_todo(self.config, '8', 'toggle')
+        todo.add_todo(self.config, None, None, 'PLANET budget', [], [], None)
+        self.rm(str(TODOS - 10))
+        todo.edit_todo(self.config, '100', 'x1 plan planning')
+        self.check()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+"""Tests of sharded workspaces (TodoShards): with shard-by project and
+hash:N, ls, sorted and limited ls and search have to print what they print
+for one todo.txt holding the shards one after the other, line numbers
+included, and set and rm by line number have to change the todo with that
+line number in the shard holding it."""
+import contextlib
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'todo.py')
+sys.path.insert(0, ROOT)
+
+import todo  # noqa: E402
+
+TODOS = 120
+
+
+def line(no):
+    parts = []
+    if no % 9 == 0:
+        parts.append('x 2024-02-0{} 2024-01-01'.format(1 + no % 8))
+    if no % 4:
+        parts.append('({})'.format('ABCD'[no % 4]))
+    words = ('plan', 'review', 'budget', 'report', 'call', 'fix')
+    parts.append('{} {} {:03d}'.format(words[no % 6], words[no % 5], no))
+    if no % 5:
+        parts.append('+p{}'.format(no % 5))
+    parts.append('@c{}'.format(no % 3))
+    if no % 3:
+        parts.append('due:2024-0{}-1{}'.format(1 + no % 7, no % 4))
+    parts.append('id:{}'.format('abcdefghijklmnopqrstuvwxyz'[no % 26] * 2 +
+                                '{:03d}'.format(no)))
+    return ' '.join(parts) + '\n'
+
+
+class Workspace:
+    def __init__(self, options=''):
+        self.dir = tempfile.mkdtemp()
+        with open(os.path.join(self.dir, '.todo-cli'), 'w') as dotfile:
+            dotfile.write('todo-dir={}\n{}'.format(self.dir, options))
+        self.config = todo.Dotfile(os.path.join(self.dir, '.todo-cli'))
+
+    def run(self, *argv, stdin=None):
+        result = subprocess.run([sys.executable, SCRIPT] + list(argv),
+                                env=dict(os.environ, HOME=self.dir),
+                                input=stdin,
+                                capture_output=True,
+                                text=True)
+        return (result.returncode, result.stdout, result.stderr)
+
+    def lines(self):
+        """The lines of every shard, one after the other."""
+        lines = []
+        for path in todo.TodoShards.paths(self.config):
+            with open(path) as todo_file:
+                lines.extend(todo_file.readlines())
+        return lines
+
+    def close(self):
+        shutil.rmtree(self.dir)
+
+
+class ShardTest(unittest.TestCase):
+    def setUp(self):
+        parser = todo.TodoParser()
+        self.todos = [
+            str(parser.parse_line(no, line(no))) for no in range(TODOS)
+        ]
+        # Malformed lines stay in todo.txt, with projects or not
+        self.todos[5] = 'x 2024-02-02 done with one date +p1\n'
+        self.todos[50] = '2024-01-01 2023-12-31 two dates +p2\n'
+
+    def workspaces(self, shard_by):
+        """A sharded workspace and one with the same todos in a single
+        todo.txt in the order of the shards."""
+        sharded = Workspace('shard-by={}'.format(shard_by))
+        self.addCleanup(sharded.close)
+        parser = todo.TodoParser()
+        for no, text in enumerate(self.todos):
+            (item, record) = todo.TodoCache.parse_record(parser, no, text)
+            path = todo.TodoShards.path_for(sharded.config, item)
+            with open(path, 'a') as todo_file:
+                todo_file.write(text)
+        self.assertGreater(len(todo.TodoShards.paths(sharded.config)), 2)
+
+        single = Workspace()
+        self.addCleanup(single.close)
+        with open(single.config.todo_path, 'w') as todo_file:
+            todo_file.writelines(sharded.lines())
+        return (sharded, single)
+
+    def same_output(self, sharded, single, *argv):
+        result = sharded.run(*argv)
+        self.assertEqual(result[0], 0, result)
+        self.assertEqual(result, single.run(*argv), argv)
+        return result[1]
+
+    def check(self, shard_by):
+        (sharded, single) = self.workspaces(shard_by)
+        for argv in (['ls'], ['ls', '-f'], ['ls', '-n', '7', '-s=-prio,due'],
+                     ['ls', '-n', '12', '-f', '--sort=due,~created,idx'],
+                     ['ls', '-n', '5', '--no-sort'], ['ls', '-+', 'p1'],
+                     ['ls', '-f', 'due<2024-04-01 and not @c0'],
+                     ['ls', '-f', '--format', 'jsonl'], ['search', 'plan'],
+                     ['search', '-f', 'budget', 'rep*'],
+                     ['search', '-f', '-i', 'FIX'], ['show', '40']):
+            output = self.same_output(sharded, single, *argv)
+            self.assertTrue(output.strip(), argv)
+
+        # By line no across the shards, then by id
+        for argv, stdin in ((['set', '3', 'done'], None),
+                            (['set', '70', 'toggle'], None),
+                            (['rm', '0'], 'y\n'), (['rm', '64'], 'y\n'),
+                            (['rm', str(TODOS - 3)], 'y\n'),
+                            (['edit', '30', 'edited 030'], None),
+                            (['set', 'id:dd003', 'done'], None),
+                            (['set', '5', 'done'], None)):
+            self.assertEqual(
+                sharded.run(*argv, stdin=stdin)[0],
+                single.run(*argv, stdin=stdin)[0], argv)
+            self.assertEqual(sharded.lines(), single.lines(), argv)
+        self.same_output(sharded, single, 'ls', '-f')
+        self.same_output(sharded, single, 'search', '-f', 'edited')
+
+    def test_project(self):
+        self.check('project')
+
+    def test_hash(self):
+        self.check('hash:3')
+
+    def test_parallel(self):
+        # The shards queried in worker processes, merged in this one
+        (sharded, single) = self.workspaces('project')
+        parallel_size = todo.TodoCache.parallel_size
+        todo.TodoCache.parallel_size = 1
+        self.addCleanup(setattr, todo.TodoCache, 'parallel_size',
+                        parallel_size)
+        sharded.config.workers = 3
+        for spec, limit, sort_keys in (({}, None, None),
+                                       ({'finished': True}, 10,
+                                        todo.TodoSorter.parse('~prio,due')),
+                                       ({'query': '+p2 or done',
+                                         'finished': True}, None, None)):
+            with contextlib.redirect_stdout(io.StringIO()):
+                merged = list(
+                    todo.TodoShards.select(sharded.config, spec,
+                                           limit=limit, sort_keys=sort_keys))
+                records = todo.query_records(single.config, spec)
+                expected = todo.TodoSorter(sort_keys).select(records, limit)
+            self.assertEqual(merged, expected, spec)
+
+
+if __name__ == '__main__':
+    unittest.main()
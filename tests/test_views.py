@@ -0,0 +1,155 @@
+"""Tests of named views (TodoView): after rm, add, set and edit the rows of
+a view caught up from the change log of the cache have to be the rows of
+the view computed from scratch, and what `ls` lists with the same filters
+and sort keys. More changes than the log keeps and a cache rebuilt from
+scratch have to recompute the view instead."""
+import contextlib
+import io
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import todo  # noqa: E402
+from helpers import WorkspaceTest  # noqa: E402
+
+TODOS = 300
+VIEWS = {
+    'ctx': '-@ c1 -s due,~prio',
+    'query': '"prio<=C or +p2 or late" -f -s ~due,idx',
+    'plain': '-+ p0',
+}
+
+
+def line(no):
+    """A todo with a few fields in common with many others, for ties."""
+    parts = []
+    if no % 7 == 0:
+        parts.append('x')
+    if no % 3:
+        parts.append('({})'.format('ABCDE'[no % 5]))
+    parts.append('task {:03d} +p{} @c{}'.format(no, no % 4, no % 3))
+    if no % 2:
+        parts.append('due:2024-0{}-1{}'.format(1 + no % 9, no % 5))
+    return ' '.join(parts) + '\n'
+
+
+class ViewTest(WorkspaceTest):
+    def setUp(self):
+        super().setUp()
+        for name, options in VIEWS.items():
+            self.config.views[name] = [options, None]
+        self.write_todos(line, TODOS)
+        # Counts the views caught up rather than computed
+        self.caught_up = 0
+        catch_up = todo.TodoView.catch_up
+
+        def counted(*args):
+            self.caught_up += 1
+            return catch_up(*args)
+
+        todo.TodoView.catch_up = counted
+        self.addCleanup(setattr, todo.TodoView, 'catch_up', catch_up)
+        self.quiet()
+        for name in VIEWS:
+            todo.TodoView.select(self.config, name)
+
+    def ls(self, *args, **kwargs):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            todo.ls_todo(self.config, *args, **kwargs)
+        return out.getvalue()
+
+    def check(self, caught_up):
+        """Check every view against a recomputed one and against ls."""
+        self.caught_up = 0
+        for name in VIEWS:
+            rows = todo.TodoView.select(self.config, name)
+            self.assertEqual(todo.TodoView.select(self.config, name), rows)
+            os.remove(todo.TodoView(self.config.todo_path, name).path)
+            self.assertEqual(todo.TodoView.select(self.config, name), rows,
+                             name)
+
+            (spec, sort_keys, _) = todo.TodoView.parse(self.config, name)
+            self.assertEqual(
+                todo.TodoSorter(sort_keys).select(
+                    todo.query_records(self.config, spec)), rows, name)
+            self.assertEqual(
+                self.ls(None, None, None, False, view=name, limit=40),
+                self.ls(spec['category'], spec['project'], spec['due'],
+                        spec['finished'], query=spec['query'],
+                        sort_keys=sort_keys, limit=40), name)
+        # Only the first select of each view may have caught up
+        self.assertEqual(self.caught_up, len(VIEWS) if caught_up else 0)
+
+    def generation(self):
+        return todo.load_cache_entry(self.config).generation
+
+    def test_rm(self):
+        self.rm('0')
+        self.rm('150')
+        self.rm(str(TODOS - 3))
+        self.check(True)
+
+    def test_add(self):
+        self.add('new late one', ['p0'], ['c1'])
+        self.add('new plain one', ['p2'])
+        self.check(True)
+
+    def test_same_length_change(self):
+        inode = os.stat(self.config.todo_path).st_ino
+        # task 010 leaves the query view, task 011 joins it
+        todo.edit_todo(self.config, '10', 'slow 010')
+        todo.edit_todo(self.config, '11', 'late 011')
+        todo.edit_todo(self.config, '13', 'late 013')
+        self.assertEqual(os.stat(self.config.todo_path).st_ino, inode)
+        self.check(True)
+
+    def test_set(self):
+        # Done todos leave the views without -f
+        todo.toggle_todo(self.config, '1', 'done')
+        todo.toggle_todo(self.config, '7', 'ongoing')
+        todo.toggle_todo(self.config, '100', 'toggle')
+        self.check(True)
+
+    def test_mixed(self):
+        self.rm('4')
+        self.add('late addition', ['p0'], ['c1'])
+        todo.edit_todo(self.config, '20', 'late 021')
+        todo.toggle_todo(self.config, '2', 'done')
+        self.rm(str(TODOS - 1))
+        todo.edit_todo(self.config, '5', 'a much longer description')
+        self.add('another one', ['p3'], ['c1'])
+        self.check(True)
+
+    def test_more_changes_than_logged(self):
+        start = self.generation()
+        for no in range(todo.TodoCache.log_size + 1):
+            self.add('todo {}'.format(no), ['p{}'.format(no % 3)],
+                     ['c{}'.format(no % 2)])
+            # Caught up one add at a time, not one append of many lines
+            todo.load_cache_entry(self.config)
+        self.assertGreater(self.generation() - start,
+                           todo.TodoCache.log_size)
+        self.check(False)
+
+    def test_lineage_change(self):
+        lineage = todo.load_cache_entry(self.config).lineage
+        # Changed behind todo's back: the cache is rebuilt from scratch
+        with open(self.config.todo_path) as todo_file:
+            lines = todo_file.readlines()
+        with open(self.config.todo_path, 'w') as todo_file:
+            todo_file.writelines(lines[::-1])
+        self.assertNotEqual(todo.load_cache_entry(self.config).lineage,
+                            lineage)
+        self.check(False)
+
+    def test_changed_definition(self):
+        self.config.views['ctx'][0] = '-@ c2 -s ~due'
+        self.check(False)
+
+
+if __name__ == '__main__':
+    unittest.main()
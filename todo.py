@@ -1,13 +1,16 @@
-from os import path
 import sys
 import os
-import argparse
-import re
+import marshal
+import bisect
+import itertools
+import gc
+import time
 from datetime import datetime
-import shutil
-from pathlib import Path
 
-# TODO: Add archiving
+# Modules only some commands need (argparse, re, array, heapq, contextlib,
+# hashlib, locale, json, shlex) are imported where they are used to keep
+# startup fast.
+
 # TODO: Add editing of other things than descrip
 
 
@@ -24,6 +27,8 @@ class TodoPrinter:
             self.width = width
             self.name = name
             self.type = t
+            # Show a dict as key:value rows instead of as a Python dict
+            self.rows = False
             self.print_format = print_format if print_format else '{:' + str(
                 width) + '.' + str(width) + 's}'
 
@@ -50,8 +55,9 @@ class TodoPrinter:
             return TodoPrinter.Properties().show_idx().show_prio().show_due(
             ).show_description().show_categories().show_projects()
 
-        def show_labels(self):
+        def show_labels(self, rows=False):
             self.labels.show = True
+            self.labels.rows = rows
             return self
 
         def show_due(self):
@@ -91,11 +97,15 @@ class TodoPrinter:
             return self
 
     class Line:
-        def __init__(self, todo, keys, props):
+        def __init__(self, todo, columns):
             (self.rows,
-             self.dict) = TodoPrinter.Line.create_line(todo, keys, props)
+             self.cells) = TodoPrinter.Line.create_line(todo, columns)
 
         def split_line(string, width):
+            string = string.rstrip()
+            if len(string) < width:
+                # Fits on one row
+                return [string + ' ']
             lines = [''] * (1 + len(string.rstrip()) // width)
             words = string.rstrip().split(' ')
             words.reverse()
@@ -107,51 +117,67 @@ class TodoPrinter:
                 acc += 1
             return lines
 
-        def create_line(todo, keys, props):
-            value_list_dict = {}
+        def renderer(prop):
+            """Function turning a value of prop into its rows of text."""
+            width = prop.width
+            split_line = TodoPrinter.Line.split_line
+            if prop.type is str:
+                return lambda value: split_line(value, width)
+            elif prop.type is int:
+                return lambda value: [str(value).rjust(width)]
+            elif prop.type is datetime:
+                return lambda value: [value.date().isoformat()]
+            elif prop.type is list:
+                return lambda value: [str(v) for v in value]
+            elif prop.type is bool:
+                return lambda value: [' (X) ' if value else '']
+            elif prop.type is dict and prop.rows:
+                return lambda value: [
+                    '{}:{}'.format(k, v) for k, v in value.items()
+                ] or ['']
+            return lambda value: [str(value)]
+
+        def create_line(todo, columns):
+            """columns holds (key, is_attribute, renderer) per column."""
+            cells = []
             rows = 0
-            for key in keys:
-                value_list_dict[key] = []
-                value = ''
-                if key in todo.__dict__.keys():
-                    value = todo.__dict__[key]
-                elif key in todo.labels.keys():
-                    value = todo.labels[key]
-
-                prop = props.__dict__[key]
-                if value is None:
-                    value_list_dict[key] = ['']
-                elif prop.type is str:
-                    value_list_dict[key] = TodoPrinter.Line.split_line(
-                        value, prop.width)
-                elif prop.type is int:
-                    value_list_dict[key] = [str(value).rjust(prop.width)]
-                elif prop.type is datetime:
-                    value_list_dict[key] = [value.date().isoformat()]
-                elif prop.type is list:
-                    value_list_dict[key] = [str(v) for v in value]
-                elif prop.type is bool:
-                    value_list_dict[key] = [' (X) ' if value else '']
+            for key, is_attribute, render in columns:
+                if is_attribute:
+                    value = getattr(todo, key)
                 else:
-                    value_list_dict[key] = [str(value)]
-                rows = max(rows, len(value_list_dict[key]))
-            return (rows, value_list_dict)
+                    value = todo.labels.get(key, '')
 
-        def get_value(self, key, idx):
-            if (idx < len(self.dict[key])):
-                return self.dict[key][idx]
+                cell = [''] if value is None else render(value)
+                cells.append(cell)
+                if len(cell) > rows:
+                    rows = len(cell)
+            return (rows, cells)
+
+        def get_value(self, column, idx):
+            if (idx < len(self.cells[column])):
+                return self.cells[column][idx]
             return None
 
         def get_rows(self):
             return self.rows
 
+    # Rows are collected and written in batches of this many lines
+    flush_rows = 4096
+
     def set_props(self, props):
         self.props = props
         self.keys = [
             key for key, value in self.props.__dict__.items() if value.show
         ]
+        self.columns = [(key, key in Todo.__slots__,
+                         TodoPrinter.Line.renderer(self.props.__dict__[key]))
+                        for key in self.keys]
         self.title_format = self.create_title_format()
         self.format = self.create_format()
+        self.format_first_row = self.format.format
+        self.format_row = self.title_format.format
+        self.separator = '-' * len(self.format.format(*('', ) *
+                                                      (len(self.keys))))
 
     def create_title_format(self):
         format_str = '| '
@@ -168,49 +194,68 @@ class TodoPrinter:
             format_str += value.print_format + ' | '
         return format_str.rstrip()
 
-    def print_title(self):
-        title = ()
-        for key in self.keys:
-            title += (self.props.__dict__[key].name, )
+    def write(self, out):
+        if out:
+            out.append('')
+            text = '\n'.join(out)
+            TodoStats.count('bytes written', len(text))
+            sys.stdout.write(text)
+            out.clear()
+
+    def print_title(self, out=None):
+        buffered = out is not None
+        out = out if buffered else []
+        title = [self.props.__dict__[key].name for key in self.keys]
         title_str = self.title_format.format(*title)
-        print('=' * len(title_str))
-        print(title_str)
-        print('=' * len(title_str))
+        out.append('=' * len(title_str))
+        out.append(title_str)
+        out.append('=' * len(title_str))
+        if not buffered:
+            self.write(out)
 
-    def print_todo(self, todo):
-        line = TodoPrinter.Line(todo, self.keys, self.props)
-        self.print_line(line)
+    def print_todo(self, todo, out=None):
+        line = TodoPrinter.Line(todo, self.columns)
+        self.print_line(line, out)
         return
 
-    def print_line(self, line, border=False):
-        for row in range(0, line.rows):
-            # Gather all the values to print
-            values = ()
-            for key in self.keys:
-                value = line.get_value(key, row)
-                if type(value) is str:
-                    values += (value, )
-                elif value is None:
-                    values += ('', )
-                else:
-                    print('Unrecognized value type {}', value.type)
-                    values += ('', )
-            if row == 0:
-                print(self.format.format(*values))
-            else:
-                print(self.title_format.format(*values))
+    def print_line(self, line, out=None):
+        buffered = out is not None
+        out = out if buffered else []
+        cells = line.cells
+        if line.rows:
+            out.append(
+                self.format_first_row(*[cell[0] if cell else ''
+                                        for cell in cells]))
+        for row in range(1, line.rows):
+            out.append(
+                self.format_row(*[
+                    cell[row] if row < len(cell) else '' for cell in cells
+                ]))
+        if not buffered:
+            self.write(out)
 
-    def print_horizontal_separator(self):
-        print('-' * len(self.format.format(*('', ) * (len(self.keys)))))
+    def print_horizontal_separator(self, out=None):
+        if out is None:
+            print(self.separator)
+        else:
+            out.append(self.separator)
 
     def print_todos(self, todos):
-        self.print_title()
+        out = []
+        self.print_title(out)
         for todo in todos:
-            self.print_todo(todo)
-            self.print_horizontal_separator()
+            self.print_todo(todo, out)
+            out.append(self.separator)
+            if len(out) >= TodoPrinter.flush_rows:
+                self.write(out)
+        self.write(out)
 
 
 class Todo:
+    __slots__ = ('done', 'idx', 'description', 'categories', 'projects',
+                 'prio', 'created_date', 'done_date', 'due', 'labels',
+                 'matched', 'line')
+
     def __init__(self, description):
         self.done = False
         self.idx = None
@@ -234,6 +279,9 @@ class Todo:
     def set_idx(self, idx):
         self.idx = idx
 
+    def set_description(self, description):
+        self.description = description
+
     def set_prio(self, prio):
         self.prio = prio
 
@@ -290,16 +338,1350 @@ class Todo:
         return ret
 
 
+class TodoParseError(RuntimeError):
+    def __init__(self, message, todo):
+        super().__init__(message)
+        self.todo = todo
+
+
+class TodoParser:
+    # Compiled once, on first use, and shared by every line. The header is
+    # anchored and matches: done marker, priority and up to two dates. The
+    # body is then tokenized in a single scan where every match is either a
+    # +project, an @context (with or without leading whitespace) or a
+    # key:value label.
+    header = None
+    tokens = None
+
+    def __init__(self):
+        self.dates = {}
+        if TodoParser.header is None:
+            import re
+            TodoParser.header = re.compile(
+                r'(x )?(\([A-Z]\) )?([0-9]{4}-[0-9]{2}-[0-9]{2} )?([0-9]{4}-[0-9]{2}-[0-9]{2} )?(.*)'
+            )
+            TodoParser.tokens = re.compile(
+                r'\s(?:\+([A-Za-z0-9\-_]+)|(@)([A-Za-z0-9\-_]+)|'
+                r'([A-Za-z0-9\-_]+):([A-Za-z0-9\-_]+))|'
+                r'@[A-Za-z0-9\-_]+')
+
+    def parse_date(self, s):
+        date = self.dates.get(s)
+        if date is None:
+            if len(s) == 10 and s[4] == '-' and s[7] == '-' and s[:4].isdigit(
+            ) and s[5:7].isdigit() and s[8:].isdigit() and s.isascii():
+                date = datetime(int(s[:4]), int(s[5:7]), int(s[8:]))
+            else:
+                date = datetime.strptime(s, '%Y-%m-%d')
+            self.dates[s] = date
+        return date
+
+    def tokenize(self, body):
+        """Split the body of a line into description, contexts, projects and
+        labels. Returns (description, categories, projects, labels) where
+        labels is a list of (key, value) pairs in file order."""
+        pieces = []
+        categories = []
+        projects = []
+        labels = []
+        pos = 0
+        for match in self.tokens.finditer(body):
+            start, end = match.span()
+            project, at, category, key, value = match.groups()
+            if project is not None:
+                projects.append(sys.intern(project))
+            elif at is not None:
+                # The whitespace in front of a context is kept
+                categories.append(sys.intern(category))
+                start += 1
+            elif key is not None:
+                labels.append((sys.intern(key), value))
+            pieces.append(body[pos:start])
+            pieces.append(' ')
+            pos = end
+        if pos == 0:
+            return (body.strip(), categories, projects, labels)
+        pieces.append(body[pos:])
+        return (''.join(pieces).strip(), categories, projects, labels)
+
+    def parse_line(self, idx, line):
+        """Parse one todo.txt line into a Todo. Raises TodoParseError
+        (carrying the partially parsed Todo) for malformed lines."""
+        match = self.header.match(line)
+        done, prio, first, second, body = match.groups()
+        (description, categories, projects,
+         labels) = self.tokenize(body)
+
+        todo = Todo(description)
+        todo.set_idx(idx)
+
+        if prio:
+            todo.set_prio(prio[1])
+
+        if done:
+            todo.set_done(True)
+            if first:
+                # We are not allowed to have a completed date without a created date
+                if second:
+                    todo.set_done_date(self.parse_date(first[:10]))
+                    todo.set_created(self.parse_date(second[:10]))
+                else:
+                    raise TodoParseError(
+                        'Todo marked as done but has ONE date (should have 2 or none): "{}"'
+                        .format(line.rstrip()), todo)
+        else:
+            if first and not second:
+                todo.set_created(self.parse_date(first[:10]))
+            elif second:
+                raise TodoParseError(
+                    'Todo is not marked as done but has 2 dates: "{}"'.format(
+                        line.rstrip()), todo)
+
+        todo.categories = categories
+        todo.projects = projects
+        for key, value in labels:
+            if key == 'due':
+                todo.set_due(self.parse_date(value))
+            else:
+                todo.add_label(key, value)
+
+        return todo
+
+
+class TodoCache:
+    """Sidecar cache of parsed todo.txt records stored next to the todo file.
+
+    Records are stored in length-prefixed marshal chunks followed by a
+    trailer, so they can be streamed back without loading the whole cache and
+    appended to by copying the existing chunks. A TodoIndex over the records
+    and the byte offset of every line are stored after the chunks. The cache
+    is trusted as-is when the mtime and size of todo.txt are unchanged.
+    Otherwise the content hashes of the lines of every chunk decide if the
+    file was only appended to (only the tail is parsed) or has to be parsed
+    from scratch. Hashing the lines chunk by chunk lets a change to one line
+    be written to the cache by hashing only the chunk holding it, the other
+    chunks keep their hashes at their new byte offsets.
+
+    The trailer also logs the latest changes made to the records in place
+    (lines appended, replaced or removed) as (idx, removed, added): lines
+    idx to idx+removed-1 were replaced by added new lines. Together with the
+    lineage, which is new every time the cache is rebuilt from scratch, and
+    the number of changes since, this lets a TodoView catch up on only the
+    lines that changed."""
+    version = 10
+    chunk_size = 1024
+    # Changes kept in the trailer, older views are recomputed
+    log_size = 64
+    # A file modified this close to when the cache was written may have been
+    # changed again without its mtime moving, so its content hash is checked
+    racy_ns = 2 * 10**9
+    block_size = 1 << 20
+    # Least bytes of todo.txt per worker worth starting a process for
+    parallel_size = 1 << 22
+    # Dates are shared between todos, there are only so many days
+    dates = {}
+    # Entries held in memory by `todo serve`, by cache path, see Entry.warm
+    hot = None
+
+    class Entry:
+        def __init__(self, path, trailer, cache_file):
+            self.path = path
+            # Everything is read from the file the trailer came from, the
+            # cache may be replaced by another process in the meantime
+            self.file = cache_file
+            self.mtime_ns = trailer['mtime_ns']
+            self.size = trailer['size']
+            self.written_ns = trailer['written_ns']
+            self.count = trailer['count']
+            self.end = trailer['end']
+            (self.chunk_starts, self.chunk_offsets, self.chunk_bytes,
+             self.chunk_digests) = trailer['chunks']
+            self.offsets = trailer['offsets']
+            self.lineage = trailer['lineage']
+            self.generation = trailer['generation']
+            self.changes = trailer['changes']
+            self.key = None
+            self.records = None
+            self.index = None
+            self.offset_table = None
+
+        def is_fresh(self, stat):
+            return (stat.st_mtime_ns == self.mtime_ns
+                    and stat.st_size == self.size
+                    and self.written_ns - self.mtime_ns > TodoCache.racy_ns)
+
+        def is_prefix_of(self, todo_file, stat):
+            """Check the first size bytes of todo_file against the hashes of
+            the chunks. Leaves todo_file positioned after them."""
+            if stat.st_size < self.size:
+                return False
+            # Appended lines have to start on a line of their own
+            if self.size and stat.st_size > self.size:
+                todo_file.seek(self.size - 1)
+                if todo_file.read(1) != b'\n':
+                    return False
+            todo_file.seek(0)
+            ends = self.chunk_bytes[1:] + [self.size]
+            for start, end, digest in zip(self.chunk_bytes, ends,
+                                          self.chunk_digests):
+                if TodoCache.hash_range(todo_file, start, end) != digest:
+                    return False
+            return todo_file.tell() == self.size
+
+        def matches(self, todo_file, stat):
+            return self.is_fresh(stat) or (stat.st_size == self.size
+                                           and self.is_prefix_of(
+                                               todo_file, stat))
+
+        def read_at(self, offset, length):
+            if hasattr(os, 'pread'):
+                return os.pread(self.file.fileno(), length, offset)
+            self.file.seek(offset)
+            return self.file.read(length)
+
+        def read_section(self, offset):
+            """The bytes of the length-prefixed section at offset."""
+            length = int.from_bytes(self.read_at(offset, 4), 'little')
+            return self.read_at(offset + 4, length)
+
+        def read_chunk(self, pos):
+            return marshal.loads(self.read_section(self.chunk_offsets[pos]))
+
+        def warm(self, key):
+            """Keep the records, index and offsets in memory, for as long as
+            the cache file is still the one with key."""
+            from array import array
+            cache_file = self.file
+            cache_file.seek(0)
+            records = []
+            while cache_file.tell() < self.end:
+                length = int.from_bytes(cache_file.read(4), 'little')
+                records.extend(marshal.loads(cache_file.read(length)))
+            length = int.from_bytes(cache_file.read(4), 'little')
+            self.index = TodoIndex.load(cache_file.read(length))
+            if self.offsets is not None:
+                cache_file.seek(self.offsets)
+                length = int.from_bytes(cache_file.read(4), 'little')
+                self.offset_table = array('q', cache_file.read(length))
+            self.records = records
+            self.key = key
+
+        def iter_records(self):
+            if self.records is not None:
+                yield from self.records
+                return
+            pos = 0
+            while pos < self.end:
+                data = self.read_section(pos)
+                pos += 4 + len(data)
+                yield from marshal.loads(data)
+
+        def iter_records_at(self, idxs):
+            """Yield (idx, record) for ascending idxs, reading only the chunks
+            that hold them."""
+            if self.records is not None:
+                for idx in idxs:
+                    yield (idx, self.records[idx])
+                return
+            current = None
+            for idx in idxs:
+                pos = bisect.bisect_right(self.chunk_starts, idx) - 1
+                if pos != current:
+                    chunk = self.read_chunk(pos)
+                    current = pos
+                yield (idx, chunk[idx - self.chunk_starts[pos]])
+
+        def load_index(self):
+            if self.index is not None:
+                return self.index
+            return TodoIndex.load(self.read_section(self.end))
+
+        def find_id(self, value, prefix=False):
+            # Loaded once, a batch may look up many ids
+            if self.index is None:
+                self.index = self.load_index()
+            return self.index.find_id(value, prefix)
+
+        def load_offsets(self):
+            """Byte offset of the start of every line, or None if they are
+            not known."""
+            from array import array
+            if self.offsets is None:
+                return None
+            if self.offset_table is not None:
+                return self.offset_table
+            return array('q', self.read_section(self.offsets))
+
+    class Writer:
+        def __init__(self, path, entry=None, vocab=None):
+            # The entry is replaced and its index and offsets are changed in
+            # place below, it can no longer be held in memory
+            from array import array
+            if TodoCache.hot:
+                TodoCache.hot.pop(path, None)
+            self.path = path
+            self.vocab = vocab
+            self.temp_path = '{}~{}'.format(path, os.getpid())
+            self.records = []
+            self.count = 0
+            self.chunk_starts = []
+            self.chunk_offsets = []
+            # Byte offset in todo.txt and hash of the lines of every chunk,
+            # None until hashed by commit
+            self.chunk_bytes = []
+            self.chunk_digests = []
+            # Byte offset of the first line in records
+            self.start = 0
+            self.index = TodoIndex()
+            self.offsets = array('q')
+            self.lineage = os.urandom(8)
+            self.generation = 0
+            self.changes = []
+            # Lines appended to entry
+            self.appended = None
+            try:
+                self.file = open(self.temp_path, 'wb')
+                if entry:
+                    for offset in range(0, entry.end, TodoCache.block_size):
+                        self.file.write(
+                            entry.read_at(
+                                offset,
+                                min(TodoCache.block_size,
+                                    entry.end - offset)))
+                    self.inherit(entry)
+                    self.appended = entry.count
+                    self.count = entry.count
+                    self.chunk_starts = list(entry.chunk_starts)
+                    self.chunk_offsets = list(entry.chunk_offsets)
+                    self.chunk_bytes = list(entry.chunk_bytes)
+                    self.chunk_digests = list(entry.chunk_digests)
+                    self.index = entry.load_index()
+                    self.offsets = entry.load_offsets()
+            except (OSError, EOFError, ValueError, TypeError, KeyError):
+                self.discard()
+
+        def inherit(self, entry):
+            """Carry on the change log of entry."""
+            self.lineage = entry.lineage
+            self.generation = entry.generation
+            self.changes = list(entry.changes)
+
+        def log(self, idx, removed, added):
+            self.generation += 1
+            self.changes.append((idx, removed, added))
+            del self.changes[:-TodoCache.log_size]
+
+        def add(self, record, offset):
+            if not self.records:
+                self.start = offset
+            self.index.add(self.count + len(self.records), record)
+            self.records.append(record)
+            if self.offsets is not None:
+                self.offsets.append(offset)
+
+        def flush(self, digest=None):
+            """Write the records added since as a chunk, with the hash of
+            their lines when known (see TodoCache.Tee)."""
+            if self.records and self.file:
+                data = marshal.dumps(self.records)
+                try:
+                    self.chunk_starts.append(self.count)
+                    self.chunk_offsets.append(self.file.tell())
+                    self.chunk_bytes.append(self.start)
+                    self.chunk_digests.append(digest)
+                    self.file.write(len(data).to_bytes(4, 'little'))
+                    self.file.write(data)
+                except OSError:
+                    self.discard()
+            self.count += len(self.records)
+            self.records = []
+
+        def copy_chunks(self, entry, first, last, shift=0, delta=0):
+            """Copy chunks first..last-1 of entry as they are, with their
+            line numbers moved by shift and their lines by delta bytes."""
+            if not self.file:
+                return
+            for pos in range(first, last):
+                start = entry.chunk_starts[pos]
+                end = entry.chunk_starts[pos + 1] if pos + 1 < len(
+                    entry.chunk_starts) else entry.count
+                try:
+                    data = entry.read_section(entry.chunk_offsets[pos])
+                    self.chunk_starts.append(start + shift)
+                    self.chunk_offsets.append(self.file.tell())
+                    self.chunk_bytes.append(entry.chunk_bytes[pos] + delta)
+                    self.chunk_digests.append(entry.chunk_digests[pos])
+                    self.file.write(len(data).to_bytes(4, 'little'))
+                    self.file.write(data)
+                except OSError:
+                    self.discard()
+                    return
+                self.count += end - start
+
+        def commit(self, mtime_ns, size, todo_file):
+            """Write the cache of the first size bytes of todo_file (a
+            binary file). Chunks flushed without a hash have their lines
+            hashed from todo_file, which must not have changed since they
+            were read (e.g. by holding the TodoLock)."""
+            self.flush()
+            if not self.file:
+                return
+            if self.appended is not None and self.count > self.appended:
+                self.log(self.appended, 0, self.count - self.appended)
+            try:
+                ends = self.chunk_bytes[1:] + [size]
+                for pos, digest in enumerate(self.chunk_digests):
+                    if digest is None:
+                        self.chunk_digests[pos] = TodoCache.hash_range(
+                            todo_file, self.chunk_bytes[pos], ends[pos])
+                end = self.file.tell()
+                index = self.index.dump()
+                self.file.write(len(index).to_bytes(4, 'little'))
+                self.file.write(index)
+                offsets = None
+                if self.offsets is not None:
+                    offsets = self.file.tell()
+                    self.file.write((len(self.offsets) *
+                                     self.offsets.itemsize).to_bytes(
+                                         4, 'little'))
+                    self.file.write(self.offsets.tobytes())
+                trailer = marshal.dumps({
+                    'version': TodoCache.version,
+                    'mtime_ns': mtime_ns,
+                    'size': size,
+                    'written_ns': time.time_ns(),
+                    'count': self.count,
+                    'end': end,
+                    'chunks': (self.chunk_starts, self.chunk_offsets,
+                               self.chunk_bytes, self.chunk_digests),
+                    'offsets': offsets,
+                    'lineage': self.lineage,
+                    'generation': self.generation,
+                    'changes': self.changes,
+                })
+                self.file.write(trailer)
+                self.file.write(len(trailer).to_bytes(4, 'little'))
+                self.file.close()
+                self.file = None
+                os.replace(self.temp_path, self.path)
+                # Only kept up to date once completion has asked for it
+                if self.vocab and os.path.exists(self.vocab.path):
+                    self.vocab.write(self.index,
+                                     (self.lineage, self.generation))
+            except OSError:
+                # The cache is only an optimization, todo.txt is the truth
+                self.discard()
+
+        def discard(self):
+            if self.file:
+                self.file.close()
+                self.file = None
+            try:
+                os.remove(self.temp_path)
+            except OSError:
+                pass
+
+    class Tee:
+        """A binary file keeping the bytes read from it until they are
+        hashed, so that chunks are hashed from exactly the bytes they were
+        parsed from, whatever happens to the file meanwhile."""
+        def __init__(self, todo_file, offset):
+            self.file = todo_file
+            # Offset in the file of data[0]
+            self.offset = offset
+            self.data = bytearray()
+
+        def read(self, size):
+            block = self.file.read(size)
+            self.data += block
+            return block
+
+        def take(self, end=None):
+            """Hash of the bytes read from offset to end (all of them by
+            default), which are dropped."""
+            length = len(self.data) if end is None else end - self.offset
+            digest = new_digest()
+            digest.update(memoryview(self.data)[:length])
+            del self.data[:length]
+            self.offset += length
+            return digest.digest()
+
+    def __init__(self, todo_path):
+        self.path = os.path.join(os.path.dirname(todo_path),
+                                 '.' + os.path.basename(todo_path) + '.cache')
+        self.vocab = TodoVocabulary(todo_path)
+
+    def parse_record(parser, idx, line):
+        """Parse a line into (todo, record), malformed lines included."""
+        try:
+            todo = parser.parse_line(idx, line)
+            return (todo, TodoCache.to_record(todo))
+        except TodoParseError as err:
+            todo = err.todo
+            todo.matched = False
+            todo.line = line
+            return (todo, TodoCache.to_record(todo, '[WARN] {}'.format(err)))
+
+    def parse_lines(todo_file, size, workers=None):
+        """Yield (digest, lines) chunks of at most chunk_size lines of
+        todo_file from its current position, where lines are the (offset,
+        record) of each line (see read_lines) and digest the hash of their
+        bytes. Large files are split on line boundaries and parsed by a pool
+        of worker processes, small ones (or with a single worker) in this
+        process."""
+        start = todo_file.tell()
+        if workers is None:
+            workers = len(os.sched_getaffinity(0)) if hasattr(
+                os, 'sched_getaffinity') else os.cpu_count() or 1
+        workers = min(workers, (size - start) // TodoCache.parallel_size)
+        if workers <= 1:
+            yield from TodoCache.parse_chunks(
+                TodoCache.Tee(todo_file, start), TodoParser())
+            return
+
+        # A few ranges per worker, so a slow one does not hold up the rest
+        bounds = [start]
+        step = (size - start) // (workers * 4)
+        for pos in range(start + step, size, step):
+            if pos <= bounds[-1]:
+                continue
+            todo_file.seek(pos)
+            todo_file.readline()
+            if todo_file.tell() >= size:
+                break
+            bounds.append(todo_file.tell())
+        bounds.append(size)
+        todo_file.seek(start)
+
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(workers) as executor:
+            ranges = executor.map(TodoCache.parse_range,
+                                  [todo_file.name] * (len(bounds) - 1),
+                                  bounds[:-1], bounds[1:])
+            for data in ranges:
+                yield from marshal.loads(data)
+        # Where reading the lines in this process would have left it
+        todo_file.seek(size)
+
+    def parse_range(todo_path, start, end):
+        """Parse bytes start..end of todo_path in a worker process, returns
+        the marshalled list of chunks, see parse_lines."""
+        import io
+        with open(todo_path, 'rb') as todo_file:
+            todo_file.seek(start)
+            data = io.BytesIO(todo_file.read(end - start))
+        with paused_gc():
+            chunks = list(
+                TodoCache.parse_chunks(TodoCache.Tee(data, start),
+                                       TodoParser()))
+        return marshal.dumps(chunks)
+
+    def parse_chunks(tee, parser):
+        """Parse the lines of tee into chunks, see parse_lines."""
+        lines = []
+        for offset, line in TodoCache.read_lines(tee, tee.offset):
+            if len(lines) == TodoCache.chunk_size:
+                yield (tee.take(offset), lines)
+                lines = []
+            lines.append((offset, TodoCache.parse_record(parser, 0, line)[1]))
+        if lines:
+            yield (tee.take(), lines)
+
+    def to_record(todo, warning=None):
+        return (todo.done, todo.prio, TodoCache.to_ordinal(todo.done_date),
+                TodoCache.to_ordinal(todo.created_date),
+                TodoCache.to_ordinal(todo.due), todo.description,
+                tuple(todo.categories), tuple(todo.projects),
+                tuple(todo.labels.items()), todo.matched, todo.line, warning)
+
+    def from_record(idx, record):
+        (done, prio, done_date, created_date, due, description, categories,
+         projects, labels, matched, line, warning) = record
+        todo = Todo(description)
+        todo.idx = idx
+        todo.done = done
+        todo.prio = prio
+        todo.done_date = TodoCache.from_ordinal(done_date)
+        todo.created_date = TodoCache.from_ordinal(created_date)
+        todo.due = TodoCache.from_ordinal(due)
+        todo.categories = list(categories)
+        todo.projects = list(projects)
+        todo.labels = dict(labels)
+        todo.matched = matched
+        todo.line = line
+        return todo
+
+    def to_ordinal(date):
+        return date.toordinal() if date else 0
+
+    def from_ordinal(ordinal):
+        if not ordinal:
+            return None
+        date = TodoCache.dates.get(ordinal)
+        if date is None:
+            date = TodoCache.dates[ordinal] = datetime.fromordinal(ordinal)
+        return date
+
+    def load(self):
+        try:
+            cache_file = open(self.path, 'rb')
+        except OSError:
+            return None
+        try:
+            stat = os.fstat(cache_file.fileno())
+            # The cache is only ever replaced, never written in place
+            key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if TodoCache.hot is not None:
+                entry = TodoCache.hot.get(self.path)
+                if entry and entry.key == key:
+                    cache_file.close()
+                    return entry
+            cache_file.seek(-4, os.SEEK_END)
+            length = int.from_bytes(cache_file.read(4), 'little')
+            cache_file.seek(-4 - length, os.SEEK_END)
+            trailer = marshal.loads(cache_file.read(length))
+            if trailer['version'] != TodoCache.version:
+                cache_file.close()
+                return None
+            entry = TodoCache.Entry(self.path, trailer, cache_file)
+            if TodoCache.hot is not None:
+                entry.warm(key)
+                TodoCache.hot[self.path] = entry
+            return entry
+        except (OSError, EOFError, ValueError, TypeError, KeyError):
+            cache_file.close()
+            return None
+
+    def load_valid(self, todo_path):
+        """Load the cache only if it matches todo.txt exactly."""
+        entry = self.load()
+        if entry is None:
+            return None
+        try:
+            with open(todo_path, 'rb') as todo_file:
+                if entry.matches(todo_file, os.fstat(todo_file.fileno())):
+                    return entry
+        except OSError:
+            pass
+        return None
+
+    def writer(self, entry=None):
+        return TodoCache.Writer(self.path, entry, self.vocab)
+
+    def splice(self, entry, changed, added, todo_path):
+        """Rewrite the cache after the lines of todo_path in changed were
+        replaced or removed and the lines in added were appended (see
+        splice_todo_file). changed maps a line no to the record and size in
+        bytes of the line written in its place, (None, 0) when it was
+        removed, and added holds the record and size of each new line. Only
+        the chunks holding a changed line are decoded and hashed again, the
+        others are copied with their lines and bytes moved."""
+        from array import array
+        offsets = entry.load_offsets()
+
+        def old_size(idx):
+            end = offsets[idx + 1] if idx + 1 < entry.count else entry.size
+            return end - offsets[idx]
+
+        writer = TodoCache.Writer(self.path, vocab=self.vocab)
+        writer.inherit(entry)
+        dirty = {}
+        for idx in sorted(changed):
+            pos = bisect.bisect_right(entry.chunk_starts, idx) - 1
+            dirty.setdefault(pos, []).append(idx)
+        removed = []
+        (last, delta) = (0, 0)
+        try:
+            writer.index = entry.load_index()
+            for pos in sorted(dirty):
+                writer.copy_chunks(entry, last, pos, -len(removed), delta)
+                first = entry.chunk_starts[pos]
+                chunk = entry.read_chunk(pos)
+                writer.start = entry.chunk_bytes[pos] + delta
+                for idx in dirty[pos]:
+                    (record, size) = changed[idx]
+                    writer.index.remove(idx, chunk[idx - first])
+                    writer.log(idx - len(removed), 1,
+                               0 if record is None else 1)
+                    if record is None:
+                        removed.append(idx)
+                    else:
+                        writer.index.add(idx, record)
+                    chunk[idx - first] = record
+                    delta += size - old_size(idx)
+                writer.records = [
+                    record for record in chunk if record is not None
+                ]
+                writer.flush()
+                last = pos + 1
+            writer.copy_chunks(entry, last, len(entry.chunk_starts),
+                               -len(removed), delta)
+        except (OSError, EOFError, ValueError, TypeError):
+            writer.discard()
+            return
+        writer.index.shift(removed)
+
+        # The offsets of the lines kept, moved by the changes before them
+        writer.offsets = array('q')
+        (last, moved) = (0, 0)
+        for idx in sorted(changed):
+            writer.offsets.extend(offset + moved
+                                  for offset in offsets[last:idx])
+            (record, size) = changed[idx]
+            if record is not None:
+                writer.offsets.append(offsets[idx] + moved)
+            moved += size - old_size(idx)
+            last = idx + 1
+        writer.offsets.extend(offset + moved for offset in offsets[last:])
+
+        end = entry.size + delta
+        if added:
+            writer.log(writer.count, 0, len(added))
+        for pos in range(0, len(added), TodoCache.chunk_size):
+            for record, size in added[pos:pos + TodoCache.chunk_size]:
+                writer.add(record, end)
+                end += size
+            writer.flush()
+        try:
+            with open(todo_path, 'rb') as todo_file:
+                stat = os.fstat(todo_file.fileno())
+                # Anything else changed todo.txt as well
+                if stat.st_size != end:
+                    writer.discard()
+                    return
+                writer.commit(stat.st_mtime_ns, stat.st_size, todo_file)
+        except OSError:
+            writer.discard()
+
+    def append(self, entry, todo_path):
+        """Rewrite the cache after lines were appended to todo_path, which
+        entry matched before. Only the new lines are parsed and hashed."""
+        writer = self.writer(entry)
+        try:
+            with open(todo_path, 'rb') as todo_file:
+                stat = os.fstat(todo_file.fileno())
+                # Otherwise the first new line went onto the last old one
+                if entry.size:
+                    todo_file.seek(entry.size - 1)
+                    if todo_file.read(1) != b'\n':
+                        return
+                for digest, lines in TodoCache.parse_lines(
+                        todo_file, stat.st_size):
+                    for offset, record in lines:
+                        writer.add(record, offset)
+                    writer.flush(digest)
+                writer.commit(stat.st_mtime_ns, todo_file.tell(), todo_file)
+        except OSError:
+            pass
+        finally:
+            writer.discard()
+
+    def hash_range(todo_file, start, end):
+        """Content hash of bytes start..end of todo_file."""
+        digest = new_digest()
+        todo_file.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = todo_file.read(min(remaining, TodoCache.block_size))
+            if not block:
+                break
+            digest.update(block)
+            remaining -= len(block)
+        return digest.digest()
+
+    def read_lines(todo_file, offset=0):
+        """Yield (offset, line) for the lines of a binary file the way text
+        mode would split them (locale encoding, universal newlines)."""
+        encoding = file_encoding()
+        rest = b''
+        while True:
+            block = todo_file.read(TodoCache.block_size)
+            if not block:
+                break
+            lines = (rest + block).split(b'\n')
+            rest = lines.pop()
+            for raw in lines:
+                if b'\r' in raw:
+                    yield from TodoCache.split_cr(raw, offset, encoding, True)
+                else:
+                    yield (offset, raw.decode(encoding) + '\n')
+                offset += len(raw) + 1
+        if rest:
+            yield from TodoCache.split_cr(rest, offset, encoding, False)
+
+    def split_cr(raw, offset, encoding, terminated):
+        # Old Mac line endings, and the \r of a \r\n
+        pieces = raw.split(b'\r')
+        last = pieces.pop()
+        for piece in pieces:
+            yield (offset, piece.decode(encoding) + '\n')
+            offset += len(piece) + 1
+        if last:
+            yield (offset,
+                   last.decode(encoding) + ('\n' if terminated else ''))
+
+
+class TodoJournal:
+    """Undo journal that makes in-place patches of todo.txt crash-safe. The
+    bytes about to be overwritten are saved (and synced) before todo.txt is
+    touched, and put back by recover() if a patch was interrupted."""
+    def __init__(self, todo_path):
+        self.todo_path = todo_path
+        self.path = os.path.join(os.path.dirname(todo_path),
+                                 '.' + os.path.basename(todo_path) + '.journal')
+
+    def begin(self, start, size, saved):
+        temp_path = self.path + '~'
+        with open(temp_path, 'wb') as journal_file:
+            marshal.dump((start, size, saved), journal_file)
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.replace(temp_path, self.path)
+        sync_dir(self.path)
+
+    def end(self):
+        os.remove(self.path)
+
+    def recover(self):
+        if not os.path.exists(self.path):
+            return
+        # The journal of a writer that is still running is not left behind,
+        # and that writer holds the lock
+        with TodoLock(self.todo_path, blocking=False) as lock:
+            if not lock.acquired:
+                return
+            try:
+                with open(self.path, 'rb') as journal_file:
+                    (start, size, saved) = marshal.loads(journal_file.read())
+            except (OSError, EOFError, ValueError, TypeError):
+                return
+            with open(self.todo_path, 'r+b') as todo_file:
+                todo_file.seek(start)
+                todo_file.write(saved)
+                todo_file.truncate(size)
+                todo_file.flush()
+                os.fsync(todo_file.fileno())
+            print('[WARN] Rolled back an interrupted change to {}'.format(
+                self.todo_path))
+            self.end()
+
+
+class TodoLock:
+    """Advisory lock held by everything that writes todo.txt, so concurrent
+    todo processes do not lose each other's changes. It is taken on a lock
+    file next to todo.txt, as todo.txt itself is replaced when it is
+    rewritten. Re-entrant within a process, and not taken at all where
+    fcntl is not available."""
+    held = {}
+
+    def __init__(self, todo_path, blocking=True):
+        self.path = os.path.join(os.path.dirname(todo_path),
+                                 '.' + os.path.basename(todo_path) + '.lock')
+        self.blocking = blocking
+        self.acquired = False
+
+    def __enter__(self):
+        held = TodoLock.held.get(self.path)
+        if held is None:
+            lock_file = None
+            try:
+                import fcntl
+                lock_file = open(self.path, 'a+b')
+                fcntl.flock(
+                    lock_file.fileno(),
+                    fcntl.LOCK_EX | (0 if self.blocking else fcntl.LOCK_NB))
+            except ImportError:
+                pass
+            except BlockingIOError:
+                lock_file.close()
+                return self
+            except OSError:
+                # Writing next to todo.txt will fail and tell why
+                if lock_file:
+                    lock_file.close()
+                lock_file = None
+            held = TodoLock.held[self.path] = [lock_file, 0]
+        held[1] += 1
+        self.acquired = True
+        return self
+
+    def __exit__(self, *exc_info):
+        if not self.acquired:
+            return
+        held = TodoLock.held[self.path]
+        held[1] -= 1
+        if not held[1]:
+            del TodoLock.held[self.path]
+            if held[0]:
+                # Closing the file releases the lock
+                held[0].close()
+        self.acquired = False
+
+
+def new_digest():
+    import hashlib
+    return hashlib.blake2b(digest_size=16)
+
+
+def new_id():
+    """A random todo id of 12 lowercase letters, never a number so that it is
+    not taken for a line no."""
+    value = int.from_bytes(os.urandom(8), 'little')
+    letters = []
+    for _ in range(12):
+        value, letter = divmod(value, 26)
+        letters.append(chr(ord('a') + letter))
+    return ''.join(letters)
+
+
+def file_encoding():
+    # The encoding text mode reads and writes todo.txt with
+    import locale
+    return locale.getpreferredencoding(False)
+
+
+def sync_dir(path):
+    # Make a rename durable, not supported on every platform
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class TodoIndex:
+    """Inverted indexes over parsed todo records: posting lists (ascending
+    line numbers) per +project, @context, label key/value and word of the
+    descriptions, the id: labels sorted by id, a due date index sorted by
+    date, and the done and malformed lines.
+
+    The sections of a loaded index stay marshalled until they are first used,
+    so a lookup by project never decodes the (often one per line) label
+    values, words or ids."""
+    sections = ('projects', 'categories', 'labels', 'tokens', 'ids')
+    # Compiled on first use, see split_words
+    word = None
+
+    def __init__(self):
+        from array import array
+        self.lazy = {}
+        self.count = 0
+        self.projects = {}
+        self.categories = {}
+        self.labels = {}
+        self.tokens = {}
+        # Ids and the line of each, sorted up to ids_sorted, see sort_ids
+        self.ids = ([], array('i'))
+        self.ids_sorted = 0
+        self.due_dates = array('i')
+        self.due_idxs = array('i')
+        self.done = array('i')
+        self.warnings = []
+        self.due_sorted = True
+
+    def __getattr__(self, name):
+        from array import array
+        data = self.__dict__.get('lazy', {}).pop(name, None)
+        if data is None:
+            raise AttributeError(name)
+        postings = marshal.loads(data)
+        if name == 'ids':
+            value = (postings[0], array('i', postings[1]))
+            self.ids_sorted = len(postings[0])
+        elif name == 'labels':
+            value = {
+                key: {k: array('i', v)
+                      for k, v in values.items()}
+                for key, values in postings.items()
+            }
+        else:
+            value = {k: array('i', v) for k, v in postings.items()}
+        setattr(self, name, value)
+        return value
+
+    def dump_section(self, name):
+        if name in self.lazy:
+            return self.lazy[name]
+        if name == 'ids':
+            self.sort_ids()
+            return marshal.dumps((self.ids[0], self.ids[1].tobytes()))
+        if name == 'labels':
+            return marshal.dumps({
+                key: {k: v.tobytes()
+                      for k, v in values.items()}
+                for key, values in self.labels.items()
+            })
+        return marshal.dumps(
+            {k: v.tobytes()
+             for k, v in getattr(self, name).items()})
+
+    def insert_sorted(posting, idx):
+        if not posting or posting[-1] < idx:
+            posting.append(idx)
+        else:
+            pos = bisect.bisect_left(posting, idx)
+            if posting[pos] != idx:
+                posting.insert(pos, idx)
+
+    def remove_sorted(posting, idx):
+        pos = bisect.bisect_left(posting, idx)
+        if pos < len(posting) and posting[pos] == idx:
+            del posting[pos]
+
+    def add_posting(postings, key, idx):
+        from array import array
+        posting = postings.get(key)
+        if posting is None:
+            postings[key] = array('i', (idx, ))
+        elif posting[-1] < idx:
+            # Lines are mostly indexed in order
+            posting.append(idx)
+        else:
+            TodoIndex.insert_sorted(posting, idx)
+
+    def remove_posting(postings, key, idx):
+        posting = postings.get(key)
+        if posting is not None:
+            TodoIndex.remove_sorted(posting, idx)
+            if not posting:
+                del postings[key]
+
+    def shift_posting(posting, removed):
+        from array import array
+        pos = bisect.bisect_right(posting, removed[0])
+        if len(removed) == 1:
+            posting[pos:] = array('i', (i - 1 for i in posting[pos:]))
+        else:
+            posting[pos:] = array(
+                'i', (i - bisect.bisect_left(removed, i)
+                      for i in posting[pos:]))
+
+    def add(self, idx, record):
+        from array import array
+        appended = idx >= self.count
+        self.count = max(self.count, idx + 1)
+        (done, prio, done_date, created_date, due, description, categories,
+         projects, labels, matched, line, warning) = record
+        if not matched:
+            bisect.insort(self.warnings, (idx, warning))
+            return
+        for project in projects:
+            TodoIndex.add_posting(self.projects, project, idx)
+        for category in categories:
+            TodoIndex.add_posting(self.categories, category, idx)
+        for key, value in labels:
+            if key == 'id':
+                self.add_id(value, idx, appended)
+            else:
+                TodoIndex.add_posting(self.labels.setdefault(key, {}), value,
+                                      idx)
+        # add_posting inlined, there are a few words on every line
+        tokens = self.tokens
+        for token in TodoIndex.split_words(description):
+            posting = tokens.get(token)
+            if posting is None:
+                tokens[token] = array('i', (idx, ))
+            elif posting[-1] < idx:
+                posting.append(idx)
+            elif posting[-1] != idx:
+                TodoIndex.insert_sorted(posting, idx)
+        if due:
+            self.due_sorted = self.due_sorted and (not self.due_dates or
+                                                   self.due_dates[-1] <= due)
+            self.due_dates.append(due)
+            self.due_idxs.append(idx)
+        if done:
+            TodoIndex.insert_sorted(self.done, idx)
+
+    def remove(self, idx, record):
+        (done, prio, done_date, created_date, due, description, categories,
+         projects, labels, matched, line, warning) = record
+        if not matched:
+            self.warnings.remove((idx, warning))
+            return
+        for project in projects:
+            TodoIndex.remove_posting(self.projects, project, idx)
+        for category in categories:
+            TodoIndex.remove_posting(self.categories, category, idx)
+        for key, value in labels:
+            if key == 'id':
+                self.remove_id(value, idx)
+                continue
+            TodoIndex.remove_posting(self.labels[key], value, idx)
+            if not self.labels[key]:
+                del self.labels[key]
+        for token in TodoIndex.words_of(description):
+            TodoIndex.remove_posting(self.tokens, token, idx)
+        if due:
+            pos = self.due_idxs.index(idx)
+            del self.due_dates[pos]
+            del self.due_idxs[pos]
+        if done:
+            TodoIndex.remove_sorted(self.done, idx)
+
+    def shift(self, removed):
+        """Renumber the lines once the lines removed (ascending line nos)
+        have been taken out of the index."""
+        from array import array
+        if not removed:
+            return
+        for postings in [self.projects, self.categories, self.tokens] + list(
+                self.labels.values()):
+            for posting in postings.values():
+                TodoIndex.shift_posting(posting, removed)
+        TodoIndex.shift_posting(self.done, removed)
+
+        def moved(i):
+            return i - bisect.bisect_left(removed, i)
+
+        self.ids[1][:] = array('i', (moved(i) for i in self.ids[1]))
+        self.due_idxs = array('i', (moved(i) for i in self.due_idxs))
+        self.warnings = [(moved(i), warning)
+                         for (i, warning) in self.warnings]
+        self.count -= len(removed)
+
+    def sort_due(self):
+        from array import array
+        if not self.due_sorted:
+            pairs = sorted(zip(self.due_dates, self.due_idxs))
+            self.due_dates = array('i', (due for due, idx in pairs))
+            self.due_idxs = array('i', (idx for due, idx in pairs))
+            self.due_sorted = True
+
+    def add_id(self, value, idx, appended):
+        (ids, idxs) = self.ids
+        if not appended:
+            self.sort_ids()
+            TodoIndex.insert_id(ids, idxs, value, idx)
+            self.ids_sorted += 1
+            return
+        # Appended lines are sorted in when the ids are next used
+        if self.ids_sorted == len(ids) and (not ids or ids[-1] <= value):
+            self.ids_sorted += 1
+        ids.append(value)
+        idxs.append(idx)
+
+    def insert_id(ids, idxs, value, idx):
+        # Ordered by id, then line
+        start = bisect.bisect_left(ids, value)
+        end = bisect.bisect_right(ids, value, start)
+        pos = bisect.bisect_left(idxs, idx, start, end)
+        ids.insert(pos, value)
+        idxs.insert(pos, idx)
+
+    def remove_id(self, value, idx):
+        (ids, idxs) = self.ids
+        self.sort_ids()
+        pos = bisect.bisect_left(ids, value)
+        while pos < len(ids) and ids[pos] == value:
+            if idxs[pos] == idx:
+                del ids[pos]
+                del idxs[pos]
+                self.ids_sorted -= 1
+                return
+            pos += 1
+
+    def sort_ids(self):
+        from array import array
+        (ids, idxs) = self.ids
+        start = self.ids_sorted
+        if start == len(ids):
+            return
+        if (len(ids) - start) * 32 < len(ids):
+            # A few lines were added (todo add), move them into place
+            tail = sorted(zip(ids[start:], idxs[start:]))
+            del ids[start:]
+            del idxs[start:]
+            for value, idx in tail:
+                TodoIndex.insert_id(ids, idxs, value, idx)
+        else:
+            pairs = sorted(zip(ids, idxs))
+            ids[:] = [value for value, idx in pairs]
+            idxs[:] = array('i', (idx for value, idx in pairs))
+        self.ids_sorted = len(ids)
+
+    def find_id(self, value, prefix=False):
+        """Ascending line numbers of the todos with id value, or when there
+        are none and prefix is set, with an id starting with value."""
+        self.sort_ids()
+        (ids, idxs) = self.ids
+        start = bisect.bisect_left(ids, value)
+        end = bisect.bisect_right(ids, value, start)
+        if start == end and prefix:
+            end = bisect.bisect_left(ids, value + '\U0010ffff', start)
+        return sorted(idxs[start:end])
+
+    def split_words(text):
+        if TodoIndex.word is None:
+            import re
+            TodoIndex.word = re.compile(r'\w+')
+        return TodoIndex.word.findall(text)
+
+    def words_of(description):
+        """The distinct words of a description, as they are indexed."""
+        return set(TodoIndex.split_words(description))
+
+    def search(self, word, prefix=False, fold=False):
+        """Line numbers of the descriptions with word, or with a word
+        starting with it when prefix is set, ignoring case when fold is set
+        (then word is expected to be casefolded already)."""
+        if not prefix and not fold:
+            return self.tokens.get(word, ())
+        if prefix:
+            found = [
+                posting for token, posting in self.tokens.items()
+                if (token.casefold() if fold else token).startswith(word)
+            ]
+        else:
+            found = [
+                posting for token, posting in self.tokens.items()
+                if token.casefold() == word
+            ]
+        if len(found) == 1:
+            return found[0]
+        result = set()
+        for posting in found:
+            result.update(posting)
+        return result
+
+    def lookup(self, category=None, project=None, due=None, finished=True,
+               labels=None, words=None, fold=False):
+        """Return the ascending line numbers of the matched todos passing the
+        filters, or None when no filter narrows the search. words are (word,
+        prefix) pairs that must all be found, see search."""
+        postings = []
+        if category:
+            postings.append(self.categories.get(category, ()))
+        if project:
+            postings.append(self.projects.get(project, ()))
+        for key, value in (labels or {}).items():
+            if key == 'id':
+                postings.append(self.find_id(value))
+            else:
+                postings.append(self.labels.get(key, {}).get(value, ()))
+        for word, prefix in words or ():
+            postings.append(self.search(word, prefix, fold))
+        if due:
+            self.sort_due()
+            pos = bisect.bisect_right(self.due_dates, due.toordinal())
+            postings.append(self.due_idxs[:pos])
+        if not postings:
+            return None
+
+        postings.sort(key=len)
+        result = set(postings[0])
+        for posting in postings[1:]:
+            result.intersection_update(posting)
+        if not finished:
+            result.difference_update(self.done)
+        return sorted(result)
+
+    def dump(self):
+        self.sort_due()
+        return marshal.dumps((
+            self.count,
+            [self.dump_section(name) for name in TodoIndex.sections],
+            self.due_dates.tobytes(),
+            self.due_idxs.tobytes(),
+            self.done.tobytes(),
+            self.warnings,
+        ))
+
+    def load(data):
+        from array import array
+        (count, sections, due_dates, due_idxs, done,
+         warnings) = marshal.loads(data)
+        index = TodoIndex()
+        index.count = count
+        for name, section in zip(TodoIndex.sections, sections):
+            delattr(index, name)
+            index.lazy[name] = section
+        index.due_dates = array('i', due_dates)
+        index.due_idxs = array('i', due_idxs)
+        index.done = array('i', done)
+        index.warnings = list(warnings)
+        return index
+
+
 class Dotfile:
+    # The parsed dotfile is cached next to it, see TodoCache.racy_ns
+    version = 5
+
     def __init__(self, filename):
         self.show_default = []
         self.custom_labels = {}
         self.todo_path = None
-        self.read_dotfile(filename)
+        self.done_path = None
+        # Processes parsing todo.txt, None for one per available CPU
+        self.workers = None
+        # Auto-archive policy, see auto_archive
+        self.archive_days = None
+        self.archive_count = None
+        # How todos are split into shards, see TodoShards
+        self.shard_by = None
+        # Named views by name, [ls options, columns or None], see TodoView
+        self.views = {}
+        if not self.load_cache(filename):
+            self.read_dotfile(filename)
+            self.save_cache(filename)
+
+    def load_cache(self, filename):
+        try:
+            stat = os.stat(filename)
+            with open(filename + '.cache', 'rb') as cache_file:
+                (version, mtime_ns, size, written_ns, show_default,
+                 custom_labels, todo_path, done_path, workers, archive_days,
+                 archive_count, shard_by,
+                 views) = marshal.loads(cache_file.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            return False
+        if (version != Dotfile.version or mtime_ns != stat.st_mtime_ns
+                or size != stat.st_size
+                or written_ns - mtime_ns <= TodoCache.racy_ns):
+            return False
+        self.show_default = show_default
+        for key, width, name, t in custom_labels:
+            self.custom_labels[key] = TodoPrinter.Property(False, width, name, t)
+        self.todo_path = todo_path
+        self.done_path = done_path
+        self.workers = workers
+        self.archive_days = archive_days
+        self.archive_count = archive_count
+        self.shard_by = shard_by
+        self.views = views
+        return True
+
+    def save_cache(self, filename):
+        try:
+            stat = os.stat(filename)
+            now = time.time_ns()
+            # It would not be trusted, see load_cache
+            if now - stat.st_mtime_ns <= TodoCache.racy_ns:
+                return
+            data = marshal.dumps(
+                (Dotfile.version, stat.st_mtime_ns, stat.st_size,
+                 now, self.show_default,
+                 [(key, prop.width, prop.name, prop.type)
+                  for key, prop in self.custom_labels.items()],
+                 self.todo_path, self.done_path, self.workers,
+                 self.archive_days, self.archive_count, self.shard_by,
+                 self.views))
+            temp_path = '{}.cache~{}'.format(filename, os.getpid())
+            with open(temp_path, 'wb') as cache_file:
+                cache_file.write(data)
+            os.replace(temp_path, filename + '.cache')
+        except OSError:
+            pass
 
     def read_dotfile(self, filename):
-        if Path(filename).is_file():
-            pattern = re.compile(r'(.+)=(.+)', re.MULTILINE | re.DOTALL)
+        if os.path.isfile(filename):
+            import re
+            pattern = re.compile(r'(.+?)=(.+)', re.MULTILINE | re.DOTALL)
             with open(filename, 'r') as dotfile:
                 for line in dotfile.readlines():
                     match = pattern.match(line)
@@ -314,12 +1696,63 @@ class Dotfile:
                             self.handle_custom_label(match.group(2))
                         elif prop == 'todo-dir':
                             self.todo_path = match.group(
-                                2) + os.path.sep + 'todo.txt'
+                                2).strip() + os.path.sep + 'todo.txt'
+                        elif prop in ('workers', 'archive-days',
+                                      'archive-count'):
+                            self.handle_number(prop, match.group(2).strip())
+                        elif prop == 'shard-by':
+                            self.handle_shard_by(match.group(2).strip())
+                        elif prop.startswith('view.'):
+                            self.handle_view(prop, match.group(2).strip())
 
         if not self.todo_path:
             self.todo_path = os.path.expanduser('~') + os.path.sep + 'todo.txt'
+        self.done_path = os.path.join(os.path.dirname(self.todo_path),
+                                      'done.txt')
+
+    def handle_number(self, prop, value):
+        try:
+            number = int(value)
+        except ValueError:
+            print('Invalid {}: {}'.format(prop, value))
+            return
+        if prop == 'workers':
+            self.workers = max(1, number)
+        elif prop == 'archive-days':
+            self.archive_days = max(0, number)
+        else:
+            self.archive_count = max(0, number)
+
+    def handle_shard_by(self, value):
+        kind, _, arg = value.partition(':')
+        if ((kind == 'project' and not arg) or (kind == 'label' and arg)
+                or (kind == 'hash' and arg.isdigit() and int(arg) > 0)):
+            self.shard_by = value
+        else:
+            print('Invalid shard-by: {}'.format(value))
+
+    def handle_view(self, prop, value):
+        import re
+        match = re.match(r'view\.(\w+)(\.columns)?$', prop)
+        if not match:
+            print('Invalid view option: {}'.format(prop))
+            return
+        view = self.views.setdefault(match.group(1), ['', None])
+        if match.group(2):
+            view[1] = [s.strip() for s in value.split(',')]
+        else:
+            view[0] = value
+
+    def shard(self, todo_path):
+        """This config for the single shard todo_path."""
+        import copy
+        config = copy.copy(self)
+        config.todo_path = todo_path
+        config.shard_by = None
+        return config
 
     def handle_custom_label(self, label_str):
+        import re
         for match in re.finditer(r'(\{[^\}]*\})', label_str):
             fields = re.search(
                 r'id:\s*([A-Za-z0-9_]+),\s*width:\s*(\d+),\s*name:\s*([A-Za-z0-9_]+),\s*type:\s*([A-Za-z]+)',
@@ -330,6 +1763,108 @@ class Dotfile:
                     fields.group(4))
 
 
+class TodoStats:
+    """Wall time per phase and counters of the running command, reported by
+    --timings and readable by anything running commands in-process (see
+    snapshot). Time is attributed to the innermost active phase only, so
+    the phases add up to the total. While disabled the hooks return at once
+    and iterate() hands back the iterable unwrapped."""
+    enabled = False
+    times = {}
+    counts = {}
+    # [phase, time it was last entered or resumed]
+    stack = []
+
+    def enable():
+        TodoStats.enabled = True
+        TodoStats.times = {}
+        TodoStats.counts = {}
+        TodoStats.stack = [['other', time.perf_counter()]]
+
+    def disable():
+        TodoStats.enabled = False
+
+    def start(name):
+        now = time.perf_counter()
+        top = TodoStats.stack[-1]
+        TodoStats.times[top[0]] = TodoStats.times.get(top[0],
+                                                      0) + now - top[1]
+        TodoStats.stack.append([name, now])
+
+    def stop():
+        now = time.perf_counter()
+        (name, started) = TodoStats.stack.pop()
+        TodoStats.times[name] = TodoStats.times.get(name, 0) + now - started
+        TodoStats.stack[-1][1] = now
+
+    class Phase:
+        def __init__(self, name):
+            self.name = name
+            self.enabled = False
+
+        def __enter__(self):
+            self.enabled = TodoStats.enabled
+            if self.enabled:
+                TodoStats.start(self.name)
+
+        def __exit__(self, *exc_info):
+            if self.enabled:
+                TodoStats.stop()
+
+    def phase(name):
+        return TodoStats.Phase(name)
+
+    def iterate(name, iterable, counter=None):
+        """Attribute the time spent producing the items of iterable to
+        phase name, and count them as counter."""
+        if not TodoStats.enabled:
+            return iterable
+        return TodoStats.timed_iter(name, iterable, counter)
+
+    def timed_iter(name, iterable, counter):
+        iterator = iter(iterable)
+        count = 0
+        try:
+            while True:
+                TodoStats.start(name)
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    TodoStats.stop()
+                count += 1
+                yield item
+        finally:
+            if counter:
+                TodoStats.count(counter, count)
+
+    def count(name, n=1):
+        if TodoStats.enabled:
+            TodoStats.counts[name] = TodoStats.counts.get(name, 0) + n
+
+    def snapshot():
+        """The phase times (seconds) and counters so far."""
+        times = dict(TodoStats.times)
+        if TodoStats.enabled:
+            (name, started) = TodoStats.stack[-1]
+            times[name] = times.get(name, 0) + time.perf_counter() - started
+        return {'times': times, 'counts': dict(TodoStats.counts)}
+
+    def report(out=None):
+        out = out or sys.stderr
+        stats = TodoStats.snapshot()
+        total = sum(stats['times'].values()) or 1
+        out.write('{:<16} {:>10} {:>6}\n'.format('phase', 'ms', '%'))
+        for name, seconds in sorted(stats['times'].items(),
+                                    key=lambda item: -item[1]):
+            out.write('{:<16} {:>10.2f} {:>6.1f}\n'.format(
+                name, seconds * 1000, seconds * 100 / total))
+        out.write('{:<16} {:>10.2f}\n'.format('total', total * 1000))
+        for name, count in stats['counts'].items():
+            out.write('{:<16} {:>10}\n'.format(name, count))
+
+
 def create_todofile(file_path):
     if input(
             '{} does not exist. Do you wish to create an empty todo.txt file at this location? (y/n): '
@@ -347,111 +1882,149 @@ def create_todofile(file_path):
 
 
 def load_todos(config):
-    if not Path(config.todo_path).is_file() and not create_todofile(
-            config.todo_path):
-        return []
+    with paused_gc(), TodoStats.phase('load'):
+        return list(
+            TodoStats.iterate('load', iter_todos(config), 'lines read'))
 
-    todos = []
-    with open(os.path.expanduser('~') + '/' + 'todo.txt', 'r+') as todo_file:
-        for idx, line in enumerate(todo_file.readlines()):
-            try:
-                match = re.match(
-                    r'(x )?(\([A-Z]\) )?([0-9]{4}-[0-9]{2}-[0-9]{2} )?([0-9]{4}-[0-9]{2}-[0-9]{2} )?(.*)',
-                    line)
-                if match:
-                    # Remove all categories, projects and custom labels
-                    description = re.sub(
-                        r'\s(\+[A-Za-z0-9\-_]+)|(@[A-Za-z0-9\-_]+)', ' ',
-                        match.group(5))
-                    description = re.sub(
-                        r'\s[A-Za-z0-9\-_]+[:]{1}[A-Za-z0-9\-_]+', ' ',
-                        description)
-
-                    todo = Todo(description.strip())
-                    todo.set_idx(idx)
-
-                    if match.group(2):
-                        todo.set_prio(match.group(2)[1])
-
-                    # Match dates, categories, projects and custom labels
-                    if match.group(1):  # Marks done
-                        todo.set_done(True)
-                        if match.group(3):  # One date exists
-                            # We are not allowed to have a completed date without a created date
-                            if match.group(4):
-                                todo.set_done_date(
-                                    datetime.strptime(
-                                        match.group(3).rstrip(), '%Y-%m-%d'))
-                                todo.set_created(
-                                    datetime.strptime(
-                                        match.group(4).rstrip(), '%Y-%m-%d'))
-                            else:
-                                raise RuntimeError(
-                                    'Todo marked as done but has ONE date (should have 2 or none): "{}"'
-                                    .format(line.rstrip()))
-                    else:
-                        if match.group(3) and not match.group(4):
-                            todo.set_created(
-                                datetime.strptime(
-                                    match.group(3).rstrip(), '%Y-%m-%d'))
-                        elif match.group(4):
-                            raise RuntimeError(
-                                'Todo is not marked as done but has 2 dates: "{}"'
-                                .format(line.rstrip()))
-                    category_match = re.findall(r'\s\@[A-Za-z0-9_\-]+',
-                                                match.group(5))
-                    for category in category_match:
-                        todo.add_category(category.strip()[1:])
-
-                    project_match = re.findall(r'\s\+[A-Za-z0-9_\-]+',
-                                               match.group(5))
-
-                    for project in project_match:
-                        todo.add_project(project.strip()[1:])
-
-                    label_match = re.findall(
-                        r'\s[A-Za-z0-9\-_]+[:]{1}[A-Za-z0-9\-_]+',
-                        match.group(5))
-
-                    for label in label_match:
-                        key, value = tuple(label.strip().split(':'))
-                        if key == 'due':
-                            todo.set_due(datetime.strptime(value, '%Y-%m-%d'))
-                        else:
-                            todo.add_label(key, value)
-
-                    todos.append(todo)
-                else:
-                    raise RuntimeError('Could not match line: {}'.format(
-                        line.rstrip()))
-            except RuntimeError as err:
-                todo.matched = False
-                todo.line = line
-                todos.append(todo)
-                print('[WARN] {}'.format(err))
 
-    return todos
+class paused_gc:
+    # Loading allocates a few objects per line but no reference cycles, so the
+    # cyclic garbage collector is held off instead of rescanning every batch
+    def __enter__(self):
+        self.enabled = gc.isenabled()
+        gc.disable()
+
+    def __exit__(self, *exc_info):
+        if self.enabled:
+            gc.enable()
+
+
+def iter_todos(config, lookup=None):
+    """Yield the todos of config.todo_path one at a time, see iter_records."""
+    for idx, record in iter_records(config, lookup):
+        yield TodoCache.from_record(idx, record)
+
+
+def iter_records(config, lookup=None, todo_path=None):
+    """Yield (idx, record) for the lines of config.todo_path (or todo_path)
+    one at a time, from the cache when it is fresh and otherwise while
+    parsing and refreshing the cache. Warnings for malformed lines are
+    printed as they are read.
+
+    lookup is an optional function from a TodoIndex to the line numbers worth
+    reading (see TodoIndex.lookup). It is only a hint, other lines may still
+    be yielded when the cache has to be rebuilt."""
+    todo_path = todo_path or config.todo_path
+    if not os.path.isfile(todo_path) and not create_todofile(todo_path):
+        return
+
+    TodoJournal(todo_path).recover()
+    cache = TodoCache(todo_path)
+    with open(todo_path, 'rb') as todo_file:
+        stat = os.fstat(todo_file.fileno())
+        cached = cache.load()
+        if cached and cached.is_fresh(stat):
+            idxs = None
+            if lookup:
+                index = cached.load_index()
+                idxs = lookup(index)
+            if idxs is None:
+                records = enumerate(cached.iter_records())
+            else:
+                for idx, warning in index.warnings:
+                    print(warning)
+                records = cached.iter_records_at(idxs)
+            for idx, record in records:
+                if not record[9]:
+                    print(record[-1])
+                yield (idx, record)
+            return
+
+        if cached and cached.is_prefix_of(todo_file, stat):
+            # Unchanged or only appended to, parse the tail
+            writer = cache.writer(cached)
+            records = cached.iter_records()
+        else:
+            todo_file.seek(0)
+            writer = cache.writer()
+            records = ()
+
+        try:
+            idx = 0
+            for record in records:
+                if not record[9]:
+                    print(record[-1])
+                yield (idx, record)
+                idx += 1
+
+            # The cache gets the hashes of the bytes parsed, todo.txt may
+            # be changed in place while it is read
+            chunks = TodoCache.parse_lines(todo_file, stat.st_size,
+                                           config.workers)
+            for digest, lines in chunks:
+                for offset, record in lines:
+                    writer.add(record, offset)
+                    if not record[9]:
+                        print(record[-1])
+                    yield (idx, record)
+                    idx += 1
+                writer.flush(digest)
+
+            writer.commit(stat.st_mtime_ns, todo_file.tell(), todo_file)
+        finally:
+            writer.discard()
 
 
 def write_todo_file(config, todos):
-    temp_path = os.path.basename(config.todo_path) + '~todo.txt'
+    """Replace todo.txt with todos in one step: they are written to a
+    temporary file next to it, synced and moved over it."""
+    temp_path = '{}~{}'.format(config.todo_path, os.getpid())
     try:
-        with open(temp_path, 'w+') as todo_file:
-            for todo in todos:
-                todo_file.write(str(todo))
-    except:
+        with open(temp_path, 'w') as todo_file, TodoStats.phase('write'):
+            data = ''.join(str(todo) for todo in todos)
+            TodoStats.count('bytes written', len(data))
+            todo_file.write(data)
+            todo_file.flush()
+            os.fsync(todo_file.fileno())
+    except OSError:
         print("Failed to write content to todo.txt tmp file")
+        remove_file(temp_path)
         exit()
 
     try:
-        shutil.move(temp_path, config.todo_path)
-    except:
+        os.replace(temp_path, config.todo_path)
+    except OSError:
         print("Failed to overwrite todo.txt with modifications")
+        remove_file(temp_path)
         exit()
+    sync_dir(config.todo_path)
 
 
-def add_todo(config, prio, created_date, description, projects, categories,
-             due):
+def append_lines(path, lines):
+    """Append encoded lines to path, the first one on a line of its own, and
+    sync them. Callers hold the TodoLock of path."""
+    TodoStats.count('bytes written', sum(len(line) for line in lines))
+    with open(path, 'a+b') as append_file, TodoStats.phase('write'):
+        if append_file.tell() > 0:
+            append_file.seek(append_file.tell() - 1)
+            if append_file.read(1) != b'\n':
+                append_file.write(os.linesep.encode(file_encoding()))
+        for line in lines:
+            append_file.write(line)
+            if not line.endswith(b'\n'):
+                append_file.write(os.linesep.encode(file_encoding()))
+        append_file.flush()
+        os.fsync(append_file.fileno())
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def create_todo(prio, created_date, description, projects, categories, due):
     todo = Todo(description)
 
     for c in categories:
@@ -464,217 +2037,2957 @@ def add_todo(config, prio, created_date, description, projects, categories,
         todo.add_project(p)
 
     todo.set_due(due)
+    todo.add_label('id', new_id())
+    return todo
+
+
+def add_todo(config, prio, created_date, description, projects, categories,
+             due):
+    """Append a new todo, to its shard in a sharded workspace. Returns the
+    config of the file it went to."""
+    todo = create_todo(prio, created_date, description, projects, categories,
+                       due)
+    if config.shard_by:
+        config = config.shard(TodoShards.path_for(config, todo))
 
-    with open(config.todo_path, 'a+') as todo_file:
-        todo_file.write(str(todo))
+    line = str(todo).replace('\n', os.linesep).encode(file_encoding())
+    with TodoLock(config.todo_path):
+        # A fresh cache is caught up at once, so that the next read only
+        # has to check the hashes of its chunks instead of parsing the line
+        cache = TodoCache(config.todo_path)
+        entry = cache.load()
+        try:
+            fresh = entry and entry.is_fresh(os.stat(config.todo_path))
+        except OSError:
+            fresh = False
+        append_lines(config.todo_path, [line])
+        if fresh:
+            cache.append(entry, config.todo_path)
+    print('Added {}'.format(todo.labels['id']))
+    return config
 
 
-def ls_todo(config, category, project, due, finished):
-    todos = load_todos(config)
-    filtered = []
-    for todo in todos:
-        include = todo.matched
+def record_filter(category, project, due, finished):
+    due = due.toordinal() if due else None
+
+    def include(item):
+        (done, prio, done_date, created_date, todo_due, description,
+         categories, projects, labels, matched, line, warning) = item[1]
+        if not matched:
+            return False
         # check for category
-        if category:
-            include = include and category in todo.categories
+        if category and category not in categories:
+            return False
         # check for project
-        if project:
-            include = include and project in todo.projects
+        if project and project not in projects:
+            return False
         # check for due
-        if due:
-            if todo.due:
-                include = include and todo.due.date() <= due.date()
-            else:
-                include = False
+        if due and not (todo_due and todo_due <= due):
+            return False
         # check for finished
-        if not finished:
-            include = include and not todo.done
+        if not finished and done:
+            return False
+        return True
 
-        if include:
-            filtered.append(todo)
+    return include
 
-    filtered.sort(key=lambda t: t.due if t.due else datetime.max)
-    filtered.sort(key=lambda t: t.prio if t.prio else 'Z')
 
-    props = TodoPrinter.Properties()
-    for k, v in config.custom_labels.items():
-        props.__dict__[k] = v
+class TodoSorter:
+    """Orders (idx, record) pairs on a composite key such as prio,due,~created
+    where ~ (or -) marks a descending field. Fields are compared as small
+    ints: priorities as 0-25 (none counts as Z) and dates as ordinals, where
+    todos without the date always go last. Large selections are sorted with
+    NumPy when it is installed, others with one stable sort per field from
+    the last to the first, which is quicker in Python than a single sort on
+    a tuple key."""
+    # field: position in the record, None for the line number
+    fields = {
+        'prio': 1,
+        'completed': 2,
+        'created': 3,
+        'due': 4,
+        'idx': None,
+    }
+    default = 'prio,due'
+    numpy_threshold = 50000
 
-    if len(config.show_default) > 0:
-        for field in config.show_default:
-            if field in props.__dict__:
-                props.__dict__[field].show = True
-    else:
-        props = TodoPrinter.Properties.get_default()
+    def __init__(self, keys=None):
+        self.keys = keys or TodoSorter.parse(TodoSorter.default)
 
-    printer = TodoPrinter(props)
-    printer.print_todos(filtered)
+    def parse(spec):
+        keys = []
+        for field in spec.split(','):
+            field = field.strip()
+            # -due reads as an option on the command line, ~due does not
+            descending = field[:1] in ('-', '~')
+            field = field.lstrip('+-~')
+            if field not in TodoSorter.fields:
+                import argparse
+                raise argparse.ArgumentTypeError(
+                    'unknown sort field {} (choose from {})'.format(
+                        field, ', '.join(TodoSorter.fields)))
+            keys.append((field, descending))
+        return keys
 
-    return
+    def value(item, field):
+        if field == 'idx':
+            return item[0]
+        value = item[1][TodoSorter.fields[field]]
+        if field == 'prio':
+            return ord(value) - ord('A') if value else 25
+        return value
 
+    def key(self, item):
+        key = ()
+        for field, descending in self.keys:
+            value = TodoSorter.value(item, field)
+            missing = field not in ('prio', 'idx') and not value
+            key += (missing, -value if descending else value)
+        return key
 
-def get_todo_from_line(todos, line):
-    idx_ = [idx for idx, value in enumerate(todos) if idx == int(line)]
+    def select(self, items, limit=None):
+        """Return the items in order, only the first limit when given."""
+        import heapq
+        numpy = None
+        if limit is None or limit >= TodoSorter.numpy_threshold:
+            items = list(items)
+            if len(items) >= TodoSorter.numpy_threshold:
+                try:
+                    import numpy
+                except ImportError:
+                    pass
+        if numpy:
+            order = numpy.lexsort(self.columns(numpy, items))
+            return [items[i] for i in order[:limit]]
+        if limit is not None:
+            return heapq.nsmallest(limit, items, key=self.key)
+        items = list(items)
+        for field, descending in reversed(self.keys):
+            # reverse keeps equal items in order, so the sort stays stable
+            items.sort(key=TodoSorter.getter(field, descending),
+                       reverse=descending)
+        return items
 
-    if len(idx_) > 0:
-        idx = idx_[0]
-        return todos[idx]
-    else:
-        print('No match for line no: {}'.format(line))
+    def getter(field, descending):
+        """The sort key of a single field, missing dates last either way."""
+        if field == 'idx':
+            return lambda item: item[0]
+        pos = TodoSorter.fields[field]
+        if field == 'prio':
+            return lambda item: item[1][pos] or 'Z'
+        missing = -1 if descending else sys.maxsize
+        return lambda item: item[1][pos] or missing
 
+    def columns(self, numpy, items):
+        # numpy.lexsort sorts on the last column first
+        columns = []
+        for field, descending in reversed(self.keys):
+            values = numpy.fromiter(
+                (TodoSorter.value(item, field) for item in items),
+                dtype=numpy.int64,
+                count=len(items))
+            columns.append(-values if descending else values)
+            if field not in ('prio', 'idx'):
+                columns.append(values == 0)
+        return columns
 
-def remove_todo(config, line):
-    todos = load_todos(config)
-    todo = [get_todo_from_line(todos, line)]
 
-    printer = TodoPrinter(
-        TodoPrinter.Properties.get_default().show_done().show_done_date())
-    printer.print_todos(todo)
+class TodoQuery:
+    """Filter expressions for ls such as
 
-    c = input('Are you sure you want to PERMANENTLY remove this Todo? (y/n): ')
-    if c == 'y':
-        todos = filter(lambda t: t.idx != int(line), todos)
-        write_todo_file(config, todos)
+        prio<=B and (+infra or @oncall) and jira~TODO-1* and due<today+7
 
+    Terms are +project, @context, done, a word or "quoted text" found in the
+    description, and comparisons field op value with op one of = != < <= >
+    >= and ~ (glob match). Fields are prio, due, created, completed, idx,
+    description and any label, compared with the type declared for it in
+    custom-labels (str when not declared). Dates are YYYY-MM-DD or today,
+    optionally +/- a number of days. Terms combine with and, or, not and
+    parentheses.
+
+    The expression is parsed once and compiled into a single Python function
+    of (idx, record). The +project, @context, label= and due< terms every
+    match needs are also collected as a plan for TodoIndex.lookup."""
+    pattern = None
+    operators = ('<=', '>=', '!=', '=', '<', '>', '~')
+    # field: position in the record, None for the line number
+    fields = {
+        'prio': 1,
+        'completed': 2,
+        'created': 3,
+        'due': 4,
+        'description': 5,
+        'idx': None,
+    }
+    dates = ('completed', 'created', 'due')
+    types = {'int': int, 'float': float, 'str': str}
+
+    def __init__(self, text, custom_labels=None):
+        if TodoQuery.pattern is None:
+            import re
+            TodoQuery.pattern = re.compile(
+                r'\s*(?:(<=|>=|!=|[()=<>~])|"([^"]*)"|\'([^\']*)\''
+                r'|([^\s()<>=!~"\']+))')
+        self.custom_labels = custom_labels or {}
+        self.constants = {'_label': TodoQuery.label}
+        self.tokenize(text)
+        tree = self.parse_or()
+        if self.pos < len(self.tokens):
+            raise ValueError('unexpected {}'.format(self.tokens[self.pos][1]))
+
+        code = ('def predicate(item):\n'
+                '    (idx, r) = item\n'
+                '    return {}\n'.format(self.source(tree)))
+        namespace = dict(self.constants)
+        exec(code, namespace)
+        self.predicate = namespace['predicate']
+        self.plan = {'category': None, 'project': None, 'due': None,
+                     'labels': {}}
+        for node in (tree[1] if tree[0] == 'and' else [tree]):
+            self.add_to_plan(node)
+
+    def tokenize(self, text):
+        # (kind, text): op, word or quoted
+        self.tokens = []
+        self.pos = 0
+        pos = 0
+        text = text.rstrip()
+        while pos < len(text):
+            match = TodoQuery.pattern.match(text, pos)
+            if not match:
+                raise ValueError('cannot read {}'.format(text[pos:]))
+            (op, double, single, word) = match.groups()
+            if op:
+                self.tokens.append(('op', op))
+            elif word is not None:
+                self.tokens.append(('word', word))
+            else:
+                self.tokens.append(
+                    ('quoted', double if double is not None else single))
+            pos = match.end()
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def take(self):
+        token = self.peek()
+        if token[0] is None:
+            raise ValueError('unexpected end of query')
+        self.pos += 1
+        return token
+
+    def keyword(self, word):
+        token = self.peek()
+        if token[0] == 'word' and token[1].lower() == word:
+            self.pos += 1
+            return True
+        return False
+
+    def parse_or(self):
+        nodes = [self.parse_and()]
+        while self.keyword('or'):
+            nodes.append(self.parse_and())
+        return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+    def parse_and(self):
+        nodes = [self.parse_not()]
+        while True:
+            if not self.keyword('and'):
+                # Terms next to each other are and-ed as well
+                (kind, text) = self.peek()
+                if kind is None or text == ')' or (
+                        kind == 'word' and text.lower() == 'or'):
+                    break
+            nodes.append(self.parse_not())
+        return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+    def parse_not(self):
+        if self.keyword('not'):
+            return ('not', self.parse_not())
+        return self.parse_term()
+
+    def parse_term(self):
+        if self.peek()[0] is None and self.pos:
+            (kind, text) = self.tokens[self.pos - 1]
+            if kind == 'word' and text.lower() in ('and', 'or', 'not'):
+                raise ValueError('missing operand of {}'.format(text))
+        (kind, text) = self.take()
+        if kind == 'op':
+            if text != '(':
+                raise ValueError('unexpected {}'.format(text))
+            node = self.parse_or()
+            if self.take() != ('op', ')'):
+                raise ValueError('missing )')
+            return node
+        if kind == 'quoted':
+            return ('text', text)
+        if text[0] in '+@' and len(text) > 1:
+            return ('project' if text[0] == '+' else 'category', text[1:])
+        (next_kind, op) = self.peek()
+        if next_kind == 'op' and op in TodoQuery.operators:
+            self.pos += 1
+            (value_kind, value) = self.take()
+            if value_kind == 'op':
+                raise ValueError('missing value after {}{}'.format(text, op))
+            return ('compare', text, op, value)
+        if text.lower() in ('and', 'or'):
+            # Quoted, they are words of the description
+            raise ValueError('missing operand of {}'.format(text))
+        if text.lower() == 'done':
+            return ('done', )
+        return ('text', text)
+
+    def constant(self, value):
+        name = '_c{}'.format(len(self.constants))
+        self.constants[name] = value
+        return name
+
+    def glob(self, pattern):
+        return self.constant(TodoQuery.glob_match(pattern))
+
+    def glob_match(pattern):
+        import fnmatch
+        import re
+        return re.compile(fnmatch.translate(pattern)).match
+
+    def is_glob(text):
+        return any(c in text for c in '*?[')
+
+    def source(self, node):
+        kind = node[0]
+        if kind in ('and', 'or'):
+            return '({})'.format(' {} '.format(kind).join(
+                self.source(child) for child in node[1]))
+        if kind == 'not':
+            return '(not {})'.format(self.source(node[1]))
+        if kind == 'done':
+            return 'r[0]'
+        if kind == 'text':
+            return '({!r} in r[5].lower())'.format(node[1].lower())
+        if kind in ('project', 'category'):
+            pos = 7 if kind == 'project' else 6
+            if TodoQuery.is_glob(node[1]):
+                return 'any(map({}, r[{}]))'.format(self.glob(node[1]), pos)
+            return '({!r} in r[{}])'.format(node[1], pos)
+        return self.compare_source(*node[1:])
+
+    def date(value):
+        """Ordinal of YYYY-MM-DD or today[+-N]."""
+        if value.lower().startswith('today'):
+            offset = value[5:]
+            try:
+                # int() alone would take today7 or today+ 7
+                if offset and not (offset[0] in '+-'
+                                   and offset[1:].isdigit()):
+                    raise ValueError
+                return datetime.today().toordinal() + (int(offset)
+                                                       if offset else 0)
+            except ValueError:
+                raise ValueError('invalid date {}'.format(value))
+        try:
+            return datetime.strptime(value, '%Y-%m-%d').toordinal()
+        except ValueError:
+            raise ValueError('invalid date {}'.format(value))
+
+    def compare_source(self, field, op, value):
+        py_op = '==' if op == '=' else op
+        if field in TodoQuery.dates:
+            if op == '~':
+                raise ValueError('{} cannot be matched with ~'.format(field))
+            return '(r[{0}] and r[{0}] {1} {2})'.format(
+                TodoQuery.fields[field], py_op, TodoQuery.date(value))
+        if field == 'idx':
+            try:
+                return '(idx {} {})'.format(py_op, int(value))
+            except ValueError:
+                raise ValueError('invalid line number {}'.format(value))
+        if field in ('prio', 'description'):
+            pos = TodoQuery.fields[field]
+            if field == 'prio':
+                value = value.upper()
+            if op == '~':
+                return '(r[{0}] and {1}(r[{0}]) is not None)'.format(
+                    pos, self.glob(value))
+            return '(r[{0}] and r[{0}] {1} {2!r})'.format(pos, py_op, value)
+
+        # A label, compared as the type declared in custom-labels
+        prop = self.custom_labels.get(field)
+        cast = TodoQuery.types.get(prop.type if prop else 'str', str)
+        if op == '~':
+            return '{}(_label(r[8], {!r}))'.format(
+                self.constant(TodoQuery.globbed(TodoQuery.glob_match(value))),
+                field)
+        try:
+            value = cast(value)
+        except ValueError:
+            raise ValueError('{} is not a valid {} for {}'.format(
+                value, cast.__name__, field))
+        if cast is str and op == '=':
+            return '(_label(r[8], {!r}) == {!r})'.format(field, value)
+        return '{}(_label(r[8], {!r}))'.format(
+            self.constant(TodoQuery.typed(cast, py_op, value)), field)
+
+    def globbed(match):
+        def test(label):
+            return label is not None and match(label) is not None
+
+        return test
+
+    def typed(cast, py_op, value):
+        import operator
+        compare = {
+            '==': operator.eq,
+            '!=': operator.ne,
+            '<': operator.lt,
+            '<=': operator.le,
+            '>': operator.gt,
+            '>=': operator.ge
+        }[py_op]
+
+        def test(label):
+            try:
+                return label is not None and compare(cast(label), value)
+            except ValueError:
+                return False
+
+        return test
+
+    def label(labels, key):
+        for label_key, value in labels:
+            if label_key == key:
+                return value
+        return None
+
+    def add_to_plan(self, node):
+        """Add a term every match has to satisfy to the lookup plan."""
+        kind = node[0]
+        if kind in ('project', 'category') and not TodoQuery.is_glob(node[1]):
+            self.plan[kind] = self.plan[kind] or node[1]
+        elif kind == 'compare':
+            (field, op, value) = node[1:]
+            if field == 'due' and op in ('<', '<='):
+                cutoff = TodoQuery.date(value) - (op == '<')
+                if not self.plan['due'] or cutoff < self.plan['due'].toordinal(
+                ):
+                    self.plan['due'] = datetime.fromordinal(cutoff)
+            elif op == '=' and field not in TodoQuery.fields and (
+                    field not in self.custom_labels
+                    or self.custom_labels[field].type == 'str'):
+                self.plan['labels'].setdefault(field, value)
+
+
+class TodoExport:
+    """Writes (idx, record) pairs for other programs rather than as a table,
+    as JSON Lines, CSV, TSV or todo.txt lines. Rows are formatted straight
+    from the records, with ISO dates and custom labels converted to their
+    type, and written chunk_size rows at a time."""
+    formats = ('jsonl', 'csv', 'tsv', 'raw')
+    dialects = {'csv': 'excel', 'tsv': 'excel-tab'}
+    columns = ('idx', 'done', 'prio', 'completed', 'created', 'due',
+               'description', 'categories', 'projects')
+    chunk_size = 4096
+    # json.dumps of the dict with these keys, without building the dict
+    json_format = ('{{"idx": {}, "done": {}, "prio": {}, "completed": {}, '
+                   '"created": {}, "due": {}, "description": {}, '
+                   '"categories": [{}], "projects": [{}], "labels": {{{}}}}}')
+
+    class Dates(dict):
+        """Formatted ISO dates by ordinal, computed on first use."""
+        def __init__(self, fmt, missing):
+            super().__init__({0: missing})
+            self.fmt = fmt
+
+        def __missing__(self, ordinal):
+            value = self[ordinal] = self.fmt.format(
+                datetime.fromordinal(ordinal).date().isoformat())
+            return value
+
+    def __init__(self, fmt, custom_labels=None, out=None):
+        self.fmt = fmt
+        self.out = out or sys.stdout
+        custom_labels = custom_labels or {}
+        self.custom = list(custom_labels)
+        self.types = {
+            key: TodoQuery.types.get(prop.type, str)
+            for key, prop in custom_labels.items()
+            if TodoQuery.types.get(prop.type, str) is not str
+        }
+        if fmt == 'jsonl':
+            self.dates = TodoExport.Dates('"{}"', 'null')
+        else:
+            self.dates = TodoExport.Dates('{}', '')
+
+    def write(self, records):
+        if self.fmt in TodoExport.dialects:
+            write = self.write_delimited
+            self.write_rows([self.columns + tuple(self.custom) + ('labels', )])
+        else:
+            write = getattr(self, 'write_' + self.fmt)
+        records = iter(records)
+        while True:
+            chunk = list(itertools.islice(records, TodoExport.chunk_size))
+            if not chunk:
+                break
+            write(chunk)
+        self.out.flush()
+
+    def write_jsonl(self, chunk):
+        import json
+        from json.encoder import encode_basestring_ascii as quote
+        dates = self.dates
+        types = self.types
+        row = TodoExport.json_format.format
+        lines = []
+        for idx, record in chunk:
+            (done, prio, done_date, created_date, due, description,
+             categories, projects, labels, matched, line, warning) = record
+            if labels:
+                labels = ', '.join([
+                    quote(key) + ': ' +
+                    (json.dumps(self.label(key, value))
+                     if key in types else quote(value))
+                    for key, value in labels
+                ])
+            lines.append(
+                row(idx, 'true' if done else 'false',
+                    quote(prio) if prio else 'null', dates[done_date],
+                    dates[created_date], dates[due], quote(description),
+                    ', '.join(map(quote, categories)),
+                    ', '.join(map(quote, projects)), labels or ''))
+        lines.append('')
+        self.out.write('\n'.join(lines))
+
+    def label(self, key, value):
+        try:
+            typed = self.types[key](value)
+        except ValueError:
+            return value
+        # nan and inf are not JSON numbers, they stay the text they were
+        if typed != typed or abs(typed) == float('inf'):
+            return value
+        return typed
+
+    def write_delimited(self, chunk):
+        dates = self.dates
+        custom = self.custom
+        rows = []
+        for idx, record in chunk:
+            (done, prio, done_date, created_date, due, description,
+             categories, projects, labels, matched, line, warning) = record
+            row = [
+                idx, 'true' if done else 'false', prio or '',
+                dates[done_date], dates[created_date], dates[due],
+                description, ' '.join(categories), ' '.join(projects)
+            ]
+            if labels:
+                labels = dict(labels)
+                row.extend([labels.pop(key, '') for key in custom])
+                row.append(' '.join(
+                    [key + ':' + value for key, value in labels.items()]))
+            else:
+                row.extend([''] * (len(custom) + 1))
+            rows.append(row)
+        self.write_rows(rows)
+
+    def write_rows(self, rows):
+        import csv
+        import io
+        buffer = io.StringIO()
+        csv.writer(buffer, TodoExport.dialects[self.fmt]).writerows(rows)
+        self.out.write(buffer.getvalue())
+
+    def write_raw(self, chunk):
+        self.out.write(''.join([
+            str(TodoCache.from_record(idx, record)) for idx, record in chunk
+        ]))
+
+
+class TodoShards:
+    """A workspace whose todos are split over todo.txt and todo.<key>.txt
+    files in the todo-dir, following the shard-by option of the dotfile:
+    project (the first +project), label:<key> (the value of that label) or
+    hash:<N> (a hash of the id, modulo N). Todos without a key stay in
+    todo.txt. Every shard has its own cache, lock and journal, so a change
+    only rewrites the shard it touches. Line nos run on from one shard to
+    the next in the order of paths."""
+    pattern = r'todo\.[\w-]+\.txt$'
+
+    def paths(config):
+        """The shard files, todo.txt first and then the others by name."""
+        import re
+        folder = os.path.dirname(config.todo_path)
+        try:
+            names = os.listdir(folder)
+        except OSError:
+            names = []
+        paths = sorted(
+            os.path.join(folder, name) for name in names
+            if re.match(TodoShards.pattern, name))
+        if os.path.isfile(config.todo_path) or not paths:
+            paths.insert(0, config.todo_path)
+        return paths
+
+    def configs(config):
+        """A config per shard, just config when the workspace is not
+        sharded."""
+        if not config.shard_by:
+            return [config]
+        return [config.shard(path) for path in TodoShards.paths(config)]
+
+    def path_for(config, todo):
+        """The shard a new todo belongs in."""
+        import re
+        (todo, _) = TodoCache.parse_record(TodoParser(), 0, str(todo))
+        kind, _, arg = config.shard_by.partition(':')
+        if kind == 'project':
+            key = todo.projects[0] if todo.projects else None
+        elif kind == 'label':
+            key = todo.labels.get(arg)
+        else:
+            import zlib
+            key = str(
+                zlib.crc32(todo.labels.get('id', '').encode('utf-8')) %
+                int(arg))
+        if not key:
+            return config.todo_path
+        return os.path.join(os.path.dirname(config.todo_path),
+                            'todo.{}.txt'.format(re.sub(r'[^\w-]', '_', key)))
+
+    def resolver(config):
+        """Return a function from a ref to a todo in any shard (see
+        find_line) to (shard config, ref within the shard, line no across
+        the shards, line no of the first line of the shard), or None after
+        printing why there is no such todo."""
+        shards = []
+        total = 0
+        for shard in TodoShards.configs(config):
+            entry = load_cache_entry(shard)
+            if entry is None or entry.offsets is None:
+                todos = load_todos(shard)
+                count = len(todos)
+                find = todo_id_finder(todos)
+            else:
+                count = entry.count
+                find = entry.find_id
+            shards.append((shard, total, count, find))
+            total += count
+
+        def find_id(value, prefix=False):
+            # Exact matches in any shard win over prefixes
+            idxs = [
+                start + idx for shard, start, count, find in shards
+                for idx in find(value)
+            ]
+            if idxs or not prefix:
+                return idxs
+            return [
+                start + idx for shard, start, count, find in shards
+                for idx in find(value, True)
+            ]
+
+        def resolve(ref):
+            idx = find_line(ref, total, find_id)
+            if idx is None:
+                return None
+            for shard, start, count, find in shards:
+                if idx < start + count:
+                    # Ids are looked up again under the lock of the shard
+                    return (shard, str(idx - start) if ref.isdigit() else ref,
+                            idx, start)
+
+        return resolve
+
+    def select(config, spec, archive=False, limit=None, sort=True,
+               sort_keys=None):
+        """Yield the (idx, record) pairs matching spec (see query_records)
+        from all the shards, then done.txt when archive is set. The shards
+        are queried in a pool of worker processes when they are large
+        enough, each sorting and cutting its own matches to limit, and the
+        results are merged on the sort keys."""
+        import heapq
+        paths = TodoShards.paths(config)
+        if archive and os.path.isfile(config.done_path):
+            paths.append(config.done_path)
+        size = sum(
+            os.path.getsize(path) for path in paths if os.path.isfile(path))
+        workers = config.workers
+        if workers is None:
+            workers = len(os.sched_getaffinity(0)) if hasattr(
+                os, 'sched_getaffinity') else os.cpu_count() or 1
+        workers = min(workers, len(paths))
+        shard = config.shard(config.todo_path)
+        args = (spec, limit, sort, sort_keys)
+        if (workers > 1 and size >= TodoCache.parallel_size
+                and TodoCache.hot is None):
+            # Shards are parsed in a single process each
+            shard.workers = 1
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(workers) as executor:
+                results = list(
+                    executor.map(TodoShards.select_shard,
+                                 *zip(*((shard, path) + args
+                                        for path in paths))))
+        else:
+            results = [
+                TodoShards.select_shard(shard, path, *args) for path in paths
+            ]
+
+        matches = []
+        start = 0
+        for count, warnings, data in results:
+            sys.stdout.write(warnings)
+            matches.append([(start + idx, record)
+                            for idx, record in marshal.loads(data)])
+            start += count
+        if sort:
+            merged = heapq.merge(*matches, key=TodoSorter(sort_keys).key)
+        else:
+            merged = itertools.chain(*matches)
+        yield from itertools.islice(merged, limit)
+
+    def select_shard(config, todo_path, spec, limit, sort, sort_keys):
+        """Query one shard, possibly in a worker process. Returns its number
+        of lines, the warnings printed while reading it and the marshalled
+        matches in order."""
+        import contextlib
+        import io
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out), paused_gc():
+            if 'view' in spec:
+                # Already in order
+                records = TodoView.select(config.shard(todo_path),
+                                          spec['view'], limit)
+            elif sort:
+                records = TodoSorter(sort_keys).select(
+                    query_records(config, spec, todo_path), limit)
+            else:
+                records = list(
+                    itertools.islice(query_records(config, spec, todo_path),
+                                     limit))
+            count = count_lines(todo_path)
+        return (count, out.getvalue(), marshal.dumps(records))
+
+
+class TodoView:
+    """A named view of the dotfile: view.<name> holds ls filters and -s,
+    view.<name>.columns the columns to show instead of show-default. Its
+    rows are materialized in a sidecar file next to todo.txt, served as they
+    are while todo.txt is unchanged and caught up from the change log of the
+    TodoCache when lines were appended, replaced or removed since. A cache
+    rebuilt from scratch, a changed definition or a new day (for filters
+    relative to today) recompute the view."""
+    version = 1
+
+    def __init__(self, todo_path, name):
+        self.path = os.path.join(
+            os.path.dirname(todo_path),
+            '.{}.view-{}'.format(os.path.basename(todo_path), name))
+
+    def parse(config, name):
+        """Return the spec (see query_records), sort keys and columns of the
+        view name. Prints why and exits when it is undefined or invalid."""
+        if name not in config.views:
+            print('No view named {}'.format(name))
+            exit()
+        (options, columns) = config.views[name]
+        import argparse
+        import shlex
+        # The sort keys are parsed here, so that argparse never takes a
+        # descending -due for an option
+        (words, sort_keys) = ([], None)
+        it = iter(shlex.split(options))
+        for word in it:
+            (option, _, value) = word.partition('=')
+            if option not in ('-s', '--sort'):
+                words.append(word)
+                continue
+            try:
+                sort_keys = TodoSorter.parse(value or next(it, ''))
+            except argparse.ArgumentTypeError as error:
+                print('Invalid view {}: {}'.format(name, error))
+                exit()
+        args = create_parser('ls').parse_args(['ls'] + words)
+        if (args.limit is not None or not args.sort or args.archive
+                or args.fmt != 'table' or args.view):
+            print('Invalid view {}: only filters and -s can be set'.format(
+                name))
+            exit()
+        spec = {
+            'category': args.category,
+            'project': args.project,
+            'due': args.due,
+            'finished': args.finished,
+            'query': args.query
+        }
+        return (spec, sort_keys, columns)
+
+    def select(config, name, limit=None):
+        """Return the (idx, record) pairs of the view name over todo.txt in
+        order, only the first limit when given."""
+        from array import array
+        import contextlib
+        (spec, sort_keys, _) = TodoView.parse(config, name)
+        (lookup, filters) = spec_filters(config, spec)
+        sorter = TodoSorter(sort_keys)
+        key = [
+            TodoView.version, config.views[name][0],
+            datetime.today().toordinal(),
+            sorted((label, prop.type)
+                   for label, prop in config.custom_labels.items())
+        ]
+        import io
+        # Malformed lines are left to ls to warn about
+        with contextlib.redirect_stdout(io.StringIO()):
+            entry = load_cache_entry(config)
+            if entry is None:
+                # Nothing to follow, e.g. in a read-only todo-dir
+                records = query_records(config, spec)
+                with paused_gc(), TodoStats.phase('sort'):
+                    return sorter.select(records, limit)
+
+        view = TodoView(config.todo_path, name)
+        state = view.load()
+        if state is not None:
+            (state_key, lineage, generation, idxs, values) = state
+            behind = entry.generation - generation
+            if (state_key == key and lineage == entry.lineage
+                    and 0 <= behind <= len(entry.changes)):
+                if behind:
+                    with paused_gc(), TodoStats.phase('filter'):
+                        (idxs, values) = TodoView.catch_up(
+                            idxs, values,
+                            entry.changes[len(entry.changes) - behind:],
+                            entry, filters, sorter)
+                    view.save(key, entry, idxs, values)
+                with paused_gc(), TodoStats.phase('load'):
+                    idxs = idxs[:limit]
+                    records = dict(entry.iter_records_at(sorted(idxs)))
+                    return [(idx, records[idx]) for idx in idxs]
+
+        with paused_gc(), TodoStats.phase('filter'):
+            idxs = lookup(entry.load_index())
+            if idxs is None:
+                records = enumerate(entry.iter_records())
+            else:
+                records = entry.iter_records_at(idxs)
+            records = TodoStats.iterate('load', records, 'lines read')
+            for include in filters:
+                records = filter(include, records)
+            records = TodoStats.iterate('filter', records, 'tasks matched')
+            with TodoStats.phase('sort'):
+                rows = sorter.select(records)
+            view.save(
+                key, entry, array('i', (idx for idx, record in rows)),
+                array('q', (value for item in rows
+                            for value in TodoView.values(sorter, item))))
+        return rows[:limit]
+
+    def values(sorter, item):
+        """The sort fields of item, kept for every row of a view. The line
+        no is left out, it changes when lines before it are removed."""
+        return [
+            0 if field == 'idx' else TodoSorter.value(item, field)
+            for field, descending in sorter.keys
+        ]
+
+    def row_key(sorter, idx, values):
+        """TodoSorter.key of a row from its values."""
+        key = ()
+        for (field, descending), value in zip(sorter.keys, values):
+            if field == 'idx':
+                value = idx
+            missing = field not in ('prio', 'idx') and not value
+            key += (missing, -value if descending else value)
+        return key
+
+    def catch_up(idxs, values, changes, entry, filters, sorter):
+        """Apply changes (see TodoCache) to the rows of a view: drop the rows
+        of replaced and removed lines, renumber the lines after them and
+        merge in the new lines passing filters."""
+        from array import array
+        import heapq
+        width = len(sorter.keys)
+        rows = [(idx, values[n * width:(n + 1) * width])
+                for n, idx in enumerate(idxs)]
+        dirty = set()
+        for idx, removed, added in changes:
+            end = idx + removed
+            delta = added - removed
+            rows = [(i + delta if i >= end else i, row)
+                    for i, row in rows if not idx <= i < end]
+            dirty = {
+                i + delta if i >= end else i
+                for i in dirty if not idx <= i < end
+            }
+            dirty.update(range(idx, idx + added))
+        new = [(item[0], TodoView.values(sorter, item))
+               for item in entry.iter_records_at(sorted(dirty))
+               if all(include(item) for include in filters)]
+
+        # Ties are in file order, as in a stable sort of the whole file
+        def key(row):
+            return (TodoView.row_key(sorter, *row), row[0])
+
+        rows = list(heapq.merge(rows, sorted(new, key=key), key=key))
+        return (array('i', (idx for idx, row in rows)),
+                array('q', (value for idx, row in rows for value in row)))
+
+    def load(self):
+        from array import array
+        try:
+            with open(self.path, 'rb') as view_file:
+                (key, lineage, generation, idxs,
+                 values) = marshal.loads(view_file.read())
+            return (key, lineage, generation, array('i', idxs),
+                    array('q', values))
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+    def save(self, key, entry, idxs, values):
+        temp_path = '{}~{}'.format(self.path, os.getpid())
+        try:
+            with open(temp_path, 'wb') as view_file:
+                marshal.dump((key, entry.lineage, entry.generation,
+                              idxs.tobytes(), values.tobytes()), view_file)
+            os.replace(temp_path, self.path)
+        except (OSError, ValueError):
+            # Only an optimization like the cache, recomputed next time
+            remove_file(temp_path)
+
+
+class TodoVocabulary:
+    """The names shell completion offers for todo.txt: projects, contexts,
+    label keys, the values of labels that have few of them and ids. They are
+    kept in a small sidecar file next to todo.txt, written from the TodoIndex
+    when the cache is written once the file exists, so that answering a TAB
+    press does not depend on the size of todo.txt. Ids are stored sorted in
+    fixed-width slots and found by binary search."""
+    version = 1
+    kinds = ('project', 'category', 'label', 'id', 'word', 'view')
+    # Labels with more values (e.g. one per todo) only complete their key
+    max_values = 1000
+
+    class Slots:
+        """The ids of a vocabulary as a sequence, for bisect."""
+        def __init__(self, block, width):
+            self.block = block
+            self.width = width
+
+        def __len__(self):
+            return len(self.block) // self.width
+
+        def __getitem__(self, pos):
+            start = pos * self.width
+            return self.block[start:start + self.width].rstrip(b'\0')
+
+    def __init__(self, todo_path):
+        self.path = os.path.join(os.path.dirname(todo_path),
+                                 '.' + os.path.basename(todo_path) + '.vocab')
+
+    def write(self, index, stamp):
+        """Write the vocabulary of index, stamped with the (lineage,
+        generation) of the cache it belongs to."""
+        index.sort_ids()
+        ids = [value.encode('utf-8') for value in index.ids[0]]
+        width = max(map(len, ids), default=1)
+        labels = {
+            key:
+            sorted(values) if len(values) <= TodoVocabulary.max_values else None
+            for key, values in index.labels.items()
+        }
+        header = marshal.dumps(
+            (TodoVocabulary.version, stamp, sorted(index.projects),
+             sorted(index.categories), labels, width))
+        temp_path = '{}~{}'.format(self.path, os.getpid())
+        try:
+            with open(temp_path, 'wb') as vocab_file:
+                vocab_file.write(len(header).to_bytes(4, 'little'))
+                vocab_file.write(header)
+                vocab_file.write(b''.join(
+                    value.ljust(width, b'\0') for value in ids))
+            os.replace(temp_path, self.path)
+        except OSError:
+            remove_file(temp_path)
+
+    def load(self):
+        """Return (stamp, projects, categories, labels, ids) or None."""
+        try:
+            with open(self.path, 'rb') as vocab_file:
+                length = int.from_bytes(vocab_file.read(4), 'little')
+                (version, stamp, projects, categories, labels,
+                 width) = marshal.loads(vocab_file.read(length))
+                block = vocab_file.read()
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        if version != TodoVocabulary.version:
+            return None
+        return (stamp, projects, categories, labels,
+                TodoVocabulary.Slots(block, width))
+
+    def load_fresh(config):
+        """The vocabulary of todo.txt, brought up to date with it first when
+        todo.txt changed since it was written. None when there is no
+        todo.txt."""
+        import contextlib
+        if not os.path.isfile(config.todo_path):
+            return None
+        vocab = TodoVocabulary(config.todo_path)
+        state = vocab.load()
+        entry = TodoCache(config.todo_path).load()
+        if (state and entry and state[0] == (entry.lineage, entry.generation)
+                and entry.is_fresh(os.stat(config.todo_path))):
+            return state
+
+        import io
+        # Caught up like any other reader of todo.txt, warnings are for ls
+        with contextlib.redirect_stdout(io.StringIO()):
+            entry = load_cache_entry(config)
+        if entry is None:
+            return None
+        state = vocab.load()
+        if state is None or state[0] != (entry.lineage, entry.generation):
+            vocab.write(entry.load_index(), (entry.lineage, entry.generation))
+            state = vocab.load()
+        return state
+
+    def names(state, kind, prefix):
+        """The names of kind (project, category, label, id or word: a
+        +project, @context or key:value being typed) starting with prefix."""
+        (stamp, projects, categories, labels, ids) = state
+        if kind == 'word':
+            if prefix[:1] in ('+', '@'):
+                names = projects if prefix[0] == '+' else categories
+                return [
+                    prefix[0] + name for name in names
+                    if name.startswith(prefix[1:])
+                ]
+            key, _, value = prefix.partition(':')
+            if key == 'id':
+                return ['id:' + name for name in
+                        TodoVocabulary.names(state, 'id', value)]
+            return [
+                key + ':' + name for name in labels.get(key) or ()
+                if name.startswith(value)
+            ]
+        if kind == 'id':
+            start = prefix.encode('utf-8')
+            pos = bisect.bisect_left(ids, start)
+            names = []
+            while pos < len(ids) and ids[pos].startswith(start):
+                names.append(ids[pos].decode('utf-8'))
+                pos += 1
+            return names
+        names = {
+            'project': projects,
+            'category': categories,
+            'label': [key + ':' for key in labels]
+        }[kind]
+        return [name for name in names if name.startswith(prefix)]
+
+
+def complete(config, kind, prefix):
+    """Print what completes prefix (see TodoVocabulary.names), one per line,
+    from every shard."""
+    if kind == 'view':
+        names = [name for name in config.views if name.startswith(prefix)]
+    else:
+        names = set()
+        for shard in TodoShards.configs(config):
+            state = TodoVocabulary.load_fresh(shard)
+            if state is not None:
+                names.update(TodoVocabulary.names(state, kind, prefix))
+    sys.stdout.write(''.join(name + '\n' for name in sorted(names)))
+
+
+def completion_script(shell):
+    """The completion script of shell, calling back into this file."""
+    import shlex
+    command = '{} -c {}'.format(
+        shlex.quote(sys.executable),
+        shlex.quote('import sys; sys.path.insert(0, {!r}); import todo; '
+                    'todo.main()'.format(
+                        os.path.dirname(os.path.abspath(__file__)))))
+    return completion_scripts[shell].replace('@COMMANDS@',
+                                             ' '.join(commands)).replace(
+                                                 '@TODO@', command)
+
+
+def ls_todo(config,
+            category,
+            project,
+            due,
+            finished,
+            limit=None,
+            sort=True,
+            sort_keys=None,
+            archive=False,
+            query=None,
+            fmt=None,
+            view=None):
+    if view:
+        if (category or project or due or finished or archive or query
+                or sort_keys or not sort):
+            print('--view can only be combined with -n and --format')
+            exit()
+        list_records(config, {'view': view}, fmt=fmt, limit=limit)
+        return
+    spec = {
+        'category': category,
+        'project': project,
+        'due': due,
+        'finished': finished,
+        'query': query
+    }
+    list_records(config, spec, archive, fmt, limit, sort, sort_keys)
+
+
+def compile_query(config, text):
+    try:
+        return TodoQuery(text, config.custom_labels)
+    except ValueError as err:
+        print('Invalid query: {}'.format(err))
+        exit()
+
+
+def query_records(config, spec, todo_path=None, archive=False):
+    """Return the (idx, record) pairs of todo_path (todo.txt by default, then
+    done.txt when archive is set) passing the filters in spec, in file order.
+    spec holds the options of ls and search: category, project, due,
+    finished, query (the text), words (see search_terms) and fold."""
+    (lookup, filters) = spec_filters(config, spec)
+    records = iter_records(config, lookup, todo_path)
+    if archive:
+        records = itertools.chain(records, iter_archive(config, lookup))
+    records = TodoStats.iterate('load', records, 'lines read')
+    for include in filters:
+        records = filter(include, records)
+    return TodoStats.iterate('filter', records, 'tasks matched')
+
+
+def spec_filters(config, spec):
+    """Return the lookup (see iter_records) and the list of filters of the
+    records matching spec, see query_records."""
+    category = spec.get('category')
+    project = spec.get('project')
+    due = spec.get('due')
+    finished = spec.get('finished', False)
+    words = spec.get('words')
+    fold = spec.get('fold', False)
+    query = None
+    plan = {'category': None, 'project': None, 'due': None, 'labels': None}
+    if spec.get('query'):
+        query = compile_query(config, spec['query'])
+        plan = query.plan
+
+    def lookup(index):
+        return index.lookup(category or plan['category'], project
+                            or plan['project'], due or plan['due'], finished,
+                            plan['labels'], words, fold)
+
+    filters = [record_filter(category, project, due, finished)]
+    if query:
+        filters.append(query.predicate)
+    if words:
+        filters.append(word_filter(words, fold))
+    return (lookup, filters)
+
+
+def list_records(config, spec, archive=False, fmt=None, limit=None, sort=True,
+                 sort_keys=None):
+    """Print the todos matching spec (see query_records), or the view
+    spec['view'], from every shard of a sharded workspace."""
+    view = spec.get('view')
+    if view:
+        # The view comes with its own order and columns
+        (_, sort_keys, columns) = TodoView.parse(config, view)
+        if columns:
+            config.show_default = columns
+    if not config.shard_by:
+        if view:
+            records = TodoView.select(config, view, limit)
+            show_records(config, records, fmt, limit, sort=False)
+        else:
+            records = query_records(config, spec, archive=archive)
+            show_records(config, records, fmt, limit, sort, sort_keys)
+        return
+    if spec.get('query'):
+        # Checked once here rather than in every shard
+        compile_query(config, spec['query'])
+    records = TodoShards.select(config, spec, archive, limit, sort,
+                                sort_keys)
+    show_records(config, records, fmt, limit, sort=False)
+
+
+def show_records(config, records, fmt=None, limit=None, sort=True,
+                 sort_keys=None):
+    """Sort and print (idx, record) pairs, as a table or in one of the
+    TodoExport formats."""
+    export = None
+    saved = sys.stdout
+    if fmt in TodoExport.formats:
+        # Created first to hold on to stdout, the warnings about malformed
+        # lines printed while the records are read go to stderr instead
+        export = TodoExport(fmt, config.custom_labels)
+        sys.stdout = sys.stderr
+    try:
+        if sort:
+            with paused_gc(), TodoStats.phase('sort'):
+                records = TodoSorter(sort_keys).select(records, limit)
+        elif limit is not None:
+            records = itertools.islice(records, limit)
+        if export:
+            records = TodoStats.iterate('render', records, 'rows rendered')
+            with TodoStats.phase('render'):
+                export.write(records)
+        else:
+            print_records(config, records)
+    finally:
+        sys.stdout = saved
+
+
+def print_records(config, records):
+    """Print (idx, record) pairs as a table with the columns of config."""
+    todos = TodoStats.iterate(
+        'render',
+        (TodoCache.from_record(idx, record) for idx, record in records),
+        'rows rendered')
+
+    props = TodoPrinter.Properties()
+    for k, v in config.custom_labels.items():
+        props.__dict__[k] = v
+
+    if len(config.show_default) > 0:
+        for field in config.show_default:
+            if field in props.__dict__:
+                props.__dict__[field].show = True
+    else:
+        props = TodoPrinter.Properties.get_default()
+
+    printer = TodoPrinter(props)
+    with TodoStats.phase('render'):
+        printer.print_todos(todos)
+
+
+def search_terms(args, fold=False):
+    """Split search arguments into (word, prefix) pairs the way descriptions
+    are split into words, where a trailing * makes the last word a prefix."""
+    terms = []
+    for arg in args:
+        words = TodoIndex.split_words(arg.casefold() if fold else arg)
+        terms.extend((word, False) for word in words)
+        if words and arg.endswith('*'):
+            terms[-1] = (words[-1], True)
+    return terms
+
+
+def word_filter(terms, fold):
+    def include(item):
+        words = TodoIndex.words_of(item[1][5])
+        if fold:
+            words = {word.casefold() for word in words}
+        for term, prefix in terms:
+            if prefix:
+                if not any(word.startswith(term) for word in words):
+                    return False
+            elif term not in words:
+                return False
+        return True
+
+    return include
+
+
+def search_todo(config, args, fold=False, finished=False, limit=None,
+                archive=False, fmt=None):
+    """List the todos whose description has all the words in args, looked up
+    in the word index of the cache."""
+    terms = search_terms(args, fold)
+    if not terms:
+        print('Nothing to search for')
+        exit()
+    spec = {'finished': finished, 'words': terms, 'fold': fold}
+    list_records(config, spec, archive, fmt, limit)
+
+
+def iter_archive(config, lookup=None):
+    """Yield (idx, record) for the lines of done.txt, numbered after the
+    lines of todo.txt. Only read once todo.txt has been."""
+    if not os.path.isfile(config.done_path):
+        return
+    start = count_lines(config.todo_path)
+    for idx, record in iter_records(config, lookup, config.done_path):
+        yield (start + idx, record)
+
+
+def count_lines(todo_path):
+    """Number of lines of todo_path, from its cache when it is up to date."""
+    entry = TodoCache(todo_path).load_valid(todo_path)
+    if entry is not None:
+        return entry.count
+    if not os.path.isfile(todo_path):
+        return 0
+    with open(todo_path, 'rb') as todo_file:
+        return sum(1 for line in TodoCache.read_lines(todo_file))
+
+
+def archive_todo(config, days=None):
+    """Move the done todos (done at least days ago when given) from todo.txt
+    to the end of done.txt, copying their lines byte for byte. done.txt is
+    written first, so a crash in between leaves a todo in both files rather
+    than in neither. Returns the number of archived todos."""
+    cutoff = datetime.today().toordinal() - days if days is not None else None
+
+    def archived(done, done_date):
+        return done and (cutoff is None or 0 < done_date <= cutoff)
+
+    with TodoLock(config.todo_path):
+        entry = load_cache_entry(config)
+        if entry is None or entry.offsets is None:
+            todos = load_todos(config)
+            done = [
+                todo for todo in todos if todo.matched and archived(
+                    todo.done, TodoCache.to_ordinal(todo.done_date))
+            ]
+            lines = [
+                str(todo).replace('\n', os.linesep).encode(file_encoding())
+                for todo in done
+            ]
+        else:
+            done = [
+                idx for idx, record in entry.iter_records_at(
+                    entry.load_index().done) if archived(record[0], record[2])
+            ]
+            offsets = entry.load_offsets()
+            lines = []
+            with open(config.todo_path, 'rb') as todo_file:
+                for idx in done:
+                    end = offsets[
+                        idx + 1] if idx + 1 < entry.count else entry.size
+                    todo_file.seek(offsets[idx])
+                    lines.append(todo_file.read(end - offsets[idx]))
+        if not done:
+            return 0
+
+        try:
+            with TodoLock(config.done_path):
+                append_lines(config.done_path, lines)
+        except OSError:
+            print('Failed to append to {}'.format(config.done_path))
+            exit()
+
+        if entry is None or entry.offsets is None:
+            done = set(todo.idx for todo in done)
+            write_todo_file(config,
+                            [todo for todo in todos if todo.idx not in done])
+        else:
+            splice_todo_file(config, entry, {idx: None for idx in done}, [])
+    return len(done)
+
+
+def assign_ids(config, dry_run=False):
+    """Give every todo of todo.txt without an id one (see new_id), rewriting
+    the file once under its lock. Malformed lines are left as they are, and
+    so are todos that would not read the id back (an id:value alone is taken
+    for the description). Returns the number of todos that can get an id,
+    which only get one unless dry_run."""
+    with TodoLock(config.todo_path):
+        entry = load_cache_entry(config)
+        if entry is None or entry.offsets is None:
+            todos = load_todos(config)
+            missing = [
+                todo for todo in todos
+                if todo.matched and 'id' not in todo.labels
+            ]
+        else:
+            missing = [
+                TodoCache.from_record(idx, record)
+                for idx, record in enumerate(entry.iter_records())
+                if record[9] and 'id' not in dict(record[8])
+            ]
+        parser = TodoParser()
+        for todo in missing:
+            todo.add_label('id', new_id())
+        missing = [
+            todo for todo in missing
+            if 'id' in parser.parse_line(todo.idx, str(todo)).labels
+        ]
+        if dry_run or not missing:
+            return len(missing)
+
+        if entry is None or entry.offsets is None:
+            write_todo_file(config, todos)
+        else:
+            splice_todo_file(config, entry,
+                             {todo.idx: todo
+                              for todo in missing}, [])
+    return len(missing)
+
+
+def auto_archive(config):
+    """Archive according to the archive-days and archive-count options of
+    the dotfile, after a command changed todo.txt (or each shard)."""
+    for shard in TodoShards.configs(config):
+        if shard.archive_days is not None:
+            archive_todo(shard, shard.archive_days)
+        if shard.archive_count is not None:
+            entry = load_cache_entry(shard)
+            if entry is not None and len(
+                    entry.load_index().done) > shard.archive_count:
+                archive_todo(shard)
+
+
+def find_line(ref, count, find_id):
+    """Line no of the todo ref refers to: a line no, or the id of a todo as
+    id:value or (when it is not a number) as value or a unique prefix of it.
+    find_id is TodoIndex.find_id or the same over loaded todos. Prints why
+    and returns None when there is no such todo."""
+    if ref.isdigit():
+        if int(ref) < count:
+            return int(ref)
+        print('No match for line no: {}'.format(ref))
+        return None
+    prefix = not ref.startswith('id:')
+    value = ref if prefix else ref[3:]
+    idxs = find_id(value, prefix)
+    if len(idxs) == 1:
+        return idxs[0]
+    if idxs:
+        print('Ambiguous id {}, matches line nos: {}'.format(
+            value, ', '.join(str(idx) for idx in idxs)))
+    else:
+        print('No match for id: {}'.format(value))
+    return None
+
+
+def todo_id_finder(todos):
+    """TodoIndex.find_id over a list of todos."""
+    def find_id(value, prefix=False):
+        idxs = [todo.idx for todo in todos if todo.labels.get('id') == value]
+        if idxs or not prefix:
+            return idxs
+        return [
+            todo.idx for todo in todos
+            if todo.labels.get('id', '').startswith(value)
+        ]
+
+    return find_id
+
+
+def load_cache_entry(config):
+    """Load the cache of todo.txt, (re)building it first when it is stale."""
+    with TodoStats.phase('load'):
+        cache = TodoCache(config.todo_path)
+        entry = cache.load_valid(config.todo_path)
+        if entry is None:
+            for record in TodoStats.iterate('load', iter_records(config),
+                                            'lines read'):
+                pass
+            entry = cache.load_valid(config.todo_path)
+    return entry
+
+
+def load_todo(config, line):
+    """Load the todo on line no line, or with the id line (see find_line),
+    without parsing the whole file."""
+    if not os.path.isfile(config.todo_path):
+        print('No match for {}'.format(line))
+        return None
+
+    entry = load_cache_entry(config)
+    if entry is None:
+        todos = load_todos(config)
+        idx = find_line(line, len(todos), todo_id_finder(todos))
+        return None if idx is None else todos[idx]
+
+    idx = find_line(line, entry.count, entry.find_id)
+    if idx is None:
+        return None
+    for idx, record in entry.iter_records_at([idx]):
+        return TodoCache.from_record(idx, record)
+
+
+def patch_todo_file(config, idx, todo):
+    """Replace line idx of todo.txt with todo, or remove it when todo is None,
+    keeping every other line byte for byte. A line that keeps its length is
+    overwritten in place, guarded by the TodoJournal. Otherwise the file is
+    spliced into a temporary file moved over it, so that todo.txt is never
+    seen half written (see splice_todo_file), which copies the other lines
+    in the kernel but still writes a new todo.txt. Either way the cache is
+    patched, only hashing the chunk of the line again. Returns False when
+    the line offsets are unknown and the file has to be rewritten."""
+    journal = TodoJournal(config.todo_path)
+    journal.recover()
+    cache = TodoCache(config.todo_path)
+    entry = cache.load_valid(config.todo_path)
+    if entry is None or entry.offsets is None or not 0 <= idx < entry.count:
+        return False
+
+    offsets = entry.load_offsets()
+    start = offsets[idx]
+    end = offsets[idx + 1] if idx + 1 < entry.count else entry.size
+    # Written the way text mode would write it
+    encoding = file_encoding()
+    line = str(todo) if todo else ''
+    data = line.replace('\n', os.linesep).encode(encoding)
+
+    if len(data) != end - start:
+        splice_todo_file(config, entry, {idx: todo}, [])
+        return True
+
+    with open(config.todo_path, 'r+b') as todo_file:
+        todo_file.seek(start)
+        journal.begin(start, entry.size, todo_file.read(end - start))
+        todo_file.seek(start)
+        todo_file.write(data)
+        todo_file.flush()
+        os.fsync(todo_file.fileno())
+        TodoStats.count('bytes written', len(data))
+    journal.end()
+
+    record = None
+    if todo:
+        (_, record) = TodoCache.parse_record(TodoParser(), idx, line)
+    cache.splice(entry, {idx: (record, len(data))}, [], config.todo_path)
+    return True
+
+
+def update_todo(config, idx, todo):
+    """Write back a modified todo, or remove it when todo is None."""
+    with TodoStats.phase('write'):
+        if patch_todo_file(config, idx, todo):
+            return
 
-def edit_todo(config, line, description):
     todos = load_todos(config)
-    todo = get_todo_from_line(todos, line)
     if todo:
-        todo.set_description(description)
-        write_todo_file(config, todos)
+        todos[idx] = todo
+    else:
+        del todos[idx]
+    write_todo_file(config, todos)
+
+
+def remove_todo(config, line):
+    # Not locked while asking, a prompt left open would hold up every other
+    # writer for as long
+    todo = load_todo(config, line)
+    if not todo:
+        return
+
+    printer = TodoPrinter(
+        TodoPrinter.Properties.get_default().show_done().show_done_date())
+    printer.print_todos([todo])
+
+    c = input('Are you sure you want to PERMANENTLY remove this Todo? (y/n): ')
+    if c != 'y':
+        return
+    with TodoLock(config.todo_path):
+        # Looked up again by its id, or on its line no, as lines may have
+        # been added, removed or changed in the meantime
+        ref = 'id:' + todo.labels['id'] if 'id' in todo.labels else str(
+            todo.idx)
+        current = load_todo(config, ref)
+        if current is None or str(current) != str(todo):
+            print('Todo {} was changed meanwhile, not removed'.format(line))
+            exit(1)
+        update_todo(config, current.idx, None)
+
+
+def check_parsed(todo):
+    """Print why and exit when todo is a malformed line, which is written
+    back as it was read whatever is changed."""
+    if not todo.matched:
+        print('Line {} is malformed, cannot change it: {}'.format(
+            todo.idx, todo.line.rstrip('\n')))
+        exit(1)
+
+
+def edit_todo(config, line, description):
+    with TodoLock(config.todo_path):
+        todo = load_todo(config, line)
+        if todo:
+            check_parsed(todo)
+            todo.set_description(description)
+            update_todo(config, todo.idx, todo)
     return
 
 
+def show_todo(config, line, fmt=None, start=0):
+    """Print a single todo with all its fields. start is the line no of the
+    first line of its shard, see TodoShards."""
+    todo = load_todo(config, line)
+    if not todo:
+        return
+    todo.idx += start
+    if fmt in TodoExport.formats:
+        record = TodoCache.to_record(todo)
+        TodoExport(fmt, config.custom_labels).write([(todo.idx, record)])
+        return
+    props = TodoPrinter.Properties.get_default()
+    printer = TodoPrinter(
+        props.show_done().show_done_date().show_labels(rows=True))
+    printer.print_todos([todo])
+
+
+def set_status(todo, status):
+    if status == 'done':
+        todo.set_done(True)
+    elif status == 'ongoing':
+        todo.set_done(False)
+    elif status == 'toggle':
+        todo.toggle_done()
+    else:
+        print('Unrecognized status')
+        exit()
+
+
 def toggle_todo(config, line, status):
-    todos = load_todos(config)
-    todo = get_todo_from_line(todos, line)
-    if todo:
-        if status == 'done':
-            todo.set_done(True)
-        elif status == 'ongoing':
-            todo.set_done(False)
-        elif status == 'toggle':
-            todo.toggle_done()
+    """Set the status of the todo on line (see find_line) and return it, or
+    None when there is no such todo."""
+    with TodoLock(config.todo_path):
+        todo = load_todo(config, line)
+        if todo:
+            check_parsed(todo)
+            set_status(todo, status)
+            update_todo(config, todo.idx, todo)
+        return todo
+
+
+def read_batch(parser, batch_file):
+    """Read batch operations, one per line, either as a command line (shell
+    quoting, # comments) or as a JSON array of its arguments."""
+    import json
+    import shlex
+    ops = []
+    for no, line in enumerate(batch_file, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            argv = json.loads(line) if line.startswith('[') else shlex.split(
+                line, comments=True)
+            if not isinstance(argv, list) or not argv or argv[0] not in (
+                    'add', 'set', 'edit', 'rm'):
+                raise ValueError('expected one of add, set, edit or rm')
+            ops.append(parser.parse_args([str(arg) for arg in argv]))
+        except (ValueError, SystemExit) as err:
+            print('Invalid operation on line {}: {} {}'.format(
+                no, line, err if isinstance(err, ValueError) else ''))
+            exit()
+    return ops
+
+
+def batch_todo(config, source):
+    """Apply many add/set/edit/rm operations with a single load and a single
+    write. Line numbers always refer to the file as it was before the batch,
+    so they stay valid when earlier operations remove lines."""
+    parser = create_parser()
+    if source == '-':
+        ops = read_batch(parser, sys.stdin)
+    else:
+        with open(source, 'r') as batch_file:
+            ops = read_batch(parser, batch_file)
+    for op in ops:
+        if op.cmd == 'add':
+            op.todo = create_todo(op.prio,
+                                  datetime.today() if op.today else None,
+                                  op.description, op.project, op.category,
+                                  op.due)
+
+    if not config.shard_by:
+        apply_batch(config, ops)
+        print('Applied {} operations'.format(len(ops)))
+        return
+
+    # Split into a batch per shard, checked across shards up front
+    resolve = TodoShards.resolver(config)
+    batches = {}
+    removed = set()
+    for op in ops:
+        if op.cmd == 'add':
+            shard = config.shard(TodoShards.path_for(config, op.todo))
         else:
-            print('Unrecognized status')
+            target = resolve(op.line)
+            if target is None:
+                exit()
+            shard, op.line, idx, _ = target
+            if idx in removed:
+                print('Line no {} is removed earlier in the batch'.format(idx))
+                exit()
+            if op.cmd == 'rm':
+                removed.add(idx)
+        batches.setdefault(shard.todo_path, (shard, []))[1].append(op)
+    for shard, shard_ops in batches.values():
+        if not os.path.isfile(shard.todo_path):
+            # A new shard, only added to
+            with TodoLock(shard.todo_path):
+                append_lines(shard.todo_path, [])
+        apply_batch(shard, shard_ops)
+    print('Applied {} operations'.format(len(ops)))
+
+
+def apply_batch(config, ops):
+    """Apply the ops of a batch to todo.txt (or a shard) under its lock."""
+    with TodoLock(config.todo_path):
+        entry = load_cache_entry(config)
+        if entry is None or entry.offsets is None:
+            todos = load_todos(config)
+            count = len(todos)
+            find_id = todo_id_finder(todos)
+        else:
+            todos = None
+            count = entry.count
+            find_id = entry.find_id
+
+        # Validate everything before changing anything
+        removed = set()
+        for op in ops:
+            if op.cmd == 'add':
+                continue
+            op.idx = find_line(op.line, count, find_id)
+            if op.idx is None:
+                exit()
+            if op.idx in removed:
+                print('Line no {} is removed earlier in the batch'.format(
+                    op.idx))
+                exit()
+            if op.cmd == 'rm':
+                removed.add(op.idx)
+
+        targets = sorted({op.idx for op in ops if op.cmd != 'add'})
+        if todos is None:
+            changed = {
+                idx: TodoCache.from_record(idx, record)
+                for idx, record in entry.iter_records_at(targets)
+            }
+        else:
+            changed = {idx: todos[idx] for idx in targets}
+        for op in ops:
+            if op.cmd in ('edit', 'set'):
+                check_parsed(changed[op.idx])
+
+        added = []
+        for op in ops:
+            if op.cmd == 'add':
+                added.append(op.todo)
+            elif op.cmd == 'rm':
+                changed[op.idx] = None
+            elif op.cmd == 'edit':
+                changed[op.idx].set_description(op.description)
+            elif op.cmd == 'set':
+                set_status(changed[op.idx], op.status)
+
+        if todos is None:
+            splice_todo_file(config, entry, changed, added)
+        else:
+            todos = [changed.get(todo.idx, todo) for todo in todos]
+            write_todo_file(
+                config, [todo for todo in todos if todo is not None] + added)
+
+
+def write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def copy_range(source, target, start, size):
+    """Append size bytes of the file source from start to the file target.
+    The kernel copies them where it can, without reading them into this
+    process, and file systems with reflinks (btrfs, XFS) share the blocks
+    instead of writing them again."""
+    end = start + size
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    while start < end:
+        if copy_file_range is None:
+            os.lseek(source, start, os.SEEK_SET)
+            data = os.read(source, min(end - start, 1 << 20))
+            write_all(target, data)
+            copied = len(data)
+        else:
+            try:
+                copied = copy_file_range(source, target, end - start, start)
+            except OSError:
+                # Not between these files or on this system, copy them here
+                copy_file_range = None
+                continue
+        if not copied:
+            # todo.txt got shorter behind our back
+            return
+        start += copied
+
+
+def splice_todo_file(config, entry, changed, added):
+    """Write todo.txt with the lines in changed replaced (or removed when
+    None) and added appended, copying every other line byte for byte, and
+    move it over the original in one step. The cache of entry is then
+    patched (see TodoCache.splice), so that the next read does not parse
+    todo.txt from scratch."""
+    offsets = entry.load_offsets()
+    encoding = file_encoding()
+    parser = TodoParser()
+
+    def encode(idx, todo):
+        # The bytes of the line of todo, and what the cache keeps of it
+        line = str(todo)
+        (_, record) = TodoCache.parse_record(parser, idx, line)
+        return (line.replace('\n', os.linesep).encode(encoding), record)
+
+    lines = {
+        idx: encode(idx, todo) if todo is not None else (b'', None)
+        for idx, todo in changed.items()
+    }
+    count = entry.count - sum(todo is None for todo in changed.values())
+    new = [encode(count + no, todo) for no, todo in enumerate(added)]
+    # A line break put after the last line changes it, the cache is rebuilt
+    patch = True
+    temp_path = '{}~{}'.format(config.todo_path, os.getpid())
+    try:
+        with open(config.todo_path, 'rb', buffering=0) as todo_file, open(
+                temp_path, 'w+b', buffering=0) as temp, TodoStats.phase(
+                    'write'):
+            (source, target) = (todo_file.fileno(), temp.fileno())
+            pos = 0
+            for idx in sorted(lines):
+                copy_range(source, target, pos, offsets[idx] - pos)
+                write_all(target, lines[idx][0])
+                pos = offsets[idx + 1] if idx + 1 < entry.count else entry.size
+            copy_range(source, target, pos, entry.size - pos)
+            size = temp.tell()
+            # Read back, it was copied in the kernel
+            temp.seek(max(size - 1, 0))
+            if new and temp.read(1) not in (b'', b'\n'):
+                write_all(target, os.linesep.encode(encoding))
+                patch = False
+            for data, record in new:
+                write_all(target, data)
+            os.fsync(target)
+            TodoStats.count('bytes written', temp.tell())
+        os.replace(temp_path, config.todo_path)
+    except OSError:
+        print('Failed to overwrite todo.txt with modifications')
+        remove_file(temp_path)
+        exit()
+    sync_dir(config.todo_path)
+    if patch:
+        TodoCache(config.todo_path).splice(
+            entry,
+            {idx: (record, len(data))
+             for idx, (data, record) in lines.items()},
+            [(record, len(data)) for data, record in new], config.todo_path)
+
+
+class TodoServer:
+    """`todo serve` keeps the parsed todos in memory and runs the commands
+    other todo processes forward to it over a Unix socket next to the
+    dotfile. todo.txt is polled for changes made behind its back and re-read
+    (only the tail when lines were appended) before a command needs it.
+
+    A request is a JSON object with the argv, cwd and stdin of the command on
+    one line. The reply is a stream of frames: a tag (o for stdout, e for
+    stderr, x for the exit status), a 4 byte length and the UTF-8 payload."""
+    # rm asks for confirmation, so it always runs in the calling process
+    commands = ('add', 'ls', 'search', 'show', 'edit', 'set', 'batch',
+                'archive')
+    poll_interval = 0.5
+    buffer_size = 1 << 16
+
+    class Stream:
+        """stdout or stderr of a forwarded command."""
+        def __init__(self, sock, tag):
+            self.sock = sock
+            self.tag = tag
+            self.parts = []
+            self.size = 0
+
+        def write(self, s):
+            self.parts.append(s)
+            self.size += len(s)
+            if self.size >= TodoServer.buffer_size:
+                self.flush()
+            return len(s)
+
+        def flush(self):
+            data = ''.join(self.parts).encode('utf-8')
+            self.parts = []
+            self.size = 0
+            if data and self.sock:
+                try:
+                    TodoServer.send(self.sock, self.tag, data)
+                except OSError:
+                    # The client went away, the command still runs to the end
+                    self.sock = None
+
+    def __init__(self, dotfile):
+        self.dotfile = dotfile
+        self.path = dotfile + '.sock'
+        # (inode, mtime, size) of each file when last read
+        self.seen = {}
+
+    def send(sock, tag, data):
+        sock.sendall(tag + len(data).to_bytes(4, 'little') + data)
+
+    def connect(path):
+        if not os.path.exists(path):
+            return None
+        import socket
+        if not hasattr(socket, 'AF_UNIX'):
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except OSError:
+            sock.close()
+            return None
+        return sock
+
+    def forward(dotfile, argv):
+        """Run the command in argv in a running `todo serve` and pass on its
+        output and exit status. Returns False when no server is running."""
+        sock = TodoServer.connect(dotfile + '.sock')
+        if sock is None:
+            return False
+
+        import json
+        stdin = ''
+        if command_of(argv) == 'batch' and argv[-1] in ('batch', '-'):
+            stdin = sys.stdin.read()
+        status = None
+        with sock, sock.makefile('rb') as reply:
+            sock.sendall(
+                json.dumps({
+                    'argv': argv,
+                    'cwd': os.getcwd(),
+                    'stdin': stdin
+                }).encode('utf-8') + b'\n')
+            while True:
+                head = reply.read(5)
+                if len(head) < 5:
+                    break
+                data = reply.read(int.from_bytes(head[1:], 'little'))
+                if head[:1] == b'o':
+                    sys.stdout.write(data.decode('utf-8'))
+                elif head[:1] == b'e':
+                    sys.stderr.write(data.decode('utf-8'))
+                else:
+                    status = int(data)
+        if status is None:
+            print('Lost connection to todo serve', file=sys.stderr)
+            status = 1
+        if status:
+            sys.exit(status)
+        return True
+
+    def refresh(self):
+        """Bring the cache in memory up to date with todo.txt (or every
+        shard), called between commands. A file changed within
+        TodoCache.racy_ns of being read is read again once that window has
+        passed, so that the cache can be trusted on its mtime alone from
+        then on."""
+        for config in TodoShards.configs(Dotfile(self.dotfile)):
+            self.refresh_file(config)
+
+    def refresh_file(self, config):
+        import contextlib
+        try:
+            stat = os.stat(config.todo_path)
+        except OSError:
+            return
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        entry = TodoCache(config.todo_path).load()
+        if entry and entry.is_fresh(stat):
+            self.seen[config.todo_path] = key
+            return
+        if key == self.seen.get(config.todo_path) and time.time_ns(
+        ) - stat.st_mtime_ns <= TodoCache.racy_ns:
+            return
+
+        import io
+        # Warnings are printed by the commands that read the lines
+        with paused_gc(), contextlib.redirect_stdout(io.StringIO()):
+            for record in iter_records(config):
+                pass
+            TodoCache(config.todo_path).load()
+        # The records live as long as the server, keep the collector off them
+        gc.freeze()
+        self.seen[config.todo_path] = key
+
+    def handle(self, request, sock):
+        import contextlib
+        import io
+        import json
+        try:
+            request = json.loads(request)
+            argv = [str(arg) for arg in request['argv']]
+            cwd = request['cwd']
+            stdin = request['stdin']
+        except (ValueError, KeyError, TypeError):
+            return
+
+        out = TodoServer.Stream(sock, b'o')
+        err = TodoServer.Stream(sock, b'e')
+        status = 0
+        saved = (os.getcwd(), sys.stdin)
+        try:
+            # Relative paths (batch files) are the caller's, and input()
+            # fails instead of waiting on the terminal of the server
+            os.chdir(cwd)
+            sys.stdin = io.StringIO(stdin)
+            with contextlib.redirect_stdout(out), contextlib.redirect_stderr(
+                    err):
+                try:
+                    args = read_args(argv) or create_parser(
+                        command_of(argv)).parse_args(argv)
+                    run(self.dotfile, args)
+                except SystemExit as exit_:
+                    if isinstance(exit_.code, int) or exit_.code is None:
+                        status = exit_.code or 0
+                    else:
+                        print(exit_.code, file=sys.stderr)
+                        status = 1
+                except Exception:
+                    import traceback
+                    traceback.print_exc()
+                    status = 1
+        except OSError as error:
+            err.write('{}\n'.format(error))
+            status = 1
+        finally:
+            os.chdir(saved[0])
+            sys.stdin = saved[1]
+        out.flush()
+        err.flush()
+        if out.sock and err.sock:
+            try:
+                TodoServer.send(sock, b'x', str(status).encode('utf-8'))
+            except OSError:
+                pass
+
+    def serve(self):
+        import socketserver
+        sock = TodoServer.connect(self.path)
+        if sock:
+            sock.close()
+            print('todo serve is already running on {}'.format(self.path))
             exit()
-        write_todo_file(config, todos)
+        if not hasattr(socketserver, 'UnixStreamServer'):
+            print('todo serve needs Unix domain sockets')
+            exit()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
 
+        TodoCache.hot = {}
+        self.refresh()
+        server = self
 
-def main():
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                server.handle(self.rfile.readline(), self.connection)
+
+        class UnixServer(socketserver.UnixStreamServer):
+            def service_actions(self):
+                server.refresh()
+
+        # Only the owner may connect, commands run with the owner's rights
+        umask = os.umask(0o077)
+        try:
+            unix_server = UnixServer(self.path, Handler)
+        finally:
+            os.umask(umask)
+        print('Serving {} on {}'.format(
+            Dotfile(self.dotfile).todo_path, self.path))
+        import signal
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+        try:
+            with unix_server:
+                unix_server.serve_forever(TodoServer.poll_interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+class TodoUI:
+    """`todo ui`: a full-screen curses list of todos that only ever lays out
+    and draws the rows in view. Matches are pulled from the todos as they
+    scroll into view (or between keystrokes), and the height of a row
+    wrapped to the screen is worked out when it is first drawn, so a
+    keystroke costs the same for ten todos as for a million.
+
+    Keys: arrows or j/k to move, PgUp/PgDn, Home/End, / to filter as you
+    type (Enter keeps the filter, Esc drops it), x or space to toggle done
+    and q to quit."""
+    # Time a redraw may spend looking for matches, the rest is found
+    # between keystrokes
+    budget = 0.03
+    help = '/ filter  x done  q quit'
+
+    class Source:
+        """The todos to show, pulled from an iterable as far as asked."""
+        def __init__(self, items):
+            self.items = iter(items)
+            self.rows = []
+
+        def get(self, pos):
+            while pos >= len(self.rows):
+                item = next(self.items, None)
+                if item is None:
+                    return None
+                self.rows.append(item)
+            return self.rows[pos]
+
+    class Rows:
+        """The rows of the source passing test, found as far as asked."""
+        def __init__(self, source, test=None):
+            self.source = source
+            self.test = test
+            # Next position in source to look at
+            self.pos = 0
+            self.rows = []
+            self.done = False
+
+        def fill(self, count, deadline=None):
+            """Look for matches until there are count, the source runs out
+            or deadline (a time.perf_counter value) has passed."""
+            while len(self.rows) < count and not self.done:
+                item = self.source.get(self.pos)
+                if item is None:
+                    self.done = True
+                    break
+                self.pos += 1
+                if self.test is None or self.test(item):
+                    self.rows.append(item)
+                if (deadline is not None and not self.pos % 256
+                        and time.perf_counter() > deadline):
+                    break
+
+    def __init__(self, config, items):
+        self.config = config
+        self.source = TodoUI.Source(items)
+        self.rows = TodoUI.Rows(self.source)
+        self.text = ''
+        self.typing = False
+        self.top = 0
+        self.cursor = 0
+        self.message = ''
+        # Records changed by toggling, by line no
+        self.changed = {}
+        # Wrapped text of rows by line no, for the current width
+        self.wrapped = {}
+        self.width = None
+
+    def record(self, item):
+        return self.changed.get(item[0], item[1])
+
+    def lines(self, item):
+        """The rows of text of item on screen, wrapped once per width."""
+        lines = self.wrapped.get(item[0])
+        if lines is None:
+            (idx, record) = (item[0], self.record(item))
+            (done, prio, done_date, created_date, due, description,
+             categories, projects, labels, matched, line, warning) = record
+            head = '{:>6} {} {} {} '.format(
+                idx, 'x' if done else ' ',
+                '({})'.format(prio) if prio else '   ',
+                TodoCache.from_ordinal(due).date().isoformat()
+                if due else ' ' * 10)
+            text = ' '.join([description] + ['+' + p for p in projects] +
+                            ['@' + c for c in categories])
+            width = max(10, self.width - len(head))
+            lines = [
+                (head if n == 0 else ' ' * len(head)) + part
+                for n, part in enumerate(
+                    TodoPrinter.Line.split_line(text, width))
+            ]
+            self.wrapped[item[0]] = lines
+        return lines
+
+    def filter(self, text):
+        """Show the rows whose description, projects, contexts or labels
+        contain every word of text, ignoring case."""
+        self.text = text
+        terms = text.lower().split()
+
+        def test(item):
+            (done, prio, done_date, created_date, due, description,
+             categories, projects, labels, matched, line,
+             warning) = self.record(item)
+            words = ' '.join([description] + ['+' + p for p in projects] +
+                             ['@' + c for c in categories] + [
+                                 '{}:{}'.format(key, value)
+                                 for key, value in labels
+                             ]).lower()
+            return all(term in words for term in terms)
+
+        self.rows = TodoUI.Rows(self.source, test if terms else None)
+        self.top = 0
+        self.cursor = 0
+
+    def scroll(self, height):
+        """Move top so that the cursor row is in the height rows of the
+        list, only laying out the rows in between."""
+        if self.cursor <= self.top:
+            self.top = self.cursor
+            return
+        used = sum(
+            len(self.lines(self.rows.rows[pos]))
+            for pos in range(self.top, self.cursor + 1))
+        while used > height and self.top < self.cursor:
+            used -= len(self.lines(self.rows.rows[self.top]))
+            self.top += 1
+
+    def move(self, step, height):
+        self.rows.fill(self.cursor + step + 1,
+                       time.perf_counter() + TodoUI.budget)
+        self.cursor = max(0, min(self.cursor + step, len(self.rows.rows) - 1))
+        self.scroll(height)
+
+    def toggle(self):
+        import contextlib
+        if not self.rows.rows:
+            return
+        item = self.rows.rows[self.cursor]
+        labels = dict(self.record(item)[8])
+        ref = 'id:' + labels['id'] if 'id' in labels else str(item[0])
+        config = self.config
+        # Printed messages would land on the screen
+        import io
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            todo = None
+            target = (config, ref, None, None)
+            if config.shard_by:
+                target = TodoShards.resolver(config)(ref)
+            try:
+                if target is not None:
+                    todo = toggle_todo(target[0], target[1], 'toggle')
+            except SystemExit:
+                # Printed why, e.g. for a malformed line
+                pass
+        if todo is None:
+            self.message = out.getvalue().strip() or 'Not found'
+            return
+        self.changed[item[0]] = TodoCache.to_record(todo)
+        self.wrapped.pop(item[0], None)
+
+    def draw(self, screen):
+        import curses
+        (height, width) = screen.getmaxyx()
+        if width != self.width:
+            self.width = width
+            self.wrapped = {}
+        screen.erase()
+        y = 0
+        pos = self.top
+        deadline = time.perf_counter() + TodoUI.budget
+        while y < height - 1:
+            self.rows.fill(pos + 1, deadline)
+            if pos >= len(self.rows.rows):
+                break
+            item = self.rows.rows[pos]
+            attr = curses.A_REVERSE if pos == self.cursor else 0
+            if self.record(item)[0]:
+                attr |= curses.A_DIM
+            for line in self.lines(item):
+                if y >= height - 1:
+                    break
+                screen.addnstr(y, 0, line.ljust(width), width - 1, attr)
+                y += 1
+            pos += 1
+
+        count = '{}{}'.format(len(self.rows.rows),
+                              '' if self.rows.done else '+')
+        if self.typing:
+            status = '/' + self.text
+        else:
+            status = '{} todos{}  {}'.format(
+                count, '  /' + self.text if self.text else '',
+                self.message or TodoUI.help)
+        screen.addnstr(height - 1, 0, status, width - 1, curses.A_BOLD)
+        if self.typing:
+            curses.curs_set(1)
+            screen.move(height - 1, min(len(status), width - 1))
+        else:
+            curses.curs_set(0)
+        screen.refresh()
+
+    def run(self, screen):
+        import curses
+        screen.keypad(True)
+        while True:
+            self.draw(screen)
+            # Look for more matches while no key is pressed
+            screen.timeout(-1 if self.rows.done else 0)
+            key = screen.getch()
+            if key == -1:
+                self.rows.fill(len(self.rows.rows) + 1,
+                               time.perf_counter() + TodoUI.budget)
+                continue
+            height = screen.getmaxyx()[0] - 1
+            self.message = ''
+            if self.typing:
+                if key in (curses.KEY_ENTER, 10, 13):
+                    self.typing = False
+                elif key == 27:
+                    self.typing = False
+                    self.filter('')
+                elif key in (curses.KEY_BACKSPACE, 127, 8):
+                    self.filter(self.text[:-1])
+                elif 32 <= key < 127:
+                    self.filter(self.text + chr(key))
+            elif key in (ord('q'), 27):
+                return
+            elif key == ord('/'):
+                self.typing = True
+            elif key in (curses.KEY_DOWN, ord('j')):
+                self.move(1, height)
+            elif key in (curses.KEY_UP, ord('k')):
+                self.move(-1, height)
+            elif key == curses.KEY_NPAGE:
+                self.move(height, height)
+            elif key == curses.KEY_PPAGE:
+                self.move(-height, height)
+            elif key == curses.KEY_HOME:
+                self.move(-self.cursor, height)
+            elif key == curses.KEY_END:
+                self.rows.fill(float('inf'))
+                self.move(len(self.rows.rows), height)
+            elif key in (ord('x'), ord(' ')):
+                self.toggle()
+
+
+def ui_todo(config, query=None, finished=False, sort=True, sort_keys=None):
+    import contextlib
+    try:
+        import curses
+    except ImportError:
+        print('todo ui needs the curses module')
+        exit()
+    if not sys.stdin.isatty() or not sys.stdout.isatty():
+        print('todo ui needs a terminal')
+        exit()
+    spec = {'finished': finished, 'query': query}
+    if query:
+        compile_query(config, query)
+
+    import io
+    # Warnings about malformed lines would land on the screen
+    with contextlib.redirect_stdout(io.StringIO()):
+        if config.shard_by:
+            items = TodoShards.select(config, spec, sort=sort,
+                                      sort_keys=sort_keys)
+        else:
+            items = query_records(config, spec)
+            if sort:
+                # Sorting needs every match, --no-sort shows the first ones
+                # at once
+                with paused_gc():
+                    items = TodoSorter(sort_keys).select(items)
+        curses.wrapper(TodoUI(config, items).run)
+
+
+def due_arg(s):
+    return datetime.today() if s == 'today' else datetime.strptime(
+        s, '%Y-%m-%d')
+
+
+def read_options(cmd):
+    """The arguments of the read-only commands as [(names, kwargs)] for
+    ArgumentParser.add_argument, None for the other commands. create_parser
+    adds them to the parsers of these commands and read_args reads them
+    without argparse."""
+    fmt = (('--format', ), {
+        'dest': 'fmt',
+        'choices': ('table', ) + TodoExport.formats,
+        'default': 'table',
+        'help': 'Output format (default: %(default)s)'
+    })
+    finished = (('-f', '--finished'), {
+        'dest': 'finished',
+        'action': 'store_true',
+        'help': 'Include finished items'
+    })
+    limit = (('-n', '--limit'), {
+        'metavar': 'N',
+        'dest': 'limit',
+        'type': int,
+        'action': 'store',
+        'help': 'Show only the first N items'
+    })
+    archive = (('-a', '--archive'), {
+        'dest': 'archive',
+        'action': 'store_true',
+        'help': 'Include finished items archived in done.txt, implies -f'
+    })
+    if cmd == 'ls':
+        return [
+            (('query', ), {
+                'type': str,
+                'nargs': '?',
+                'help': 'Only todos matching the query, e.g. \'prio<=B and '
+                '(+infra or @oncall) and due<today+7\''
+            }),
+            (('-@', ), {
+                'metavar': 'category',
+                'dest': 'category',
+                'action': 'store',
+                'help': 'Match specified category'
+            }),
+            (('-+', ), {
+                'metavar': 'project',
+                'dest': 'project',
+                'action': 'store',
+                'help': 'Match specified project'
+            }),
+            (('-d', ), {
+                'metavar': 'due',
+                'dest': 'due',
+                'type': due_arg,
+                'action': 'store',
+                'help': 'Show only items due by specified day'
+            }),
+            finished,
+            limit,
+            (('-s', '--sort'), {
+                'metavar': 'keys',
+                'dest': 'sort_keys',
+                'type': TodoSorter.parse,
+                'action': 'store',
+                'help': 'Sort by comma-separated fields ({}), prefix with ~ '
+                'for descending order, e.g. -s prio,~due or --sort=-due '
+                '(default: {})'.format(','.join(TodoSorter.fields),
+                                       TodoSorter.default)
+            }),
+            (('--no-sort', ), {
+                'dest': 'sort',
+                'action': 'store_false',
+                'help': 'Show items in file order as they are read'
+            }),
+            archive,
+            (('--view', ), {
+                'metavar': 'name',
+                'dest': 'view',
+                'action': 'store',
+                'help': 'List a view defined in the dotfile'
+            }),
+            fmt,
+        ]
+    if cmd == 'search':
+        return [
+            (('words', ), {
+                'type': str,
+                'nargs': '+',
+                'help': 'Words the description must have, end with * to '
+                'match the start of a word'
+            }),
+            (('-i', '--ignore-case'), {
+                'dest': 'fold',
+                'action': 'store_true',
+                'help': 'Ignore case'
+            }),
+            finished,
+            limit,
+            archive,
+            fmt,
+        ]
+    if cmd == 'show':
+        return [
+            (('line', ), {
+                'type': str,
+                'help': 'The line no or id of the todo to show',
+                'action': 'store'
+            }),
+            fmt,
+        ]
+    if cmd == 'ids':
+        return [(('--assign', ), {
+            'dest': 'assign',
+            'action': 'store_true',
+            'help': 'Give every todo without an id one'
+        })]
+    if cmd == 'completions':
+        return [
+            (('shell', ), {
+                'nargs': '?',
+                'choices': tuple(completion_scripts),
+                'help': 'Print the completion script for shell'
+            }),
+            (('--query', ), {
+                'nargs': 2,
+                'metavar': ('kind', 'prefix'),
+                'help': 'Print the {} names starting with prefix'.format(
+                    '/'.join(TodoVocabulary.kinds))
+            }),
+        ]
+    return None
+
+
+def create_parser(cmd=None):
+    """Build the argument parser, with only the sub-command cmd when given."""
+    import argparse
     parser = argparse.ArgumentParser(description='Todo.txt CLI')
+    parser.add_argument('--timings',
+                        action='store_true',
+                        help='Report the time spent per phase and counters '
+                        'on stderr')
+    parser.add_argument('--profile',
+                        action='store_true',
+                        help='Report a cProfile profile of the command on '
+                        'stderr')
 
     subparsers = parser.add_subparsers(help='sub-command help', dest='cmd')
 
+    def add_read_only(name, help_text):
+        # Declared in read_options, shared with read_args
+        if cmd in (None, name):
+            sub_parser = subparsers.add_parser(name, help=help_text)
+            for names, kwargs in read_options(name):
+                sub_parser.add_argument(*names, **kwargs)
+
     # todo add
-    add_parser = subparsers.add_parser('add', help='Add todo')
-    add_parser.add_argument('description',
-                            type=str,
-                            help='Description of todo')
-    add_parser.add_argument('-t',
-                            '--today',
-                            dest='today',
-                            action='store_true',
-                            help='Include created date',
-                            required=False)
-    add_parser.add_argument('-d',
-                            metavar='due',
-                            dest='due',
-                            type=lambda s: datetime.strptime(s, '%Y-%m-%d'),
-                            action='store',
-                            help='Set due date',
-                            required=False)
-    add_parser.add_argument('-@',
-                            metavar='category',
-                            dest='category',
-                            default=[],
-                            type=lambda s: s.split(','),
-                            action='store',
-                            help='Set categories, separated by commas')
-    add_parser.add_argument('-+',
-                            metavar='project',
-                            dest='project',
-                            default=[],
-                            type=lambda s: s.split(','),
-                            action='store',
-                            help='Set projects, separated by commas')
-    add_parser.add_argument('-p',
-                            metavar='priority',
-                            dest='prio',
-                            type=lambda s: s.upper()[0],
-                            action='store',
-                            help='Set priority')
-
-    # todo ls
-    ls_parser = subparsers.add_parser('ls', help='List todo')
-    ls_parser.add_argument('-@',
-                           metavar='category',
-                           dest='category',
-                           action='store',
-                           help='Match specified category')
-    ls_parser.add_argument('-+',
-                           metavar='project',
-                           dest='project',
-                           action='store',
-                           help='Match specified project')
-    ls_parser.add_argument(
-        '-d',
-        metavar='due',
-        dest='due',
-        type=lambda s: datetime.today()
-        if s == 'today' else datetime.strptime(s, '%Y-%m-%d'),
-        action='store',
-        help='Show only items due by specified day')
-    ls_parser.add_argument('-f',
-                           '--finished',
-                           dest='finished',
-                           action='store_true',
-                           help='Include finished items')
+    if cmd in (None, 'add'):
+        add_parser = subparsers.add_parser('add', help='Add todo')
+        add_parser.add_argument('description',
+                                type=str,
+                                help='Description of todo')
+        add_parser.add_argument('-t',
+                                '--today',
+                                dest='today',
+                                action='store_true',
+                                help='Include created date',
+                                required=False)
+        add_parser.add_argument('-d',
+                                metavar='due',
+                                dest='due',
+                                type=lambda s: datetime.strptime(s, '%Y-%m-%d'),
+                                action='store',
+                                help='Set due date',
+                                required=False)
+        add_parser.add_argument('-@',
+                                metavar='category',
+                                dest='category',
+                                default=[],
+                                type=lambda s: s.split(','),
+                                action='store',
+                                help='Set categories, separated by commas')
+        add_parser.add_argument('-+',
+                                metavar='project',
+                                dest='project',
+                                default=[],
+                                type=lambda s: s.split(','),
+                                action='store',
+                                help='Set projects, separated by commas')
+        add_parser.add_argument('-p',
+                                metavar='priority',
+                                dest='prio',
+                                type=lambda s: s.upper()[0],
+                                action='store',
+                                help='Set priority')
+
+    add_read_only('ls', 'List todo')
+    add_read_only('search', 'Search the descriptions of todos')
+    add_read_only('show', 'Show todo')
 
     # todo rm
-    rm_parser = subparsers.add_parser('rm', help='Remove todo')
-    rm_parser.add_argument('line',
-                           type=str,
-                           help='The line no of the todo to remove',
-                           action='store')
-    edit_parser = subparsers.add_parser('edit', help='Edit todo')
-
-    edit_parser.add_argument('line',
-                             type=str,
-                             help='The line no of the todo to edit',
-                             action='store')
-    edit_parser.add_argument('description',
-                             type=str,
-                             help='New description of todo')
+    if cmd in (None, 'rm'):
+        rm_parser = subparsers.add_parser('rm', help='Remove todo')
+        rm_parser.add_argument('line',
+                               type=str,
+                               help='The line no or id of the todo to remove',
+                               action='store')
+
+    # todo edit
+    if cmd in (None, 'edit'):
+        edit_parser = subparsers.add_parser('edit', help='Edit todo')
+        edit_parser.add_argument('line',
+                                 type=str,
+                                 help='The line no or id of the todo to edit',
+                                 action='store')
+        edit_parser.add_argument('description',
+                                 type=str,
+                                 help='New description of todo')
 
     # todo set
-    set_parser = subparsers.add_parser('set', help='Toggle status of todo')
-    set_parser.add_argument('line',
-                            type=str,
-                            help='The line of the todo to toggle',
-                            action='store')
-    set_parser.add_argument('status', choices=['done', 'ongoing', 'toggle'])
-    args = parser.parse_args(sys.argv[1:])
+    if cmd in (None, 'set'):
+        set_parser = subparsers.add_parser('set', help='Toggle status of todo')
+        set_parser.add_argument('line',
+                                type=str,
+                                help='The line no or id of the todo to toggle',
+                                action='store')
+        set_parser.add_argument('status', choices=['done', 'ongoing', 'toggle'])
+
+    # todo batch
+    if cmd in (None, 'batch'):
+        batch_parser = subparsers.add_parser(
+            'batch', help='Apply many add/set/edit/rm operations at once')
+        batch_parser.add_argument(
+            'file',
+            type=str,
+            nargs='?',
+            default='-',
+            help='File with one operation per line (default: stdin)')
+
+    # todo archive
+    if cmd in (None, 'archive'):
+        archive_parser = subparsers.add_parser(
+            'archive', help='Move finished todos to done.txt')
+        archive_parser.add_argument('-d',
+                                    '--days',
+                                    metavar='N',
+                                    dest='days',
+                                    type=int,
+                                    action='store',
+                                    help='Only todos finished N or more days ago')
+
+    add_read_only('ids', 'Count the todos without an id, or give them one')
+
+    # todo serve
+    if cmd in (None, 'serve'):
+        subparsers.add_parser(
+            'serve', help='Keep todo.txt in memory and run commands for others')
+
+    # todo ui
+    if cmd in (None, 'ui'):
+        ui_parser = subparsers.add_parser(
+            'ui', help='Browse todos and check them off in a full-screen list')
+        ui_parser.add_argument('query',
+                               type=str,
+                               nargs='?',
+                               help='Only todos matching the query')
+        ui_parser.add_argument('-f',
+                               '--finished',
+                               dest='finished',
+                               action='store_true',
+                               help='Include finished items')
+        ui_parser.add_argument('-s',
+                               '--sort',
+                               metavar='keys',
+                               dest='sort_keys',
+                               type=TodoSorter.parse,
+                               action='store',
+                               help='Sort by comma-separated fields (see ls)')
+        ui_parser.add_argument('--no-sort',
+                               dest='sort',
+                               action='store_false',
+                               help='Keep file order, showing the first todos '
+                               'before the whole file is read')
+
+    add_read_only('completions',
+                  'Shell completion of projects, contexts, labels and ids')
+
+    return parser
+
+
+class Arguments:
+    """The arguments read by read_args, like an argparse Namespace."""
+
+
+def read_args(argv):
+    """The arguments in argv of a read-only command (see read_options) as
+    argparse reads them, without argparse: importing it and building a parser
+    takes longer than a short ls takes to run. Only the plain forms are read,
+    an option with its value in one word (--limit=5, -n5) or in two (-n 5).
+    Returns None on anything else (another command, -h, abbreviated or
+    combined options, a value that does not convert, a missing argument),
+    for argparse to read it and report the error or print the help."""
+    args = Arguments()
+    (args.timings, args.profile) = (False, False)
+    words = iter(argv)
+    for word in words:
+        if word not in ('--timings', '--profile'):
+            break
+        setattr(args, word[2:], True)
+    else:
+        return None
+    spec = read_options(word)
+    if spec is None:
+        return None
+    args.cmd = word
+    options = {}
+    positionals = []
+    for names, kwargs in spec:
+        if not names[0].startswith('-'):
+            positionals.append((names[0], kwargs))
+            continue
+        action = kwargs.get('action', 'store')
+        dest = kwargs.get('dest') or names[-1].lstrip('-').replace('-', '_')
+        setattr(args, dest, {
+            'store_true': False,
+            'store_false': True
+        }.get(action, kwargs.get('default')))
+        for name in names:
+            options[name] = (dest, action, kwargs)
+
+    # Runs of positional arguments, argparse only takes them in one
+    runs = []
+    after_option = True
+    for word in words:
+        if not word.startswith('-') or word == '-':
+            if after_option:
+                runs.append([])
+                after_option = False
+            runs[-1].append(word)
+            continue
+        after_option = True
+        if word.startswith('--'):
+            (option, sep, value) = word.partition('=')
+            value = value if sep else None
+        elif word[2:3] == '=':
+            # argparse reads -n=5 as -n 5
+            return None
+        else:
+            (option, value) = (word[:2], word[2:] or None)
+        if option not in options:
+            return None
+        (dest, action, kwargs) = options[option]
+        if action != 'store':
+            if value is not None:
+                return None
+            setattr(args, dest, action == 'store_true')
+            continue
+        nargs = kwargs.get('nargs')
+        values = [] if value is None else [value]
+        if values and nargs is not None:
+            return None
+        while len(values) < (nargs or 1):
+            value = next(words, None)
+            if value is None or value.startswith('-') and value != '-':
+                return None
+            values.append(value)
+        values = read_values(values, kwargs)
+        if values is None:
+            return None
+        setattr(args, dest, values[0] if nargs is None else values)
+    if len(runs) > 1:
+        return None
+
+    words = runs[0] if runs else []
+    for dest, kwargs in positionals:
+        nargs = kwargs.get('nargs')
+        if (nargs is None and len(words) != 1 or nargs == '+' and not words
+                or nargs == '?' and len(words) > 1):
+            return None
+        values = read_values(words, kwargs)
+        if values is None:
+            return None
+        if nargs == '+':
+            setattr(args, dest, values)
+        else:
+            setattr(args, dest, values[0] if values else kwargs.get('default'))
+        words = []
+    return None if words else args
 
-    config = Dotfile(os.path.expanduser('~') + '/' + '.todo-cli')
 
+def read_values(values, kwargs):
+    """values converted and checked like add_argument(**kwargs) does, None
+    when one is not valid."""
+    convert = kwargs.get('type')
+    try:
+        values = [convert(value) for value in values] if convert else values
+    except Exception:
+        return None
+    choices = kwargs.get('choices')
+    if choices is not None and any(value not in choices for value in values):
+        return None
+    return values
+
+
+commands = ('add', 'ls', 'search', 'show', 'rm', 'edit', 'set', 'batch',
+            'archive', 'ids', 'serve', 'ui', 'completions')
+
+
+completion_bash = r'''# todo completion for bash, from `todo completions bash`
+_todo() {
+    local line=${COMP_LINE:0:COMP_POINT}
+    local cur=${line##*[[:space:]]} kind
+    local -a words=(${line%"$cur"})
+    if [ ${#words[@]} -le 1 ]; then
+        COMPREPLY=($(compgen -W "@COMMANDS@" -- "$cur"))
+        return
+    fi
+    case "${words[${#words[@]}-1]}" in
+        -+) kind=project ;;
+        -@) kind=category ;;
+        --view) kind=view ;;
+        *)
+            case "$cur" in
+                +*|@*|*:*) kind=word ;;
+                *)
+                    case "${words[1]}" in
+                        show|rm|edit|set) [ ${#words[@]} -eq 2 ] && kind=id ;;
+                    esac ;;
+            esac ;;
+    esac
+    [ -n "$kind" ] || return
+    local IFS=$'\n'
+    COMPREPLY=($(@TODO@ completions --query "$kind" "$cur" 2>/dev/null))
+    if [[ "$cur" == *:* && "$COMP_WORDBREAKS" == *:* ]]; then
+        # Only what follows the last colon is replaced
+        local head=${cur%"${cur##*:}"}
+        COMPREPLY=("${COMPREPLY[@]#"$head"}")
+    fi
+}
+complete -o default -F _todo todo todo.py
+'''
+
+completion_scripts = {
+    'bash': completion_bash,
+    'zsh': '# todo completion for zsh, from `todo completions zsh`\n'
+    'autoload -U +X bashcompinit && bashcompinit\n' + completion_bash,
+    'fish': r'''# todo completion for fish, from `todo completions fish`
+function __todo_complete
+    set -l words (commandline -opc)
+    set -l cur (commandline -ct)
+    set -l kind
+    if test (count $words) -le 1
+        printf '%s\n' @COMMANDS@
+        return
+    end
+    switch $words[-1]
+        case -+
+            set kind project
+        case -@
+            set kind category
+        case --view
+            set kind view
+        case '*'
+            switch $cur
+                case '+*' '@*' '*:*'
+                    set kind word
+                case '*'
+                    if test (count $words) -eq 2
+                        and contains -- $words[2] show rm edit set
+                        set kind id
+                    end
+            end
+    end
+    test -n "$kind"
+    and @TODO@ completions --query $kind "$cur" 2>/dev/null
+end
+complete -c todo -c todo.py -a '(__todo_complete)'
+''',
+}
+
+
+def run_command(config, args):
+    """Run the sub-command in args, returns False when there is none."""
+    start = 0
+    if config.shard_by and args.cmd in ('show', 'rm', 'edit', 'set'):
+        target = TodoShards.resolver(config)(args.line)
+        if target is None:
+            return True
+        config, args.line, _, start = target
     if args.cmd == 'add':
-        add_todo(config, args.prio,
-                 datetime.today() if args.today else None, args.description,
-                 args.project, args.category, args.due)
+        config = add_todo(config, args.prio,
+                          datetime.today() if args.today else None,
+                          args.description, args.project, args.category,
+                          args.due)
     elif args.cmd == 'ls':
-        ls_todo(config, args.category, args.project, args.due, args.finished)
+        ls_todo(config, args.category, args.project, args.due, args.finished
+                or args.archive, args.limit, args.sort, args.sort_keys,
+                args.archive, args.query, args.fmt, args.view)
+        return True
+    elif args.cmd == 'search':
+        search_todo(config, args.words, args.fold, args.finished
+                    or args.archive, args.limit, args.archive, args.fmt)
+        return True
+    elif args.cmd == 'show':
+        show_todo(config, args.line, args.fmt, start)
+        return True
     elif args.cmd == 'rm':
         remove_todo(config, args.line)
     elif args.cmd == 'edit':
         edit_todo(config, args.line, args.description)
     elif args.cmd == 'set':
         toggle_todo(config, args.line, args.status)
+    elif args.cmd == 'batch':
+        batch_todo(config, args.file)
+    elif args.cmd == 'archive':
+        archived = sum(
+            archive_todo(shard, args.days)
+            for shard in TodoShards.configs(config))
+        print('Archived {} todos to {}'.format(archived, config.done_path))
+        return True
+    elif args.cmd == 'ids':
+        count = sum(
+            assign_ids(shard, not args.assign)
+            for shard in TodoShards.configs(config))
+        if args.assign:
+            print('Gave ids to {} todos'.format(count))
+        else:
+            print('{} todos have no id, give them one with todo ids '
+                  '--assign'.format(count))
+        return True
+    elif args.cmd == 'ui':
+        ui_todo(config, args.query, args.finished, args.sort, args.sort_keys)
+    elif args.cmd == 'completions':
+        if args.query:
+            if args.query[0] not in TodoVocabulary.kinds:
+                print('Unknown kind: {}'.format(args.query[0]))
+                exit()
+            complete(config, *args.query)
+        elif args.shell:
+            sys.stdout.write(completion_script(args.shell))
+        else:
+            print('Give a shell: {}'.format(', '.join(completion_scripts)))
+        return True
     else:
-        print(parser.print_help())
+        return False
+    auto_archive(config)
+    return True
+
+
+def command_of(argv):
+    # Global options all come before the sub-command and take no value
+    cmd = next((arg for arg in argv if not arg.startswith('-')), None)
+    return cmd if cmd in commands else None
+
+
+def run(dotfile, args):
+    """Run the sub-command in args with the --timings and --profile options
+    applied, returns False when there is none."""
+    if args.timings:
+        TodoStats.enable()
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        with TodoStats.phase('dotfile'):
+            config = Dotfile(dotfile)
+        return run_command(config, args)
+    finally:
+        if args.profile:
+            profiler.disable()
+            import pstats
+            stats = pstats.Stats(profiler, stream=sys.stderr)
+            stats.sort_stats('cumulative').print_stats(40)
+        if args.timings:
+            TodoStats.report()
+            TodoStats.disable()
+
+
+def main():
+    dotfile = os.path.expanduser('~') + '/' + '.todo-cli'
+    argv = sys.argv[1:]
+    cmd = command_of(argv)
+    if cmd in TodoServer.commands and TodoServer.forward(dotfile, argv):
         return
 
+    # The read-only commands are read without argparse, for the others
+    # only the sub-command that is run is built
+    args = read_args(argv)
+    if args is None:
+        args = create_parser(cmd).parse_args(argv)
+
+    if args.cmd == 'serve':
+        TodoServer(dotfile).serve()
+    elif not run(dotfile, args):
+        print(create_parser().print_help())
+
 
 if __name__ == "__main__":
     main()